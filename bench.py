@@ -0,0 +1,472 @@
+import argparse
+import multiprocessing
+import random
+import re
+import resource
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import ssqlite
+import ssqlite.config
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+from ssqlite.algo import SSqliteQueryGraph, build_sqg_from_sql, execute_returning_rowids, get_sqg_filepath
+from ssqlite.index import Index
+from ssqlite.node import DropNode, InsertNode, UpdateNode
+from ssqlite.recovery import generate_undo_query
+from ssqlite.utils import NodeType, parse_query_string
+
+
+# Statement counts of the synthetic workload benchmark
+WORKLOAD_SIZES = (10_000, 1_000_000, 10_000_000)
+
+
+def write_script(base_dir: str, sql_filename: str, queries: list[str]) -> None:
+    """Helper function for writing benchmark queries under BASE_DIR/data"""
+    data_dir = Path(base_dir) / "data"
+    data_dir.mkdir(parents=True, exist_ok=True)
+    with open(data_dir / sql_filename, "w") as f:
+        f.writelines(f"{query}\n" for query in queries)
+
+
+def bench_returning(num_rows: int=2000, num_updates: int=10000, repeat: int=3) -> None:
+    """Compare UPDATE-heavy ingestion with and without RETURNING rowid"""
+    create_query = "CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255), code VARCHAR(255));"
+    insert_queries = [
+        f"INSERT INTO X(id, name, code) VALUES({i}, 'name{i}', 'code{i}');"
+        for i in range(1, num_rows + 1)
+    ]
+    update_queries = [
+        f"UPDATE X SET name='update{i}' WHERE code='code{i % num_rows + 1}';"
+        for i in range(num_updates)
+    ]
+    queries = [create_query] + insert_queries + update_queries
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        ssqlite.config.BASE_DIR = base_dir
+        write_script(base_dir, "returning.sql", queries)
+        db_filepath = Path(base_dir) / "returning.db"
+
+        default = ssqlite.config.USE_RETURNING
+        for use_returning in (False, True):
+            ssqlite.config.USE_RETURNING = use_returning
+            mode = "RETURNING rowid" if use_returning else "SELECT rowid"
+
+            # 1. Rowid capture + UPDATE only
+            best = float("inf")
+            for _ in range(repeat):
+                db_filepath.unlink(missing_ok=True)
+                conn = sqlite3.connect(db_filepath)
+                cursor = conn.cursor()
+                cursor.execute(create_query)
+                cursor.executescript("".join(insert_queries))
+                start = time.perf_counter()
+                for query in update_queries:
+                    condition = query[query.index("WHERE"):-1]
+                    execute_returning_rowids(cursor, query, "X", condition)
+                conn.commit()
+                best = min(best, time.perf_counter() - start)
+                conn.close()
+            print(f"[returning] {mode:<16} update path {num_updates / best:>12,.0f} statements/sec")
+
+            # 2. End-to-end graph building
+            best = float("inf")
+            for _ in range(repeat):
+                db_filepath.unlink(missing_ok=True)
+                conn = sqlite3.connect(db_filepath)
+                start = time.perf_counter()
+                build_sqg_from_sql(conn.cursor(), "returning.sql", "returning.sqg", batch_size=10000)
+                best = min(best, time.perf_counter() - start)
+                conn.close()
+            print(f"[returning] {mode:<16} end-to-end  {len(queries) / best:>12,.0f} statements/sec")
+        ssqlite.config.USE_RETURNING = default
+
+
+class StringKeyIndex(object):
+    """Insert/update part of the former Index, keyed by f-strings, kept for comparison"""
+
+    def __init__(self):
+        self.order_index = {}
+        self.insert_index = {}
+        self.update_index = defaultdict(list)
+
+    def add(self, node) -> None:
+        if isinstance(node, InsertNode):
+            self.insert_index[f"{node.target_table}-{node.primary_key}"] = node
+        elif isinstance(node, UpdateNode):
+            self.update_index[f"{node.target_table}-{node.primary_key}-{node.target_column}"].append(node)
+        self.order_index[node.query_order] = node
+
+    def find_insert(self, table_name: str, primary_key: int):
+        return self.insert_index[f"{table_name}-{primary_key}"]
+
+    def find_last_update(self, table_name: str, primary_key: int, column_name: str):
+        try:
+            return self.update_index[f"{table_name}-{primary_key}-{column_name}"][-1]
+        except Exception:
+            return None
+
+
+class TupleKeyIndex(Index):
+    """Index with the same lookup signature as StringKeyIndex"""
+
+    def find_insert(self, table_name: str, primary_key: int):
+        return self.find(_from="insert", _key=(table_name, primary_key))
+
+
+def bench_index(num_rows: int=200000, num_updates: int=200000, repeat: int=3) -> None:
+    """Compare build and lookup throughput of tuple-key and string-key indexes"""
+    tables = [f"table_{i}" for i in range(10)]
+    columns = ["name", "status", "score"]
+    nodes = [
+        InsertNode(
+            query_order=i, query_string="", primary_key=i // len(tables),
+            target_table=tables[i % len(tables)]
+        )
+        for i in range(num_rows)
+    ]
+    nodes += [
+        UpdateNode(
+            query_order=num_rows + i, query_string="", primary_key=(i * 7) % num_rows // len(tables),
+            target_table=tables[(i * 7) % num_rows % len(tables)], target_column=columns[i % len(columns)]
+        )
+        for i in range(num_updates)
+    ]
+    lookups = [(node.target_table, node.primary_key, columns[i % len(columns)]) for i, node in enumerate(nodes)]
+
+    for index_cls in (StringKeyIndex, TupleKeyIndex):
+        build, lookup = float("inf"), float("inf")
+        for _ in range(repeat):
+            index = index_cls()
+            start = time.perf_counter()
+            for node in nodes:
+                index.add(node)
+            build = min(build, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for table_name, primary_key, column_name in lookups:
+                index.find_insert(table_name, primary_key)
+                index.find_last_update(table_name, primary_key, column_name)
+            lookup = min(lookup, time.perf_counter() - start)
+        print(f"[index] {index_cls.__name__:<15} build  {len(nodes) / build:>12,.0f} nodes/sec")
+        print(f"[index] {index_cls.__name__:<15} lookup {len(lookups) / lookup:>12,.0f} rows/sec")
+
+
+def legacy_parse_query_string(query_string: str) -> dict:
+    """Former regex chain of parse_query_string, kept for comparison"""
+    inst = query_string.split()[0]
+    if inst not in [nt.name for nt in NodeType]:
+        return None
+
+    table_name, column_name, condition = None, None, None
+    where_pattern = r"(?P<condition>WHERE(\s+)([a-zA-Z0-9_]*)(\s*)=(\s*)(\'?)(\"?)([a-zA-Z0-9_]+)(\'?)(\"?))"
+    if inst == "CREATE":
+        table_name = re.search(r"TABLE(\s+)(?P<table_name>[a-zA-Z0-9_]+)(\s+)", query_string, re.IGNORECASE).group("table_name")
+    elif inst == "INSERT":
+        table_name = re.search(r"INSERT(\s+)INTO(\s+)(?P<table_name>[a-zA-Z0-9_]+)", query_string, re.IGNORECASE).group("table_name")
+    elif inst == "UPDATE":
+        table_name = re.search(r"UPDATE(\s+)(?P<table_name>[a-zA-Z0-9_]+)(\s+)SET", query_string, re.IGNORECASE).group("table_name")
+        column_name = re.search(r"SET(\s+)(?P<column_name>[a-zA-Z0-9_]+)(\s*)=", query_string, re.IGNORECASE).group("column_name")
+        condition = re.search(where_pattern, query_string, re.IGNORECASE).group("condition")
+    elif inst == "DROP":
+        table_name = re.search(r"DROP(\s+)TABLE(\s+)(?P<table_name>[a-zA-Z0-9_]+)", query_string, re.IGNORECASE).group("table_name")
+    elif inst == "DELETE":
+        table_name = re.search(r"DELETE(\s+)FROM(\s+)(?P<table_name>[a-zA-Z0-9_]+)(\s+)", query_string, re.IGNORECASE).group("table_name")
+        condition = re.search(where_pattern, query_string, re.IGNORECASE).group("condition")
+
+    return {"inst": inst, "table_name": table_name, "column_name": column_name, "condition": condition}
+
+
+def bench_parse(num_queries: int=1000000, repeat: int=3) -> None:
+    """Compare parsing throughput of the compiled classifier and the former regex chain"""
+    templates = [
+        "CREATE TABLE T{i} (id INTEGER PRIMARY KEY, name VARCHAR(255), code VARCHAR(255));",
+        "INSERT INTO T{t}(id, name, code) VALUES({i}, 'name{i}', 'code{i}');",
+        "INSERT INTO T{t}(id, name, code) VALUES({i}, 'name{i}', 'code{i}');",
+        "INSERT INTO T{t}(id, name, code) VALUES({i}, 'name{i}', 'code{i}');",
+        "UPDATE T{t} SET name='update{i}' WHERE id={i};",
+        "UPDATE T{t} SET code='code{i}' WHERE name='name{i}';",
+        "DELETE FROM T{t} WHERE id={i};",
+        "DROP TABLE T{i};",
+    ]
+    queries = [
+        templates[i % len(templates)].format(i=i, t=i % 10)
+        for i in range(num_queries)
+    ]
+
+    for parse in (legacy_parse_query_string, parse_query_string):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for query in queries:
+                parse(query)
+            best = min(best, time.perf_counter() - start)
+        print(f"[parse] {parse.__name__:<25} {num_queries / best:>12,.0f} statements/sec")
+
+
+def bench_executemany(num_rows: int=1000000, repeat: int=3) -> None:
+    """Compare bulk loading with sqlite3 and with a recording connection"""
+    create_query = "CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255), code VARCHAR(255))"
+    rows = [(f"name{i}", f"code{i}") for i in range(num_rows)]
+    rows_with_id = [(i + 1, name, code) for i, (name, code) in enumerate(rows)]
+    # Every ssqlite run records to a fresh .sqg file, rather than growing the default one
+    cases = [
+        ("sqlite3", lambda run: sqlite3.connect(":memory:"), "INSERT INTO X(name, code) VALUES(?, ?)", rows),
+        (
+            "ssqlite bulk", lambda run: ssqlite.connect(":memory:", sqg_filename=f"bulk{run}.sqg"),
+            "INSERT INTO X(name, code) VALUES(?, ?)", rows
+        ),
+        (
+            "ssqlite row by row", lambda run: ssqlite.connect(":memory:", sqg_filename=f"rowbyrow{run}.sqg"),
+            "INSERT INTO X(id, name, code) VALUES(?, ?, ?)", rows_with_id
+        ),
+    ]
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        ssqlite.config.BASE_DIR = base_dir
+        for name, connect, insert_query, params in cases:
+            best = float("inf")
+            for run in range(repeat):
+                conn = connect(run)
+                conn.execute(create_query)
+                start = time.perf_counter()
+                conn.executemany(insert_query, params)
+                conn.commit()
+                best = min(best, time.perf_counter() - start)
+                conn.close()
+            print(f"[executemany] {name:<18} {num_rows / best:>12,.0f} rows/sec")
+
+
+class Workload(object):
+    """Seeded generator of a realistic statement mix over many tables
+
+    Most statements insert rows, update them or delete them, with a small set of hot
+    rows whose update chains grow long. Once in a while a whole table holding many
+    rows is dropped and created again.
+    """
+
+    def __init__(
+            self, num_tables: int=20, num_hot_rows: int=50, seed: int=0,
+            weights: dict[str, float] | None=None
+        ):
+        self.num_tables = num_tables
+        self.num_hot_rows = num_hot_rows
+        self.rng = random.Random(seed)
+        self.weights = weights or {
+            "insert": 0.45, "update": 0.25, "hot_update": 0.1, "multi_update": 0.04,
+            "delete": 0.1, "multi_delete": 0.02, "drop": 0.0002,
+        }
+        self.num_created = 0
+        # Dropped tables are created again by the next statement
+        self.dropped = []
+        # Next rowid, live rowids and position of every live rowid in them, per table
+        self.next_ids = {}
+        self.live_ids = {}
+        self.positions = {}
+
+    def create(self, table_name: str) -> str:
+        self.next_ids[table_name] = 1
+        self.live_ids[table_name] = []
+        self.positions[table_name] = {}
+        return f"CREATE TABLE {table_name} (id INTEGER PRIMARY KEY, name VARCHAR(255), score INTEGER, team VARCHAR(255));"
+
+    def remove(self, table_name: str, rowid: int) -> None:
+        # Swap with the last live rowid, so that removal is O(1)
+        live_ids, positions = self.live_ids[table_name], self.positions[table_name]
+        idx = positions.pop(rowid)
+        last_id = live_ids.pop()
+        if last_id != rowid:
+            live_ids[idx] = last_id
+            positions[last_id] = idx
+
+    def statement(self) -> str:
+        """Generate the next statement"""
+        rng = self.rng
+        if self.num_created < self.num_tables:
+            self.num_created += 1
+            return self.create(f"T{self.num_created - 1}")
+        if self.dropped:
+            return self.create(self.dropped.pop())
+
+        table_name = f"T{rng.randrange(self.num_tables)}"
+        live_ids = self.live_ids[table_name]
+        kind = rng.choices(list(self.weights), weights=list(self.weights.values()))[0]
+        if kind == "drop" and live_ids:
+            self.dropped.append(table_name)
+            return f"DROP TABLE {table_name};"
+        if kind == "insert" or not live_ids:
+            rowid = self.next_ids[table_name]
+            self.next_ids[table_name] += 1
+            self.positions[table_name][rowid] = len(live_ids)
+            live_ids.append(rowid)
+            return (
+                f"INSERT INTO {table_name}(id, name, score, team) "
+                f"VALUES({rowid}, 'name{rowid}', {rng.randrange(100)}, 'team{rowid % 8}');"
+            )
+        if kind == "update":
+            rowid = rng.choice(live_ids)
+            return f"UPDATE {table_name} SET name='name{rng.randrange(10 ** 6)}' WHERE id={rowid};"
+        if kind == "hot_update":
+            rowid = live_ids[rng.randrange(min(self.num_hot_rows, len(live_ids)))]
+            if rng.random() < 0.5:
+                return f"UPDATE {table_name} SET score=score+1 WHERE id={rowid};"
+            return f"UPDATE {table_name} SET score={rng.randrange(100)} WHERE id={rowid};"
+        if kind == "multi_update":
+            return f"UPDATE {table_name} SET team='team{rng.randrange(8)}' WHERE score={rng.randrange(100)};"
+        if kind == "delete":
+            rowid = rng.choice(live_ids)
+            self.remove(table_name, rowid)
+            return f"DELETE FROM {table_name} WHERE id={rowid};"
+        # Range of consecutive rowids, which are mostly live
+        first_id = rng.choice(live_ids)
+        for rowid in range(first_id, first_id + 10):
+            if rowid in self.positions[table_name]:
+                self.remove(table_name, rowid)
+        return f"DELETE FROM {table_name} WHERE id>={first_id} AND id<{first_id + 10};"
+
+    def generate(self, num_statements: int) -> Iterator[str]:
+        """Generate given number of statements"""
+        for _ in range(num_statements):
+            yield self.statement()
+
+
+def get_peak_rss() -> int:
+    """Peak resident set size of the current process in bytes"""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def run_workload(num_statements: int, seed: int=0, num_samples: int=1000) -> dict:
+    """Build the graph of a workload and measure it, meant to run in a fresh process"""
+    with tempfile.TemporaryDirectory() as base_dir:
+        ssqlite.config.BASE_DIR = base_dir
+        write_script(base_dir, "workload.sql", Workload(seed=seed).generate(num_statements))
+
+        # 1. Ingestion
+        conn = sqlite3.connect(Path(base_dir) / "workload.db")
+        start = time.perf_counter()
+        build_sqg_from_sql(conn.cursor(), "workload.sql", "workload.sqg", batch_size=10000)
+        ingest = time.perf_counter() - start
+        conn.close()
+        sqg_size = get_sqg_filepath("workload.sqg").stat().st_size
+
+        # 2. Loading and saving the graph
+        start = time.perf_counter()
+        graph = SSqliteQueryGraph.load_from_file("workload.sqg")
+        load = time.perf_counter() - start
+        start = time.perf_counter()
+        SSqliteQueryGraph.save_to_file(graph, "resaved.sqg")
+        save = time.perf_counter() - start
+
+        # 3. Undo generation of sampled query orders, per node type
+        rng = random.Random(seed)
+        query_orders = list(graph.index.order_index)
+        sampled_orders = rng.sample(query_orders, min(num_samples, len(query_orders)))
+        # DROPs are rare but the heaviest to undo, so every one of them is measured
+        sampled_orders += [
+            query_order for query_order, node in graph.index.order_index.items() if isinstance(node, DropNode)
+        ][:num_samples]
+        latencies = defaultdict(list)
+        for query_order in set(sampled_orders):
+            node_type = type(graph.index.find_by_order(query_order)).__name__
+            start = time.perf_counter()
+            generate_undo_query(graph, query_order=query_order)
+            latencies[node_type].append(time.perf_counter() - start)
+
+    return {
+        "statements/sec": num_statements / ingest,
+        "load": load,
+        "save": save,
+        "sqg size": sqg_size,
+        "peak rss": get_peak_rss(),
+        "latencies": dict(latencies),
+    }
+
+
+def bench_workload(sizes: tuple[int]=WORKLOAD_SIZES, seed: int=0) -> None:
+    """Measure ingestion, .sqg size, memory and undo latency of synthetic workloads"""
+    # Every size runs in a fresh process, so that peak RSS belongs to that size only
+    context = multiprocessing.get_context("spawn")
+    for num_statements in sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_workload, num_statements, seed).result()
+        label = f"{num_statements:,} statements"
+        print(f"[workload] {label:<22} ingest     {result['statements/sec']:>12,.0f} statements/sec")
+        print(f"[workload] {label:<22} load/save  {result['load']:>8.2f}s / {result['save']:.2f}s")
+        print(f"[workload] {label:<22} .sqg size  {result['sqg size'] / 2 ** 20:>10,.1f} MiB")
+        print(f"[workload] {label:<22} peak RSS   {result['peak rss'] / 2 ** 20:>10,.1f} MiB")
+        for node_type, latencies in sorted(result["latencies"].items()):
+            if len(latencies) < 2:
+                continue
+            percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+            p50, p95, p99 = (percentiles[i] * 1000 for i in (49, 94, 98))
+            print(
+                f"[workload] {label:<22} undo {node_type:<16} "
+                f"p50 {p50:.3f}ms p95 {p95:.3f}ms p99 {p99:.3f}ms ({len(latencies)} samples)"
+            )
+
+
+def bench_parallel(num_statements: int=1_000_000, workers: tuple[int]=(0, 2, 4), seed: int=0) -> None:
+    """Compare ingestion with parsing in the main process and in worker processes"""
+    with tempfile.TemporaryDirectory() as base_dir:
+        ssqlite.config.BASE_DIR = base_dir
+        write_script(base_dir, "parallel.sql", Workload(seed=seed).generate(num_statements))
+        for num_workers in workers:
+            conn = sqlite3.connect(":memory:")
+            start = time.perf_counter()
+            build_sqg_from_sql(
+                conn.cursor(), "parallel.sql", "parallel.sqg", batch_size=10000, workers=num_workers
+            )
+            elapsed = time.perf_counter() - start
+            conn.close()
+            print(f"[parallel] {num_workers} workers {num_statements / elapsed:>12,.0f} statements/sec")
+
+
+def parse_size(size: str) -> int:
+    """Parse statement count such as 10000, 10k or 1M"""
+    multipliers = {"k": 10 ** 3, "m": 10 ** 6}
+    if size[-1].lower() in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1].lower()])
+    return int(size)
+
+
+BENCHMARKS = {
+    "returning": bench_returning,
+    "index": bench_index,
+    "parse": bench_parse,
+    "executemany": bench_executemany,
+    "workload": bench_workload,
+    "parallel": bench_parallel,
+}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run ssqlite benchmarks")
+    parser.add_argument(
+        "benchmarks", nargs="*", metavar="benchmark",
+        help=f"benchmarks to run, out of {', '.join(BENCHMARKS)} (default: all)"
+    )
+    parser.add_argument(
+        "--sizes", nargs="+", type=parse_size, default=WORKLOAD_SIZES,
+        help="statement counts of the workload benchmark, e.g. 10k 1M (default: 10k 1M 10M)"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the workload generator")
+    args = parser.parse_args()
+    # argparse checks choices of an empty nargs="*" positional against [] itself
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"invalid benchmark: {name} (choose from {', '.join(BENCHMARKS)})")
+
+    for name in args.benchmarks or BENCHMARKS:
+        if name == "workload":
+            bench_workload(sizes=tuple(args.sizes), seed=args.seed)
+        else:
+            BENCHMARKS[name]()
@@ -0,0 +1,11 @@
+PRAGMA foreign_keys=OFF;
+BEGIN TRANSACTION;
+CREATE TABLE X (
+  id INTEGER PRIMARY KEY,
+  name VARCHAR(255)
+);
+INSERT INTO X VALUES(1,'Alice'); INSERT INTO X VALUES(2,'Bob');
+INSERT INTO X VALUES(3,'Charles;
+Chaplin');
+UPDATE X SET name='Carl' WHERE id=3; -- target
+COMMIT;
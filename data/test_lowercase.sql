@@ -0,0 +1,5 @@
+create table x (id integer primary key, name varchar(255));
+insert into x(id, name) values(1, 'Alice');
+insert into x(id, name) values(2, 'Bob');
+update x set name='Zed'; -- target
+delete from x where id > 1;
\ No newline at end of file
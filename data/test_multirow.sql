@@ -0,0 +1,10 @@
+CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255), team VARCHAR(255));
+INSERT INTO X(id, name, team) VALUES(1, 'Alice', 'red');
+INSERT INTO X(id, name, team) VALUES(2, 'Bob', 'red');
+INSERT INTO X(id, name, team) VALUES(3, 'Charles', 'blue');
+INSERT INTO X(id, name, team) VALUES(4, 'David', 'blue');
+INSERT INTO X(id, name, team) VALUES(5, 'Eve', 'red');
+UPDATE X SET name='Aaron' WHERE id=1;
+UPDATE X SET name='Someone' WHERE team='red'; -- target
+UPDATE X SET name='Carl' WHERE id=3;
+DELETE FROM X WHERE team='blue'; -- target
\ No newline at end of file
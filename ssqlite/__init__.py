@@ -1,11 +1,20 @@
 import sqlite3
 
 from ssqlite.algo import build_sqg_from_sql
+from ssqlite.connection import SSqliteConnection, connect
 
 
-def executescript(db_name: str, sql_filename: str, sqg_filename: str):
+def executescript(
+        db_name: str, sql_filename: str, sqg_filename: str | None,
+        batch_size: int=0, journal: bool=False, binary: bool=False, workers: int=0,
+        capture_old_values: bool=False
+    ):
 
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
 
-    build_sqg_from_sql(cursor, sql_filename, sqg_filename)
+    build_sqg_from_sql(
+        cursor, sql_filename, sqg_filename,
+        batch_size=batch_size, journal=journal, binary=binary, workers=workers,
+        capture_old_values=capture_old_values
+    )
@@ -0,0 +1,206 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+
+from concurrent.futures import Future
+from typing import Any, Iterable, Mapping, Sequence
+
+from ssqlite.algo import SSqliteQueryGraph
+from ssqlite.connection import SSqliteConnection
+from ssqlite.recovery import generate_undo_query
+
+
+# Maximum number of queued statements executed in a single transaction
+MAX_BATCH_SIZE = 256
+
+# Kinds of requests served by the connection thread
+EXECUTE, CALL, CLOSE = range(3)
+
+
+def set_future(future: asyncio.Future, result: Any, exception: BaseException | None) -> None:
+    """Resolve future, unless its awaiting coroutine was cancelled meanwhile"""
+    if future.cancelled():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class AsyncSSqlite(object):
+    """asyncio facade of SSqliteConnection, which runs it on a dedicated thread
+
+    Statements which queued up while the thread was busy share a single transaction.
+    """
+
+    def __init__(
+            self, database: str, sqg_filename: str | None="ssqlite.sqg", journal: bool=False,
+            capture: str="parse", max_batch_size: int=MAX_BATCH_SIZE, **kwargs
+        ):
+        self.max_batch_size = max_batch_size
+        self.connection: SSqliteConnection = None
+        self.closed = False
+
+        self.requests = queue.SimpleQueue()
+        self.opened = Future()
+        self.thread = threading.Thread(
+            target=self._run, args=(database, sqg_filename, journal, capture, kwargs),
+            name="ssqlite", daemon=True
+        )
+        self.thread.start()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    @property
+    def last_order(self) -> int:
+        """Query order of the most recently recorded statement"""
+        return self.connection.last_order
+
+    async def execute(self, sql: str, parameters: Sequence | Mapping=()) -> list[tuple]:
+        """Execute a statement and record it, returning the rows it fetched once it's committed"""
+        return await self._submit(EXECUTE, (sql, parameters, False))
+
+    async def executemany(self, sql: str, seq_of_parameters: Iterable[Sequence | Mapping]) -> list[tuple]:
+        """Execute a statement for each set of parameters and record every execution"""
+        return await self._submit(EXECUTE, (sql, list(seq_of_parameters), True))
+
+    async def undo(self, query_orders: int | Iterable[int]) -> None:
+        """Undo given query order, or a contiguous range of them, and record the undo"""
+        if not isinstance(query_orders, int):
+            query_orders = list(query_orders)
+        await self._submit(CALL, lambda: self.connection.undo(query_orders))
+
+    async def generate_undo_query(self, query_order: int, coalesce: bool=False) -> list[str]:
+        """Generate undo query set of given query order from the graph of the connection"""
+        return await self._submit(
+            CALL, lambda: generate_undo_query(self.connection.graph, query_order=query_order, coalesce=coalesce)
+        )
+
+    async def save(self) -> None:
+        """Write the graph down, as close() would, while keeping the connection open"""
+        await self._submit(CALL, self._save)
+
+    async def close(self) -> None:
+        """Close the connection and save the graph once every queued request is served"""
+        if self.closed:
+            return
+        future = self._enqueue(CLOSE, None)
+        self.closed = True
+        await future
+
+    def _enqueue(self, kind: int, payload: Any) -> asyncio.Future:
+        if self.closed:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        future = asyncio.get_running_loop().create_future()
+        self.requests.put((kind, payload, future))
+        return future
+
+    async def _submit(self, kind: int, payload: Any) -> Any:
+        # Connection is opened on its thread, which may take a while for a large graph
+        await asyncio.wrap_future(self.opened)
+        return await self._enqueue(kind, payload)
+
+    def _resolve(self, future: asyncio.Future, result: Any=None, exception: BaseException | None=None) -> None:
+        try:
+            future.get_loop().call_soon_threadsafe(set_future, future, result, exception)
+        except RuntimeError:
+            # Event loop of the request was closed meanwhile
+            pass
+
+    def _save(self) -> None:
+        # Journal is synced at every commit, and the in-database graph is committed with the rows
+        self.connection.commit()
+        if not self.connection.journal and self.connection.sqg_filename is not None:
+            SSqliteQueryGraph.save_to_file(graph=self.connection.graph, sqg_filename=self.connection.sqg_filename)
+
+    def _run(self, database: str, sqg_filename: str | None, journal: bool, capture: str, kwargs: dict) -> None:
+        """Serve requests on the connection thread until closed"""
+        try:
+            self.connection = SSqliteConnection(
+                database, sqg_filename=sqg_filename, journal=journal, capture=capture, **kwargs
+            )
+        except BaseException as e:
+            self.closed = True
+            self.opened.set_exception(e)
+            return
+        self.opened.set_result(None)
+
+        request = None
+        while True:
+            if request is None:
+                request = self.requests.get()
+            kind, payload, future = request
+            request = None
+
+            if kind == CALL:
+                try:
+                    self._resolve(future, payload())
+                except Exception as e:
+                    self._resolve(future, exception=e)
+                continue
+            if kind == CLOSE:
+                try:
+                    self.connection.close()
+                    self._resolve(future)
+                except Exception as e:
+                    self._resolve(future, exception=e)
+                return
+
+            # 1. Take every statement queued behind this one, up to the first other request
+            batch = [(payload, future)]
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request[0] != EXECUTE:
+                    break
+                batch.append(request[1:])
+                request = None
+            self._execute_batch(batch)
+
+    def _execute_batch(self, batch: list[tuple]) -> None:
+        """Execute statements in a single transaction and resolve them once it's committed"""
+        # 1. Failing statement only fails its own request, like it would on its own
+        results = []
+        for (sql, parameters, many), future in batch:
+            try:
+                if many:
+                    cursor = self.connection.executemany(sql, parameters)
+                else:
+                    cursor = self.connection.execute(sql, parameters)
+                results.append((future, cursor.fetchall(), None))
+            except Exception as e:
+                results.append((future, None, e))
+                # Unless SQLite rolled back the whole transaction, and the statements before it with it
+                if not self.connection.in_transaction and self.connection.pending_nodes:
+                    self.connection.rollback()
+                    results = [(future, None, e) for future, _, _ in results]
+
+        # 2. Commit once for the whole batch
+        try:
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            results = [(future, None, e) for future, _, _ in results]
+        for future, result, exception in results:
+            self._resolve(future, result, exception)
+
+
+async def connect(
+        database: str, sqg_filename: str | None="ssqlite.sqg", journal: bool=False,
+        capture: str="parse", max_batch_size: int=MAX_BATCH_SIZE, **kwargs
+    ) -> AsyncSSqlite:
+    """Open a recording connection served by its own thread, like ssqlite.connect"""
+    db = AsyncSSqlite(
+        database, sqg_filename=sqg_filename, journal=journal, capture=capture,
+        max_batch_size=max_batch_size, **kwargs
+    )
+    await asyncio.wrap_future(db.opened)
+    return db
@@ -1,21 +1,134 @@
+import os
 import pickle
 import sqlite3
 import ssqlite.config
+import ssqlite.metrics
+import time
 
+from array import array
+from bisect import bisect_right
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, islice
 from pathlib import Path
+from typing import Iterable, Iterator, Mapping
 
-from ssqlite.index import Index
+from ssqlite.index import Index, NodeNotFound
+from ssqlite.journal import SQGJournal
+from ssqlite.mapped import MappedQueryGraph
+from ssqlite.store import SQLiteQueryGraph
 from ssqlite.utils import NodeType, InvalidInstructionError
-from ssqlite.utils import parse_query_string
+from ssqlite.utils import ParsedQuery, bind_parameters, parse_insert_columns, parse_query_string
+from ssqlite.utils import find_returning, gc_paused, parse_queries, parse_transaction_control, parse_update_literal
+from ssqlite.utils import read_queries, strip_query
 from ssqlite.node import SSqliteNode, CreateNode, InsertNode, UpdateNode, DropNode, DeleteNode
+from ssqlite.node import MultiUpdateNode, MultiDeleteNode, InvalidOperation
+
+
+# Seconds between two entries of the timeline of a SQG
+TIMELINE_RESOLUTION = 1.0
+
+# Number of statements parsed by a worker process at once
+PARSE_CHUNK_SIZE = 4096
+
+
+def get_sqg_filepath(sqg_filename: str) -> Path:
+    """Helper function for locating .sqg file"""
+    return Path(ssqlite.config.BASE_DIR) / sqg_filename
+
+
+def get_journal_filepath(sqg_filename: str) -> Path:
+    """Helper function for locating the journal which belongs to .sqg file"""
+    return Path(ssqlite.config.BASE_DIR) / f"{sqg_filename}-journal"
 
 
 class SSqliteQueryGraph(object):
     
     def __init__(self):
         self.index: Index = Index()
+        self.journal: SQGJournal = None
+        # UndoCache attached to the graph, which is told about every added node
+        self.undo_cache = None
+        # (time, query order) of the first node added in every TIMELINE_RESOLUTION seconds
+        self.timeline: list[tuple[float, int]] = []
+
+    def __getstate__(self):
+        # Open journal and cached undo query sets are never a part of the snapshot
+        state = self.__dict__.copy()
+        state["journal"] = None
+        state["undo_cache"] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault("journal", None)
+        state.setdefault("undo_cache", None)
+        state.setdefault("timeline", [])
+        self.__dict__.update(state)
+
+    @property
+    def last_order(self) -> int:
+        """Query order of the most recently added node"""
+        # Nodes up to the horizon may all have been pruned
+        return max(max(self.index.order_index, default=0), self.index.horizon - 1)
+
+    def stamp(self, query_order: int, timestamp: float | None=None) -> None:
+        """Record the time at which node of given query order was added to the timeline"""
+        timestamp = time.time() if timestamp is None else timestamp
+        if not self.timeline or timestamp - self.timeline[-1][0] >= TIMELINE_RESOLUTION:
+            self.timeline.append((timestamp, query_order))
+
+    def find_order_since(self, timestamp: float) -> int:
+        """Find the first query order which may have been added at or after given time"""
+        idx = bisect_right(self.timeline, timestamp, key=lambda entry: entry[0])
+        if idx == 0:
+            return 0
+        # Nodes of the same entry were added within TIMELINE_RESOLUTION seconds, so all are kept
+        return self.timeline[idx - 1][1]
 
     def add_node(self, node: SSqliteNode):
+        self._link_node(node)
+        self.stamp(node.query_order)
+        if self.undo_cache is not None:
+            self.undo_cache.invalidate(node)
+        if self.journal is not None:
+            self.journal.append(node)
+
+    def add_insert_nodes(self, insert_nodes: list[InsertNode]):
+        """Add InsertNodes of a single table at once, e.g. the rows of an executemany"""
+        if not insert_nodes:
+            return
+        # 1. Find their corresponding CreateNode from the index, only once
+        parent_create_node = self.index.find(
+            _from="create",
+            _key=insert_nodes[0].target_table
+        )
+        with gc_paused():
+            # 2. Set the CreateNode as their parent and add them as its children
+            for insert_node in insert_nodes:
+                insert_node.parent = parent_create_node
+            parent_create_node.children.extend(insert_nodes)
+            # 3. Add insert nodes to index
+            self.index.add_inserts(insert_nodes)
+        self.stamp(insert_nodes[0].query_order)
+        if self.undo_cache is not None:
+            for insert_node in insert_nodes:
+                self.undo_cache.invalidate(insert_node)
+        if self.journal is not None:
+            for insert_node in insert_nodes:
+                self.journal.append(insert_node)
+
+    def open_journal(self, sqg_filename: str="ssqlite.sqg") -> None:
+        """Append every node added from now on to the journal of .sqg file"""
+        self.journal = SQGJournal(get_journal_filepath(sqg_filename))
+
+    def close_journal(self) -> None:
+        """Sync and detach the journal"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def _link_node(self, node: SSqliteNode):
+        """Link node to its parent and add it to the index"""
         if isinstance(node, CreateNode):
             # Add create node to index
             self.index.add(node)
@@ -31,18 +144,28 @@ class SSqliteQueryGraph(object):
             parent_create_node.add_child(node)
             # 4. Add insert node to index
             self.index.add(node)
+        elif isinstance(node, MultiUpdateNode):
+            # 1. Find the InsertNode or UpdateNode of every affected row from the index
+            parent_nodes = []
+            for primary_key in node.primary_keys:
+                corr_insert_node = self.index.find(
+                    _from="insert",
+                    _key=(node.target_table, primary_key)
+                )
+                last_update_node = self.index.find_current_update(corr_insert_node, node.target_column)
+                parent_nodes.append(last_update_node or corr_insert_node)
+            # 2. Add child to every InsertNode or UpdateNode
+            for parent_node in parent_nodes:
+                parent_node.add_child(node)
+            # 3. Add update node to index
+            self.index.add(node)
         elif isinstance(node, UpdateNode):
             # 1. Find its corresponding InsertNode or UpdateNode from the index
             corr_insert_node = self.index.find(
                 _from="insert",
-                _key=f"{node.target_table}-{node.primary_key}"
+                _key=(node.target_table, node.primary_key)
             )
-            last_update_node = self.index.find_last_update(
-                table_name=node.target_table,
-                primary_key=node.primary_key,
-                column_name=node.target_column
-            )
-            parent_node = corr_insert_node if last_update_node is None else last_update_node
+            parent_node = self.index.find_current_update(corr_insert_node, node.target_column) or corr_insert_node
             # 2. Set the InsertNode or UpdateNode as its parent
             node.set_parent(parent_node)
             # 3. Add child to InsertNode or UpdateNode
@@ -60,9 +183,21 @@ class SSqliteQueryGraph(object):
             parent_create_node.add_child(node)
             # 5. Add drop node to index
             self.index.add(node)
+        elif isinstance(node, MultiDeleteNode):
+            # 1. Find the InsertNode of every deleted row from the index
+            parent_insert_nodes = [
+                self.index.find(_from="insert", _key=(node.target_table, primary_key))
+                for primary_key in node.primary_keys
+            ]
+            # 2. Set flag_delete=True and add child to every InsertNode
+            for parent_insert_node in parent_insert_nodes:
+                parent_insert_node.set_delete_flag()
+                parent_insert_node.add_child(node)
+            # 3. Add delete node to index
+            self.index.add(node)
         elif isinstance(node, DeleteNode):
             # 1. Find it corresponding InsertNode from the index(using table name and primary key)
-            parent_insert_node = self.index.find(_from="insert", _key=f"{node.target_table}-{node.primary_key}")
+            parent_insert_node = self.index.find(_from="insert", _key=(node.target_table, node.primary_key))
             # 2. Set the InsertNode as its parent
             node.set_parent(parent_insert_node)
             # 3. Set flag_delete=True in parent InsertNode
@@ -74,90 +209,609 @@ class SSqliteQueryGraph(object):
 
     @classmethod
     def load_from_file(cls, sqg_filename: str="ssqlite.sqg"):
-        """Load SQG from pickled file"""
-        sqg_filepath = Path(ssqlite.config.BASE_DIR) / sqg_filename
-        with open(sqg_filepath, "rb") as f:
-            graph = pickle.load(f)
+        """Load SQG from pickled file, then replay its journal if there is one"""
+        sqg_filepath = get_sqg_filepath(sqg_filename)
+        journal_filepath = get_journal_filepath(sqg_filename)
+        metrics = ssqlite.metrics.active
+        if metrics is not None:
+            start = time.perf_counter()
+        if not sqg_filepath.exists() and journal_filepath.exists():
+            graph = cls()
+        else:
+            with open(sqg_filepath, "rb") as f:
+                graph = pickle.load(f)
+
+        if journal_filepath.exists():
+            first_order = None
+            for node in SQGJournal.replay(journal_filepath):
+                # Nodes may already be in the snapshot if compaction was interrupted
+                if node.query_order not in graph.index.order_index and node.query_order >= graph.index.horizon:
+                    graph._link_node(node)
+                    first_order = first_order or node.query_order
+            # Journal doesn't keep the time of its nodes, so they are all as new as its last write
+            if first_order is not None:
+                graph.stamp(first_order, timestamp=journal_filepath.stat().st_mtime)
+        if metrics is not None:
+            metrics.record("load", time.perf_counter() - start)
         return graph
 
     @classmethod
     def save_to_file(cls, graph, sqg_filename: str="ssqlite.sqg") -> None:
         """Save SQG object using pickle"""
-        sqg_filepath = Path(ssqlite.config.BASE_DIR) / sqg_filename
+        sqg_filepath = get_sqg_filepath(sqg_filename)
+        metrics = ssqlite.metrics.active
+        if metrics is not None:
+            start = time.perf_counter()
         with open(sqg_filepath, "wb") as f:
             pickle.dump(graph, f, pickle.HIGHEST_PROTOCOL)
+        if metrics is not None:
+            metrics.record("save", time.perf_counter() - start)
 
+    @classmethod
+    def compact(
+            cls, sqg_filename: str="ssqlite.sqg", keep_last: int | None=None,
+            keep_since: float | None=None, collapse_updates: bool=False
+        ) -> None:
+        """Fold the journal of .sqg file into its snapshot, pruning the history as in prune()"""
+        journal_filepath = get_journal_filepath(sqg_filename)
+        retains = keep_last is not None or keep_since is not None or collapse_updates
+        if not journal_filepath.exists() and not retains:
+            return
+        graph = cls.load_from_file(sqg_filename)
+        if retains:
+            graph.prune(keep_last=keep_last, keep_since=keep_since, collapse_updates=collapse_updates)
+        # Write the new snapshot aside first, so a crash never leaves a partial one
+        tmp_filename = f"{sqg_filename}-tmp"
+        cls.save_to_file(graph, tmp_filename)
+        os.replace(get_sqg_filepath(tmp_filename), get_sqg_filepath(sqg_filename))
+        journal_filepath.unlink(missing_ok=True)
 
-def build_sqg_from_sql(cursor: sqlite3.Cursor, sql_filename: str, sqg_filename: str) -> None:
-    """ Builds .sqg(ssqlite query graph) file from .sql file"""
-    sqg = SSqliteQueryGraph()
+    def prune(
+            self, keep_last: int | None=None, keep_since: float | None=None, collapse_updates: bool=False
+        ) -> int:
+        """Drop the history which the retained query orders don't need, and return the number of dropped nodes
 
-    sql_filepath = Path(ssqlite.config.BASE_DIR) / "data" / sql_filename
-    with open(sql_filepath, "r") as f:
-        queries = f.readlines()
-    
-    for idx, query in enumerate(queries):
-        try:
-            parsed_query = parse_query_string(query)
-            # Explode
-            inst = parsed_query["inst"]
-            table_name = parsed_query["table_name"]
-            column_name = parsed_query["column_name"]
-            condition = parsed_query["condition"]
-        except InvalidInstructionError:
-            continue
-        
-        if inst == NodeType.CREATE.name:
-            cursor.execute(query)
-            node = CreateNode(
-                query_order=idx + 1,
-                query_string=query.strip(),
-                target_table=table_name
-            )
-        elif inst == NodeType.INSERT.name:
-            cursor.execute(query)
-            insert_pk = cursor.lastrowid
-            node = InsertNode(
-                query_order=idx + 1,
-                query_string=query.strip(),
-                primary_key=insert_pk,
-                target_table=table_name
+        Query orders from the horizon on, i.e. the last keep_last ones or the ones added since
+        keep_since, can still be undone, and collapse_updates only collapses the older updates.
+        """
+        if self.journal is not None:
+            raise InvalidOperation("SQG with an open journal can't be pruned, compact its file instead")
+        horizon = self.index.horizon
+        if keep_last is not None:
+            horizon = max(horizon, self.last_order - keep_last + 1)
+        if keep_since is not None:
+            horizon = max(horizon, self.find_order_since(keep_since))
+        nodes = [self.index.order_index[query_order] for query_order in sorted(self.index.order_index)]
+
+        # 1. Replay the graph, following the live tables and rows up to the horizon and the
+        # rows each update is still the last update of
+        live_tables, live_rows = {}, defaultdict(dict)
+        last_updates = defaultdict(dict)
+        current_rows = defaultdict(set)
+        prev_updates = defaultdict(list)
+        kept_orders, carried_rows = None, {}
+        for node in nodes:
+            if kept_orders is None and node.query_order >= horizon:
+                kept_orders = self._find_live_orders(live_tables, live_rows)
+                carried_rows = {query_order: set(rows) for query_order, rows in current_rows.items() if rows}
+            before_horizon = kept_orders is None
+
+            if isinstance(node, UpdateNode):
+                primary_keys = node.primary_keys if isinstance(node, MultiUpdateNode) else [node.primary_key]
+                for primary_key in primary_keys:
+                    row_updates = last_updates[(node.target_table, primary_key)]
+                    prev_update = row_updates.get(node.target_column)
+                    if prev_update is not None:
+                        current_rows[prev_update.query_order].discard(primary_key)
+                    row_updates[node.target_column] = node
+                    current_rows[node.query_order].add(primary_key)
+                    if not before_horizon:
+                        prev_updates[node.query_order].append(prev_update)
+            elif isinstance(node, CreateNode):
+                live_tables[node.target_table] = node
+            elif isinstance(node, InsertNode):
+                if before_horizon:
+                    self._end_row(last_updates, current_rows, node.target_table, node.primary_key)
+                live_rows[node.target_table][node.primary_key] = node
+                # Last updates of an earlier row with the same rowid stay with that row
+                last_updates[(node.target_table, node.primary_key)] = {}
+            elif before_horizon and isinstance(node, DropNode):
+                live_tables.pop(node.target_table, None)
+                for primary_key in live_rows.pop(node.target_table, {}):
+                    self._end_row(last_updates, current_rows, node.target_table, primary_key)
+            elif before_horizon and isinstance(node, (DeleteNode, MultiDeleteNode)):
+                primary_keys = node.primary_keys if isinstance(node, MultiDeleteNode) else [node.primary_key]
+                for primary_key in primary_keys:
+                    live_rows[node.target_table].pop(primary_key, None)
+                    self._end_row(last_updates, current_rows, node.target_table, primary_key)
+        if kept_orders is None:
+            kept_orders = self._find_live_orders(live_tables, live_rows)
+            carried_rows = {query_order: set(rows) for query_order, rows in current_rows.items() if rows}
+
+        # 2. Keep every node from the horizon on, and the last updates of the rows live at the horizon
+        for node in nodes:
+            if node.query_order >= horizon:
+                kept_orders.add(node.query_order)
+            elif not isinstance(node, UpdateNode):
+                continue
+            elif not collapse_updates:
+                if node.query_order in carried_rows:
+                    kept_orders.add(node.query_order)
+            elif current_rows[node.query_order]:
+                kept_orders.add(node.query_order)
+
+        # 3. Overwritten updates which a kept update is undone with are kept too, unless their
+        # value is a literal, which is taken over as the old value of the kept update
+        if collapse_updates:
+            for node in nodes:
+                if node.query_order not in prev_updates:
+                    continue
+                is_multi = isinstance(node, MultiUpdateNode)
+                missing = [
+                    prev_update for prev_update in prev_updates[node.query_order]
+                    if prev_update is not None and prev_update.query_order not in kept_orders
+                ]
+                if not missing or (node.old_values if is_multi else node.old_value) is not None:
+                    continue
+                literals = [
+                    None if prev_update is None else parse_update_literal(prev_update.query_string)
+                    for prev_update in prev_updates[node.query_order]
+                ]
+                if all(literal is not None for literal in literals):
+                    if is_multi:
+                        node.old_values = [value for _, value in literals]
+                    else:
+                        node.old_value = literals[0][1]
+                    continue
+                kept_orders.update(prev_update.query_order for prev_update in missing)
+
+        # 4. Link the kept nodes again from scratch
+        kept_nodes = [node for node in nodes if node.query_order in kept_orders]
+        self._relink(kept_nodes, carried_rows, horizon)
+        if self.undo_cache is not None:
+            self.undo_cache.clear()
+        return len(nodes) - len(kept_nodes)
+
+    @staticmethod
+    def _find_live_orders(live_tables: dict, live_rows: dict) -> set[int]:
+        """Query orders of the CREATEs and INSERTs of the live tables and rows"""
+        kept_orders = {create_node.query_order for create_node in live_tables.values()}
+        for table_name in live_tables:
+            kept_orders.update(insert_node.query_order for insert_node in live_rows[table_name].values())
+        return kept_orders
+
+    @staticmethod
+    def _end_row(last_updates: dict, current_rows: dict, table_name: str, primary_key: int) -> None:
+        """Forget the last updates of a row which is gone"""
+        for update_node in last_updates.pop((table_name, primary_key), {}).values():
+            current_rows[update_node.query_order].discard(primary_key)
+
+    def _relink(self, nodes: list[SSqliteNode], carried_rows: dict[int, set], horizon: int) -> None:
+        """Rebuild the index and the links of the graph from given nodes"""
+        for node in nodes:
+            node.parent = None
+            if isinstance(node, CreateNode):
+                node.children, node.flag_drop = [], False
+            elif isinstance(node, InsertNode):
+                node.children, node.flag_delete = (), False
+            elif isinstance(node, UpdateNode):
+                node.children = ()
+            # Updates older than the horizon only keep the rows they are the last update of
+            if isinstance(node, MultiUpdateNode) and node.query_order < horizon:
+                rows = carried_rows[node.query_order]
+                idxs = [idx for idx, primary_key in enumerate(node.primary_keys) if primary_key in rows]
+                if node.old_values is not None:
+                    node.old_values = [node.old_values[idx] for idx in idxs]
+                node.primary_keys = array("q", (node.primary_keys[idx] for idx in idxs))
+
+        self.index = Index()
+        self.index.horizon = horizon
+        with gc_paused():
+            for node in nodes:
+                self._link_node(node)
+        self.timeline = [entry for entry in self.timeline if entry[1] >= horizon]
+
+
+def add_nodes(graph, nodes: list[SSqliteNode]) -> None:
+    """Add nodes to the graph in order, consecutive inserts into the same table at once"""
+    metrics = ssqlite.metrics.active
+    if metrics is not None:
+        start = time.perf_counter()
+    for (is_insert, _), group in groupby(
+            nodes, key=lambda node: (type(node) is InsertNode, node.target_table)
+        ):
+        for group in [list(group)] if is_insert else ([node] for node in group):
+            try:
+                if is_insert:
+                    graph.add_insert_nodes(group)
+                else:
+                    graph.add_node(group[0])
+            except NodeNotFound:
+                # Table was created before the graph started recording
+                if metrics is not None:
+                    metrics.count("skipped", len(group))
+    if metrics is not None:
+        metrics.record("add_node", time.perf_counter() - start, count=len(nodes))
+
+
+def execute_returning_rowids(
+        cursor: sqlite3.Cursor, query: str, table_name: str, condition: str,
+        parameters: tuple | dict=()
+    ) -> array:
+    """Execute UPDATE/DELETE query and return the sorted primary keys of all affected rows"""
+    # Query which has RETURNING clause of its own keeps its rows for the caller, so it takes the preliminary query
+    if ssqlite.config.USE_RETURNING and find_returning(query) < 0:
+        # Capture primary keys with the actual query in a single step
+        cursor.execute(f"{strip_query(query)} RETURNING rowid", parameters)
+        rowids = array("q", sorted(row[0] for row in cursor.fetchall()))
+    else:
+        # Placeholders of the condition are numbered within the whole query
+        if parameters:
+            condition = parse_query_string(bind_parameters(query, parameters)).condition
+        # Add preliminary query to get primary keys
+        metrics = ssqlite.metrics.active
+        if metrics is not None:
+            start = time.perf_counter()
+        cursor.execute(f"SELECT rowid FROM {table_name} {condition} ORDER BY rowid")
+        rowids = array("q", (row[0] for row in cursor.fetchall()))
+        if metrics is not None:
+            metrics.record("select", time.perf_counter() - start)
+        # Execute actual query
+        cursor.execute(query, parameters)
+    return rowids
+
+
+def execute_returning_old_values(
+        cursor: sqlite3.Cursor, query: str, table_name: str, column_name: str,
+        condition: str, parameters: tuple | dict=()
+    ) -> tuple[array, list[str]]:
+    """Execute UPDATE query and return the sorted primary keys of all affected rows,
+    along with the old value of the updated column of each row as an SQL literal"""
+    # RETURNING only sees new values, so the preliminary query is needed either way
+    if parameters:
+        condition = parse_query_string(bind_parameters(query, parameters)).condition
+    metrics = ssqlite.metrics.active
+    if metrics is not None:
+        start = time.perf_counter()
+    cursor.execute(f"SELECT rowid, quote({column_name}) FROM {table_name} {condition} ORDER BY rowid")
+    rows = cursor.fetchall()
+    if metrics is not None:
+        metrics.record("select", time.perf_counter() - start)
+    cursor.execute(query, parameters)
+    return array("q", (row[0] for row in rows)), [row[1] for row in rows]
+
+
+def execute_parsed_query(
+        cursor: sqlite3.Cursor, query: str, parsed_query: ParsedQuery,
+        query_order: int, parameters: tuple | dict=(), capture_old_values: bool=False
+    ) -> SSqliteNode | None:
+    """Execute parsed query and build the (unlinked) node which records it"""
+    inst, table_name, column_name, condition = parsed_query
+    query_string = query.strip()
+
+    if inst == NodeType.CREATE.name:
+        cursor.execute(query, parameters)
+        node = CreateNode(
+            query_order=query_order,
+            query_string=query_string,
+            target_table=table_name,
+            parameters=parameters
+        )
+    elif inst == NodeType.INSERT.name:
+        cursor.execute(query, parameters)
+        insert_pk = cursor.lastrowid
+        node = InsertNode(
+            query_order=query_order,
+            query_string=query_string,
+            primary_key=insert_pk,
+            target_table=table_name,
+            parameters=parameters
+        )
+    elif inst == NodeType.UPDATE.name:
+        if capture_old_values:
+            update_pks, old_values = execute_returning_old_values(
+                cursor, query, table_name, column_name, condition, parameters
             )
-        elif inst == NodeType.UPDATE.name:
-            # Add preliminary query to get primary key
-            cursor.execute(f"SELECT rowid FROM {table_name} {condition}")
-            update_pk = cursor.fetchone()[0]
-            # Execute actual query
-            cursor.execute(query)
+        else:
+            update_pks = execute_returning_rowids(cursor, query, table_name, condition, parameters)
+            old_values = None
+        if len(update_pks) == 1:
             node = UpdateNode(
-                query_order=idx + 1,
-                query_string=query.strip(),
-                primary_key=update_pk,
+                query_order=query_order,
+                query_string=query_string,
+                primary_key=update_pks[0],
                 target_table=table_name,
-                target_column=column_name
+                target_column=column_name,
+                parameters=parameters,
+                old_value=old_values[0] if old_values else None
             )
-        elif inst == NodeType.DROP.name:
-            node = DropNode(
-                query_order=idx + 1,
-                query_string=query.strip(),
-                target_table=table_name
+        elif update_pks:
+            node = MultiUpdateNode(
+                query_order=query_order,
+                query_string=query_string,
+                primary_keys=update_pks,
+                target_table=table_name,
+                target_column=column_name,
+                parameters=parameters,
+                old_values=old_values
             )
-        elif inst == NodeType.DELETE.name:
-            # Add preliminary query to get primary key
-            cursor.execute(f"SELECT rowid FROM {table_name} {condition}")
-            delete_pk = cursor.fetchone()[0]
-            # Execute actual query
-            cursor.execute(query)
+        else:
+            node = None
+    elif inst == NodeType.DROP.name:
+        cursor.execute(query, parameters)
+        node = DropNode(
+            query_order=query_order,
+            query_string=query_string,
+            target_table=table_name,
+            parameters=parameters
+        )
+    elif inst == NodeType.DELETE.name:
+        delete_pks = execute_returning_rowids(cursor, query, table_name, condition, parameters)
+        if len(delete_pks) == 1:
             node = DeleteNode(
-                query_order=idx + 1,
-                query_string=query.strip(),
-                primary_key=delete_pk,
-                target_table=table_name
+                query_order=query_order,
+                query_string=query_string,
+                primary_key=delete_pks[0],
+                target_table=table_name,
+                parameters=parameters
             )
+        elif delete_pks:
+            node = MultiDeleteNode(
+                query_order=query_order,
+                query_string=query_string,
+                primary_keys=delete_pks,
+                target_table=table_name,
+                parameters=parameters
+            )
+        else:
+            node = None
+
+    return node
+
+
+def execute_query(
+        cursor: sqlite3.Cursor, query: str, query_order: int,
+        parameters: tuple | dict=(), capture_old_values: bool=False
+    ) -> SSqliteNode | None:
+    """Execute query and build the (unlinked) node which records it
+
+    Returns None for UPDATE/DELETE which matched no rows.
+    """
+    metrics = ssqlite.metrics.active
+    if metrics is None:
+        parsed_query = parse_query_string(query)
+        return execute_parsed_query(cursor, query, parsed_query, query_order, parameters, capture_old_values)
+
+    start = time.perf_counter()
+    parsed_query = parse_query_string(query)
+    parsed = time.perf_counter()
+    metrics.record("parse", parsed - start)
+    node = execute_parsed_query(cursor, query, parsed_query, query_order, parameters, capture_old_values)
+    metrics.record("execute", time.perf_counter() - parsed)
+    return node
+
+
+def get_rowid_alias(cursor: sqlite3.Cursor, table_name: str) -> str | None:
+    """Find the column of table which is an alias of rowid, if there is one"""
+    # The only column named INTEGER PRIMARY KEY is an alias of rowid
+    pk_columns = [
+        (name, col_type) for _, name, col_type, _, _, pk in cursor.execute(f"PRAGMA table_info({table_name})")
+        if pk
+    ]
+    if len(pk_columns) == 1 and pk_columns[0][1].upper() == "INTEGER":
+        return pk_columns[0][0].lower()
+    return None
+
+
+def has_explicit_rowid(cursor: sqlite3.Cursor, query: str, table_name: str) -> bool:
+    """Check whether INSERT query may give the rowid of its rows instead of letting SQLite assign it"""
+    rowid_alias = get_rowid_alias(cursor, table_name)
+    columns = parse_insert_columns(query)
+    if columns is None:
+        return rowid_alias is not None
+    return any(column.lower() in ("rowid", "oid", "_rowid_", rowid_alias) for column in columns)
+
+
+def execute_bulk_insert(
+        cursor: sqlite3.Cursor, query: str, table_name: str,
+        query_order: int, seq_of_parameters: list
+    ) -> list[InsertNode] | None:
+    """Execute INSERT query with executemany and build its nodes over the range of assigned rowids
+
+    Returns None, with nothing inserted, if the rowids turn out not to be contiguous.
+    """
+    conn = cursor.connection
+    num_rows = len(seq_of_parameters)
+    # Open the transaction sqlite3 would have opened, so that the savepoint doesn't commit
+    if conn.isolation_level is not None and not conn.in_transaction:
+        cursor.execute(f"BEGIN {conn.isolation_level}")
+    cursor.execute("SAVEPOINT ssqlite_bulk_insert")
+    try:
+        max_rowid = cursor.execute(f"SELECT max(rowid) FROM {table_name}").fetchone()[0] or 0
+        cursor.executemany(query, seq_of_parameters)
+        num_inserted = cursor.rowcount
+        last_rowid = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+        contiguous = num_inserted == num_rows and last_rowid == max_rowid + num_rows
+    except sqlite3.Error:
+        contiguous = False
+    # Rows which were not appended one after another are inserted again row by row
+    if not contiguous:
+        cursor.execute("ROLLBACK TO ssqlite_bulk_insert")
+    cursor.execute("RELEASE ssqlite_bulk_insert")
+    if not contiguous:
+        return None
+
+    return InsertNode.from_rowid_range(
+        query_order=query_order,
+        query_string=query,
+        target_table=table_name,
+        first_rowid=max_rowid + 1,
+        seq_of_parameters=seq_of_parameters
+    )
+
+
+def execute_many_query(
+        cursor: sqlite3.Cursor, query: str, query_order: int,
+        seq_of_parameters: Iterable[tuple | dict], capture_old_values: bool=False
+    ) -> Iterator[SSqliteNode]:
+    """Execute query once for each set of parameters and yield the nodes which record them"""
+    # Every node shares the same template
+    query = query.strip()
+    metrics = ssqlite.metrics.active
+    if metrics is not None:
+        start = time.perf_counter()
+    parsed_query = parse_query_string(query)
+    if metrics is not None:
+        metrics.record("parse", time.perf_counter() - start)
+    seq_of_parameters = [
+        parameters if type(parameters) is tuple or isinstance(parameters, Mapping) else tuple(parameters)
+        for parameters in seq_of_parameters
+    ]
+
+    if (
+        parsed_query.inst == NodeType.INSERT.name and len(seq_of_parameters) > 1
+        and not has_explicit_rowid(cursor, query, parsed_query.table_name)
+    ):
+        if metrics is not None:
+            start = time.perf_counter()
+        insert_nodes = execute_bulk_insert(
+            cursor, query, parsed_query.table_name, query_order, seq_of_parameters
+        )
+        if insert_nodes is not None:
+            if metrics is not None:
+                metrics.record("execute", time.perf_counter() - start, count=len(insert_nodes))
+            yield from insert_nodes
+            return
+
+    for parameters in seq_of_parameters:
+        if metrics is not None:
+            start = time.perf_counter()
+        node = execute_parsed_query(cursor, query, parsed_query, query_order, parameters, capture_old_values)
+        if metrics is not None:
+            metrics.record("execute", time.perf_counter() - start)
+        if node is not None:
+            query_order += 1
+            yield node
+
+
+def parse_queries_in_parallel(
+        queries: Iterable[str], workers: int, chunk_size: int=PARSE_CHUNK_SIZE
+    ) -> Iterator[tuple[str, ParsedQuery | None]]:
+    """Parse queries in worker processes and yield them in their original order, each along
+    with its ParsedQuery, or None if it isn't recorded by SQG"""
+    queries = iter(queries)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Keep a couple of chunks per worker in flight, so that the input is never read at once
+            while len(pending) < 2 * workers:
+                chunk = list(islice(queries, chunk_size))
+                if not chunk:
+                    break
+                pending.append((chunk, executor.submit(parse_queries, chunk)))
+            if not pending:
+                return
+            chunk, future = pending.popleft()
+            for query, parse_record in zip(chunk, future.result()):
+                yield query, None if parse_record is None else ParsedQuery._make(parse_record)
+
+
+def build_sqg_from_sql(
+        cursor: sqlite3.Cursor, sql_filename: str, sqg_filename: str | None,
+        batch_size: int=0, journal: bool=False, binary: bool=False, workers: int=0,
+        capture_old_values: bool=False
+    ) -> None:
+    """ Builds .sqg(ssqlite query graph) file from .sql file
+
+    BEGIN/COMMIT of the script itself are left out, and every batch_size statements
+    are committed together instead.
+    """
+    conn = cursor.connection
+    num_pending = 0
+    metrics = ssqlite.metrics.active
+
+    if sqg_filename is None:
+        sqg = SQLiteQueryGraph(conn)
+        journal = False
+    elif journal and (get_sqg_filepath(sqg_filename).exists() or get_journal_filepath(sqg_filename).exists()):
+        sqg = SSqliteQueryGraph.load_from_file(sqg_filename)
+    else:
+        sqg = SSqliteQueryGraph()
+    if journal:
+        sqg.open_journal(sqg_filename)
+    order_offset = sqg.last_order
+
+    sql_filepath = Path(ssqlite.config.BASE_DIR) / "data" / sql_filename
+    if workers:
+        parsed_queries = parse_queries_in_parallel(read_queries(sql_filepath), workers)
+    else:
+        parsed_queries = ((query, None) for query in read_queries(sql_filepath))
+    try:
+        for idx, (query, parsed_query) in enumerate(parsed_queries):
+            # Open a new transaction for the upcoming batch
+            if batch_size and not conn.in_transaction:
+                cursor.execute("BEGIN")
+                num_pending = 0
+
+            # Transactions of the script, e.g. of a .dump, give way to the ones of batch_size
+            control = parse_transaction_control(query)
+            if control is not None:
+                if control[0] in ("BEGIN", "COMMIT"):
+                    continue
+                # Nodes are linked as soon as their statement runs, so there's nothing to roll them back from
+                raise InvalidOperation(
+                    f"{control[0]} can't be built into SQG from a script, execute it through ssqlite.connect() instead"
+                )
+            try:
+                if not workers:
+                    node = execute_query(
+                        cursor, query, query_order=order_offset + idx + 1, capture_old_values=capture_old_values
+                    )
+                elif parsed_query is not None:
+                    node = execute_parsed_query(
+                        cursor, query, parsed_query, query_order=order_offset + idx + 1,
+                        capture_old_values=capture_old_values
+                    )
+                else:
+                    raise InvalidInstructionError(query)
+            except InvalidInstructionError:
+                # Statements which SQG doesn't record, e.g. CREATE INDEX, are executed as they are
+                cursor.execute(query)
+                continue
+
+            if metrics is not None:
+                start = time.perf_counter()
+            try:
+                # UPDATE/DELETE which matched no rows leaves nothing to record
+                if node is not None:
+                    sqg.add_node(node)
+            except Exception as e:
+                if metrics is not None:
+                    metrics.count("skipped")
+            if metrics is not None:
+                metrics.record("add_node", time.perf_counter() - start)
+
+            # Commit once the batch is full
+            num_pending += 1
+            if batch_size and num_pending >= batch_size:
+                conn.commit()
+                if journal:
+                    sqg.journal.commit()
 
-        try:
-            sqg.add_node(node)
-        except Exception as e:
-            pass
+        # Without batch_size, the whole script is committed once at the end
+        if conn.in_transaction:
+            conn.commit()
+        if journal:
+            sqg.journal.commit()
+    finally:
+        # Nodes of statements which weren't committed are dropped from the journal
+        if journal:
+            sqg.close_journal()
 
-    SSqliteQueryGraph.save_to_file(graph=sqg, sqg_filename=sqg_filename)
+    if not journal and sqg_filename is not None:
+        if binary:
+            MappedQueryGraph.save_to_file(graph=sqg, sqg_filename=sqg_filename)
+        else:
+            SSqliteQueryGraph.save_to_file(graph=sqg, sqg_filename=sqg_filename)
+        # A journal left from previous runs doesn't belong to the new graph
+        get_journal_filepath(sqg_filename).unlink(missing_ok=True)
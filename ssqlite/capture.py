@@ -0,0 +1,167 @@
+import sqlite3
+
+from ssqlite.algo import get_rowid_alias
+from ssqlite.node import SSqliteNode, CreateNode, InsertNode, UpdateNode, DropNode, DeleteNode
+from ssqlite.node import NODE_TYPE_CODES
+from ssqlite.utils import identifier_name, quote_identifier, render_literal
+
+
+CREATE_CODE = NODE_TYPE_CODES[CreateNode]
+INSERT_CODE = NODE_TYPE_CODES[InsertNode]
+UPDATE_CODE = NODE_TYPE_CODES[UpdateNode]
+DROP_CODE = NODE_TYPE_CODES[DropNode]
+DELETE_CODE = NODE_TYPE_CODES[DeleteNode]
+
+# Changes are kept in the temp database, so they are committed or rolled back with the
+# statements which made them, but never written to the database itself
+CHANGES_SCHEMA = """
+CREATE TEMP TABLE IF NOT EXISTS _ssqlite_changes (
+    seq INTEGER PRIMARY KEY,
+    node_type INTEGER NOT NULL,
+    target_table TEXT NOT NULL,
+    target_column TEXT NOT NULL DEFAULT '',
+    primary_key INTEGER,
+    query_string TEXT NOT NULL,
+    old_value TEXT
+)
+"""
+
+INSERT_CHANGE = """
+INSERT INTO _ssqlite_changes(node_type, target_table, query_string) VALUES (?, ?, ?)
+"""
+INSERT_CHANGE_ROW = """
+INSERT INTO _ssqlite_changes(node_type, target_table, target_column, primary_key, query_string, old_value)
+"""
+SELECT_CHANGES = """
+SELECT node_type, target_table, target_column, primary_key, query_string, old_value
+FROM _ssqlite_changes ORDER BY seq
+"""
+DELETE_CHANGES = "DELETE FROM _ssqlite_changes"
+
+SELECT_TABLES = """
+SELECT name FROM main.sqlite_master
+WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name NOT LIKE '_ssqlite_%'
+"""
+SELECT_MAIN_TABLE = "SELECT 1 FROM main.sqlite_master WHERE type='table' AND name=?"
+
+
+class TriggerCapture(object):
+    """Records row changes with temporary triggers instead of parsing statements
+
+    Changes are logged into _ssqlite_changes and turned into nodes by drain().
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        # Plain names of the temp tables which were created, which are never captured
+        self.temp_tables: set[str] = set()
+        self.conn.execute(CHANGES_SCHEMA)
+        self.install_all()
+
+    def install(self, name: str) -> None:
+        """(Re)install triggers which capture the changes of table, given by its plain name"""
+        table_name = quote_identifier(name)
+        columns = [column for _, column, _, _, _, _ in self.conn.execute(f"PRAGMA main.table_info({table_name})")]
+        rowid_alias = get_rowid_alias(self.conn.cursor(), table_name)
+        # Rowid is given explicitly, so that undo puts the row back at the same rowid
+        insert_columns = [quote_identifier(column) for column in columns]
+        if rowid_alias is None:
+            insert_columns.insert(0, "rowid")
+        insert_values = " || ', ' || ".join(f"quote(NEW.{column})" for column in insert_columns)
+        # Names are pasted into the logged statements as literals, so their quotes are escaped
+        table_literal = render_literal(table_name)
+        insert_change = f"""
+            {INSERT_CHANGE_ROW}
+            SELECT {INSERT_CODE}, {table_literal}, '', NEW.rowid,
+                {render_literal(f"INSERT INTO {table_name}({', '.join(insert_columns)}) VALUES(")}
+                || {insert_values} || ');', NULL"""
+        delete_change = f"""
+            {INSERT_CHANGE_ROW}
+            SELECT {DELETE_CODE}, {table_literal}, '', OLD.rowid,
+                {render_literal(f"DELETE FROM {table_name} WHERE rowid=")} || OLD.rowid || ';', NULL"""
+
+        # Row whose rowid changed is logged as deleted and inserted again under its new rowid
+        update_changes = f"""
+            {delete_change} WHERE OLD.rowid IS NOT NEW.rowid;
+            {insert_change} WHERE OLD.rowid IS NOT NEW.rowid;"""
+        for column in map(quote_identifier, columns):
+            update_changes += f"""
+            {INSERT_CHANGE_ROW}
+            SELECT {UPDATE_CODE}, {table_literal}, {render_literal(column)}, NEW.rowid,
+                {render_literal(f"UPDATE {table_name} SET {column}=")} || quote(NEW.{column})
+                || ' WHERE rowid=' || NEW.rowid || ';',
+                quote(OLD.{column})
+            WHERE OLD.{column} IS NOT NEW.{column} AND OLD.rowid IS NEW.rowid;"""
+        triggers = {
+            "insert": f"{insert_change};",
+            "update": update_changes,
+            "delete": f"{delete_change};",
+        }
+        for event, body in triggers.items():
+            trigger_name = quote_identifier(f"_ssqlite_{name}_{event}")
+            self.conn.execute(f"DROP TRIGGER IF EXISTS temp.{trigger_name}")
+            self.conn.execute(
+                f"CREATE TEMP TRIGGER {trigger_name} AFTER {event.upper()} ON main.{table_name} BEGIN {body} END"
+            )
+
+    def install_all(self) -> None:
+        """(Re)install triggers of every table of the database"""
+        for name, in self.conn.execute(SELECT_TABLES).fetchall():
+            self.install(name)
+
+    def record_create(self, table_name: str, query_string: str) -> None:
+        """Log CREATE TABLE which has just been executed, and start capturing the table"""
+        name = identifier_name(table_name)
+        # Temp tables are left out, like the changes of any other temp database
+        if self.conn.execute(SELECT_MAIN_TABLE, (name,)).fetchone() is None:
+            self.temp_tables.add(name)
+            return
+        self.conn.execute(INSERT_CHANGE, (CREATE_CODE, table_name, query_string))
+        self.install(name)
+
+    def record_drop(self, table_name: str, query_string: str) -> None:
+        """Log DROP TABLE which has just been executed, whose triggers were dropped along with the table"""
+        name = identifier_name(table_name)
+        if name in self.temp_tables:
+            self.temp_tables.discard(name)
+            return
+        self.conn.execute(INSERT_CHANGE, (DROP_CODE, table_name, query_string))
+
+    def drain(self, query_order: int) -> list[SSqliteNode]:
+        """Build the (unlinked) nodes of the logged changes and clear the log"""
+        nodes = []
+        for (
+                node_type, target_table, target_column, primary_key, query_string, old_value
+            ) in self.conn.execute(SELECT_CHANGES):
+            if node_type == CREATE_CODE:
+                node = CreateNode(
+                    query_order=query_order, query_string=query_string, target_table=target_table
+                )
+            elif node_type == INSERT_CODE:
+                node = InsertNode(
+                    query_order=query_order, query_string=query_string,
+                    primary_key=primary_key, target_table=target_table
+                )
+            elif node_type == UPDATE_CODE:
+                node = UpdateNode(
+                    query_order=query_order, query_string=query_string, primary_key=primary_key,
+                    target_table=target_table, target_column=target_column, old_value=old_value
+                )
+            elif node_type == DROP_CODE:
+                node = DropNode(
+                    query_order=query_order, query_string=query_string, target_table=target_table
+                )
+            elif node_type == DELETE_CODE:
+                node = DeleteNode(
+                    query_order=query_order, query_string=query_string,
+                    primary_key=primary_key, target_table=target_table
+                )
+            nodes.append(node)
+            query_order += 1
+
+        self.conn.execute(DELETE_CHANGES)
+        return nodes
+
+    def discard(self) -> None:
+        """Clear the log without building nodes, e.g. of changes which are recorded otherwise"""
+        self.conn.execute(DELETE_CHANGES)
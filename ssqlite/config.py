@@ -1 +1,6 @@
-BASE_DIR = "/Users/blueberry/workspace/ssqlite"
\ No newline at end of file
+import sqlite3
+
+BASE_DIR = "/Users/blueberry/workspace/ssqlite"
+
+# Capture rowids of UPDATE/DELETE with RETURNING instead of a preliminary SELECT
+USE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
@@ -0,0 +1,303 @@
+import re
+import sqlite3
+
+from typing import Iterable, Mapping, Sequence
+
+from ssqlite.algo import SSqliteQueryGraph, add_nodes, execute_many_query, execute_query
+from ssqlite.algo import get_journal_filepath, get_sqg_filepath
+from ssqlite.node import SSqliteNode
+from ssqlite.recovery import apply_undo
+from ssqlite.store import SQLiteQueryGraph
+from ssqlite.capture import TriggerCapture
+from ssqlite.utils import NodeType, InvalidInstructionError
+from ssqlite.utils import bind_parameters, parse_query_string, parse_transaction_control, split_statements
+
+
+DDL_PATTERN = re.compile(r"\s*(?P<inst>CREATE|DROP|ALTER)\b", flags=re.IGNORECASE)
+
+
+class SSqliteCursor(object):
+    """sqlite3.Cursor which records the statements it executes to the SQG of its connection"""
+
+    def __init__(self, connection: "SSqliteConnection", cursor: sqlite3.Cursor):
+        self.connection = connection
+        self.cursor = cursor
+
+    def __getattr__(self, name: str):
+        # fetchone(), lastrowid, rowcount, description, ... of the underlying cursor
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql: str, parameters: Sequence | Mapping=()) -> "SSqliteCursor":
+        """Execute a statement and record it"""
+        self.connection.execute_and_record(self.cursor, sql, parameters)
+        return self
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Sequence | Mapping]) -> "SSqliteCursor":
+        """Execute a statement once for each set of parameters and record every execution"""
+        self.connection.execute_many_and_record(self.cursor, sql, seq_of_parameters)
+        return self
+
+    def executescript(self, sql_script: str) -> "SSqliteCursor":
+        """Execute every statement of the script and record them, like sqlite3.Cursor.executescript"""
+        self.connection.commit()
+        for statement in split_statements(sql_script.splitlines(keepends=True)):
+            self.connection.execute_and_record(self.cursor, statement)
+        self.connection.commit()
+        return self
+
+
+class SSqliteConnection(object):
+    """sqlite3.Connection which records every statement executed through it to a SQG
+
+    Nodes of a transaction are linked to the graph when it is committed, so that a
+    rolled back statement never appears in the graph.
+    """
+
+    def __init__(
+            self, database: str, sqg_filename: str | None="ssqlite.sqg",
+            journal: bool=False, capture: str="parse", capture_old_values: bool=False, **kwargs
+        ):
+        self.conn = sqlite3.connect(database, **kwargs)
+        self.sqg_filename = sqg_filename
+        self.capture_old_values = capture_old_values
+
+        if sqg_filename is None:
+            self.graph = SQLiteQueryGraph(self.conn)
+            journal = False
+        elif get_sqg_filepath(sqg_filename).exists() or get_journal_filepath(sqg_filename).exists():
+            self.graph = SSqliteQueryGraph.load_from_file(sqg_filename)
+        else:
+            self.graph = SSqliteQueryGraph()
+        if journal:
+            self.graph.open_journal(sqg_filename)
+        self.journal = journal
+
+        self.last_order: int = self.graph.last_order
+        self.pending_nodes: list[SSqliteNode] = []
+        # (name, number of pending nodes) of every open savepoint, innermost last
+        self.savepoints: list[tuple[str, int]] = []
+
+        if capture not in ("parse", "triggers"):
+            raise ValueError(f"capture must be either 'parse' or 'triggers', not [{capture}]")
+        self.capture: TriggerCapture = TriggerCapture(self.conn) if capture == "triggers" else None
+
+    def __getattr__(self, name: str):
+        # in_transaction, total_changes, ... of the underlying connection
+        return getattr(self.conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Same as sqlite3.Connection, commit on success and roll back on error
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def cursor(self) -> SSqliteCursor:
+        """Create a recording cursor"""
+        return SSqliteCursor(self, self.conn.cursor())
+
+    def execute(self, sql: str, parameters: Sequence | Mapping=()) -> SSqliteCursor:
+        """Shortcut for cursor().execute()"""
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Sequence | Mapping]) -> SSqliteCursor:
+        """Shortcut for cursor().executemany()"""
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script: str) -> SSqliteCursor:
+        """Shortcut for cursor().executescript()"""
+        return self.cursor().executescript(sql_script)
+
+    def execute_and_record(
+            self, cursor: sqlite3.Cursor, sql: str, parameters: Sequence | Mapping=()
+        ) -> None:
+        """Execute a statement with given cursor and record its node"""
+        control = parse_transaction_control(sql)
+        if control is not None:
+            self.execute_transaction_control(cursor, sql, *control)
+            return
+        if self.capture is not None:
+            self.execute_and_capture(cursor, sql, parameters)
+            return
+
+        try:
+            node = execute_query(
+                cursor, sql, query_order=self.last_order + 1, parameters=parameters,
+                capture_old_values=self.capture_old_values
+            )
+        except InvalidInstructionError:
+            # Statements which SQG doesn't record are executed as they are
+            cursor.execute(sql, parameters)
+        else:
+            if node is not None:
+                self.last_order += 1
+                self.pending_nodes.append(node)
+
+        # Statements executed outside of a transaction are already committed
+        if not self.conn.in_transaction:
+            self.commit()
+
+    def execute_transaction_control(
+            self, cursor: sqlite3.Cursor, sql: str, inst: str, savepoint: str | None
+        ) -> None:
+        """Execute BEGIN/COMMIT/ROLLBACK/SAVEPOINT/RELEASE, keeping pending nodes in step with it"""
+        if inst == "COMMIT":
+            self.commit()
+            return
+        if inst == "ROLLBACK":
+            self.rollback()
+            return
+
+        cursor.execute(sql)
+        if inst == "SAVEPOINT":
+            self.savepoints.append((savepoint, len(self.pending_nodes)))
+        elif inst in ("ROLLBACK TO", "RELEASE"):
+            names = [name for name, _ in self.savepoints]
+            if savepoint in names:
+                idx = len(names) - 1 - names[::-1].index(savepoint)
+                if inst == "ROLLBACK TO":
+                    # Savepoint itself stays open, while the ones within it are gone
+                    num_pending = self.savepoints[idx][1]
+                    self.last_order -= len(self.pending_nodes) - num_pending
+                    del self.pending_nodes[num_pending:]
+                    del self.savepoints[idx + 1:]
+                else:
+                    del self.savepoints[idx:]
+
+        # Releasing the savepoint which opened the transaction commits it
+        if not self.conn.in_transaction:
+            self.commit()
+
+    def execute_many_and_record(
+            self, cursor: sqlite3.Cursor, sql: str, seq_of_parameters: Iterable[Sequence | Mapping]
+        ) -> None:
+        """Execute a statement for each set of parameters with given cursor and record their nodes"""
+        if self.capture is not None:
+            # Triggers log every row by themselves
+            cursor.executemany(sql, seq_of_parameters)
+            if not self.conn.in_transaction:
+                self.commit()
+            return
+
+        num_pending = len(self.pending_nodes)
+        try:
+            # Nodes of the rows executed before an error are kept, like the rows themselves
+            self.pending_nodes.extend(execute_many_query(
+                cursor, sql, self.last_order + 1, seq_of_parameters, self.capture_old_values
+            ))
+        except InvalidInstructionError:
+            cursor.executemany(sql, seq_of_parameters)
+        finally:
+            self.last_order += len(self.pending_nodes) - num_pending
+
+        if not self.conn.in_transaction:
+            self.commit()
+
+    def execute_and_capture(
+            self, cursor: sqlite3.Cursor, sql: str, parameters: Sequence | Mapping=()
+        ) -> None:
+        """Execute a statement with given cursor, whose changes are logged by triggers"""
+        cursor.execute(sql, parameters)
+        # Logging CREATE/DROP opens a transaction, although the statement itself is already committed
+        committed = not self.conn.in_transaction
+
+        # Only schema changes have to be told to the triggers
+        ddl_match = DDL_PATTERN.match(sql)
+        if ddl_match is not None:
+            inst = ddl_match.group("inst").upper()
+            if inst == "ALTER":
+                self.capture.install_all()
+            else:
+                try:
+                    table_name = parse_query_string(sql).table_name
+                except InvalidInstructionError:
+                    # CREATE INDEX, DROP VIEW, ...
+                    table_name = None
+                query_string = bind_parameters(sql, parameters).strip() if parameters else sql.strip()
+                if table_name is not None and inst == NodeType.CREATE.name:
+                    self.capture.record_create(table_name, query_string)
+                elif table_name is not None and inst == NodeType.DROP.name:
+                    self.capture.record_drop(table_name, query_string)
+
+        if committed:
+            self.commit()
+
+    def link_pending_nodes(self) -> None:
+        """Add nodes of the committed statements to the graph"""
+        # Consecutive inserts into the same table, e.g. of an executemany, are added at once
+        add_nodes(self.graph, self.pending_nodes)
+        self.pending_nodes.clear()
+
+    def commit(self) -> None:
+        """Commit the transaction and add its nodes to the graph"""
+        if self.capture is not None:
+            nodes = self.capture.drain(query_order=self.last_order + 1)
+            self.last_order += len(nodes)
+            self.pending_nodes.extend(nodes)
+        # Nodes go first, so the in-database graph is written in the same transaction
+        self.link_pending_nodes()
+        self.savepoints.clear()
+        self.conn.commit()
+        # Nodes only count in the journal once their transaction is committed
+        if self.journal:
+            self.graph.journal.commit()
+
+    def rollback(self) -> None:
+        """Roll back the transaction and drop its nodes"""
+        self.conn.rollback()
+        if self.journal:
+            self.graph.journal.discard()
+        # Dropped nodes hold the latest query orders, which are given out again
+        self.last_order -= len(self.pending_nodes)
+        self.pending_nodes.clear()
+        self.savepoints.clear()
+
+    def undo(self, query_orders: int | Iterable[int]) -> None:
+        """Undo given query order, or a contiguous range of them, and record the undo to the graph"""
+        # Undo is planned from the graph, so the current transaction goes first
+        self.commit()
+        try:
+            nodes = apply_undo(self.conn, self.graph, query_orders, capture_old_values=self.capture_old_values)
+        except Exception:
+            # Undo was rolled back, so are the nodes it journaled
+            if self.journal:
+                self.graph.journal.discard()
+            raise
+        self.last_order += len(nodes)
+        if self.capture is not None:
+            # Undo is recorded from its statements, so the rows logged by the triggers are dropped,
+            # and tables it created again are captured from now on
+            self.capture.discard()
+            self.capture.install_all()
+            self.conn.commit()
+        if self.journal:
+            self.graph.journal.commit()
+
+    def close(self) -> None:
+        """Close the connection, discarding an uncommitted transaction, and save the graph"""
+        self.conn.close()
+        self.pending_nodes.clear()
+        if self.journal:
+            self.graph.close_journal()
+        elif self.sqg_filename is not None:
+            SSqliteQueryGraph.save_to_file(graph=self.graph, sqg_filename=self.sqg_filename)
+            # A journal left from previous runs is already folded into the saved graph
+            get_journal_filepath(self.sqg_filename).unlink(missing_ok=True)
+
+
+def connect(
+        database: str, sqg_filename: str | None="ssqlite.sqg",
+        journal: bool=False, capture: str="parse", capture_old_values: bool=False, **kwargs
+    ) -> SSqliteConnection:
+    """Open a connection which records every executed statement, like sqlite3.connect"""
+    return SSqliteConnection(
+        database, sqg_filename=sqg_filename, journal=journal, capture=capture,
+        capture_old_values=capture_old_values, **kwargs
+    )
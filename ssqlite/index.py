@@ -1,6 +1,8 @@
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 
 from ssqlite.node import SSqliteNode, CreateNode, InsertNode, UpdateNode, DropNode, DeleteNode
+from ssqlite.node import MultiUpdateNode, MultiDeleteNode
 
 
 class NodeNotFound(Exception):
@@ -12,35 +14,111 @@ class NodeNotFound(Exception):
         return self.msg
 
 
+MAX_ORDER = 2 ** 63 - 1
+
+INDEX_NAMES = {
+    node_type: f"{node_type}_index"
+    for node_type in ("create", "insert", "update", "drop", "delete")
+}
+
+
 class Index(object):
     
     def __init__(self):
+        # Tables are keyed by their (interned) name, rows by (table_name, primary_key)
+        # and updates by (table_name, primary_key, column_name) tuples
         self.order_index = {}
         self.create_index = {}
         self.insert_index = {}
         self.update_index = defaultdict(list)
         self.drop_index = {}
         self.delete_index = {}
-    
+        # Rows of every CREATE which were not deleted, keyed by query order of the CREATE
+        # and then by primary key, and the last update of each updated column of every row
+        self.live_index = {}
+        self.last_update_index = {}
+        # Earlier InsertNodes of every rowid which was given to another row afterwards
+        self.prev_insert_index = {}
+        # Nodes before this query order were pruned, and can't be undone anymore
+        self.horizon = 0
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Indexes saved by the baseline release key rows by "table-pk" strings and lack every
+        # index added since, so they're built again from the nodes
+        if "horizon" not in state:
+            nodes = [self.order_index[query_order] for query_order in sorted(self.order_index)]
+            self.__init__()
+            for node in nodes:
+                self.add(node)
+
+    def _track(self, node: SSqliteNode) -> None:
+        """Keep live rows and last updates up to date with node"""
+        if isinstance(node, CreateNode):
+            self.live_index[node.query_order] = {}
+        elif isinstance(node, MultiUpdateNode):
+            for primary_key in node.primary_keys:
+                self.last_update_index[(node.target_table, primary_key)][node.target_column] = node
+        elif isinstance(node, MultiDeleteNode):
+            live_rows = self.live_index[self.create_index[node.target_table].query_order]
+            for primary_key in node.primary_keys:
+                live_rows.pop(primary_key, None)
+        elif isinstance(node, InsertNode):
+            live_rows = self.live_index[self.create_index[node.target_table].query_order]
+            # Row inserted again with the same rowid comes last, like in the table itself
+            live_rows.pop(node.primary_key, None)
+            live_rows[node.primary_key] = node
+            self.last_update_index[(node.target_table, node.primary_key)] = {}
+        elif isinstance(node, UpdateNode):
+            self.last_update_index[(node.target_table, node.primary_key)][node.target_column] = node
+        elif isinstance(node, DeleteNode):
+            self.live_index[self.create_index[node.target_table].query_order].pop(node.primary_key, None)
+
+    def _replace_insert(self, insert_node: InsertNode) -> None:
+        """Keep the InsertNode of the row whose rowid insert node takes over"""
+        key = (insert_node.target_table, insert_node.primary_key)
+        prev_insert_node = self.insert_index.get(key)
+        if prev_insert_node is not None:
+            self.prev_insert_index.setdefault(key, []).append(prev_insert_node)
+
     def add(self, node: SSqliteNode) -> None:
         """Add node to index"""
         if isinstance(node, CreateNode):
             self.create_index[node.target_table] = node
+        elif isinstance(node, MultiUpdateNode):
+            for primary_key in node.primary_keys:
+                self.update_index[(node.target_table, primary_key, node.target_column)].append(node)
+        elif isinstance(node, MultiDeleteNode):
+            for primary_key in node.primary_keys:
+                self.delete_index[(node.target_table, primary_key)] = node
         elif isinstance(node, InsertNode):
-            self.insert_index[f"{node.target_table}-{node.primary_key}"] = node
+            self._replace_insert(node)
+            self.insert_index[(node.target_table, node.primary_key)] = node
         elif isinstance(node, UpdateNode):
-            self.update_index[f"{node.target_table}-{node.primary_key}-{node.target_column}"].append(node)
+            self.update_index[(node.target_table, node.primary_key, node.target_column)].append(node)
         elif isinstance(node, DropNode):
             self.drop_index[node.target_table] = node
         elif isinstance(node, DeleteNode):
-            self.delete_index[f"{node.target_table}-{node.primary_key}"] =  node
+            self.delete_index[(node.target_table, node.primary_key)] =  node
+        self._track(node)
         # Add another mapping for O(1) search at recovery
         self.order_index[node.query_order] = node
 
-    def find(self, _from: str, _key: str) -> SSqliteNode:
+    def add_inserts(self, insert_nodes: list[InsertNode]) -> None:
+        """Add InsertNodes to index at once"""
+        for insert_node in insert_nodes:
+            self._replace_insert(insert_node)
+        self.insert_index.update(
+            ((insert_node.target_table, insert_node.primary_key), insert_node) for insert_node in insert_nodes
+        )
+        self.order_index.update((insert_node.query_order, insert_node) for insert_node in insert_nodes)
+        for insert_node in insert_nodes:
+            self._track(insert_node)
+
+    def find(self, _from: str, _key: str | tuple) -> SSqliteNode:
         """Find specific node from index"""
         try:
-            node = getattr(self, f"{_from.lower()}_index")[_key]
+            node = getattr(self, INDEX_NAMES.get(_from) or f"{_from.lower()}_index")[_key]
         except Exception:
             raise NodeNotFound(f"{_from.lower()} node with key: [{_key}] doesn't exist")
         return node
@@ -48,14 +126,88 @@ class Index(object):
     def find_by_order(self, query_order: int) -> SSqliteNode:
         """Find specific node based on query order"""
         node = self.order_index.get(query_order, None)
-        if node is None:
+        if node is None or query_order < self.horizon:
             raise NodeNotFound(f"Node with query order [{query_order}] doesn't exist")
         return node
     
     def find_last_update(self, table_name: str, primary_key: str, column_name: str) -> UpdateNode:
         """Find last update node based on given _key"""
-        try:
-            last_update_node = self.update_index[f"{table_name}-{primary_key}-{column_name}"][-1]
-        except Exception:
+        # Avoid indexing the defaultdict, which would add an empty list for every miss
+        update_nodes = self.update_index.get((table_name, primary_key, column_name))
+        if not update_nodes:
+            return None
+        return update_nodes[-1]
+
+    def find_prev_update(
+            self, table_name: str, primary_key: str, column_name: str, query_order: int
+        ) -> UpdateNode:
+        """Find the update node that precedes given query order on the same column"""
+        update_nodes = self.update_index.get((table_name, primary_key, column_name), [])
+        idx = bisect_left(update_nodes, query_order, key=lambda update_node: update_node.query_order)
+        if idx == 0:
+            return None
+        return update_nodes[idx - 1]
+
+    def find_current_update(
+            self, insert_node: InsertNode, column_name: str, query_order: int | None=None
+        ) -> UpdateNode | None:
+        """Find the last update of the column of the row inserted by given insert node, before
+        given query order if there is one, which is None if the row still has its inserted value"""
+        if query_order is None:
+            update_node = self.find_last_update(insert_node.target_table, insert_node.primary_key, column_name)
+        else:
+            update_node = self.find_prev_update(
+                insert_node.target_table, insert_node.primary_key, column_name, query_order
+            )
+        # Updates of an earlier row with the same rowid don't count
+        if update_node is None or update_node.query_order < insert_node.query_order:
             return None
-        return last_update_node
\ No newline at end of file
+        return update_node
+
+    def find_prev_insert(self, table_name: str, primary_key: str, query_order: int) -> InsertNode:
+        """Find the insert node of the row which had given rowid right before given query order"""
+        key = (table_name, primary_key)
+        insert_node = self.insert_index.get(key)
+        if insert_node is not None and insert_node.query_order < query_order:
+            return insert_node
+        insert_nodes = self.prev_insert_index.get(key, [])
+        idx = bisect_left(insert_nodes, query_order, key=lambda insert_node: insert_node.query_order)
+        if idx == 0:
+            raise NodeNotFound(f"insert node with key: [{key}] before query order [{query_order}] doesn't exist")
+        return insert_nodes[idx - 1]
+
+    def _find_next_insert_order(self, insert_node: InsertNode) -> int:
+        """Query order of the insert which took the rowid of given insert node over"""
+        key = (insert_node.target_table, insert_node.primary_key)
+        insert_nodes = self.prev_insert_index.get(key, [])
+        idx = bisect_right(insert_nodes, insert_node.query_order, key=lambda insert_node: insert_node.query_order)
+        if idx < len(insert_nodes):
+            return insert_nodes[idx].query_order
+        last_insert_node = self.insert_index.get(key)
+        return MAX_ORDER if last_insert_node is None else last_insert_node.query_order
+
+    def find_parent(self, node: SSqliteNode) -> SSqliteNode:
+        """Find parent node of given node"""
+        return node.get_parent()
+
+    def find_live_inserts(self, create_node: CreateNode) -> list[InsertNode]:
+        """Find insert nodes of the table whose rows were not deleted, in insertion order"""
+        return list(self.live_index.get(create_node.query_order, {}).values())
+
+    def find_updated_columns(self, insert_node: InsertNode) -> set[str]:
+        """Find all columns updated after given insert node"""
+        return set(self.find_last_updates(insert_node))
+
+    def find_last_updates(self, insert_node: InsertNode) -> dict[str, UpdateNode]:
+        """Find last update node of every column updated after given insert node"""
+        key = (insert_node.target_table, insert_node.primary_key)
+        if self.insert_index.get(key) is insert_node:
+            return dict(self.last_update_index[key])
+        # Row whose rowid was given to another row afterwards, whose updates don't count
+        next_order = self._find_next_insert_order(insert_node)
+        last_updates = {}
+        for column in insert_node.get_all_updated_columns():
+            update_node = self.find_current_update(insert_node, column, query_order=next_order)
+            if update_node is not None:
+                last_updates[column] = update_node
+        return last_updates
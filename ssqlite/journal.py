@@ -0,0 +1,67 @@
+import os
+import pickle
+
+from typing import Iterator
+
+from ssqlite.node import SSqliteNode, node_to_record, record_to_node
+
+
+# Record written once the transaction of the nodes before it is committed
+COMMIT_RECORD = None
+
+
+class SQGJournal(object):
+    """Append-only log of the nodes added to a SQG since its last snapshot
+
+    Every node is written as an independent pickled record, followed by a commit record
+    once its transaction is committed, so the journal is replayed up to the last commit.
+    """
+
+    def __init__(self, journal_filepath: str):
+        self.journal_filepath = journal_filepath
+        self.f = open(journal_filepath, "ab")
+        self.committed_size = self.f.seek(0, os.SEEK_END)
+
+    def append(self, node: SSqliteNode) -> None:
+        """Append node to the journal"""
+        self.f.write(pickle.dumps(node_to_record(node), pickle.HIGHEST_PROTOCOL))
+
+    def sync(self) -> None:
+        """Flush appended nodes down to the disk"""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def commit(self) -> None:
+        """Mark the nodes appended so far as committed, and flush them down to the disk"""
+        self.f.write(pickle.dumps(COMMIT_RECORD, pickle.HIGHEST_PROTOCOL))
+        self.sync()
+        self.committed_size = self.f.tell()
+
+    def discard(self) -> None:
+        """Drop the nodes appended since the last commit"""
+        self.f.flush()
+        self.f.truncate(self.committed_size)
+
+    def close(self) -> None:
+        """Drop uncommitted nodes, then sync and close the journal"""
+        if not self.f.closed:
+            self.discard()
+            self.sync()
+            self.f.close()
+
+    @staticmethod
+    def replay(journal_filepath: str) -> Iterator[SSqliteNode]:
+        """Yield the committed nodes recorded in the journal in the order they were added"""
+        nodes = []
+        with open(journal_filepath, "rb") as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    # Nodes of a transaction which wasn't committed, or a crash left incomplete, are dropped
+                    return
+                if record is COMMIT_RECORD:
+                    yield from nodes
+                    nodes.clear()
+                else:
+                    nodes.append(record_to_node(record))
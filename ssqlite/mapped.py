@@ -0,0 +1,432 @@
+import mmap
+import os
+import struct
+import sys
+import ssqlite.config
+import ssqlite.metrics
+import time
+
+from array import array
+from pathlib import Path
+
+from ssqlite.index import Index, NodeNotFound
+from ssqlite.node import SSqliteNode, CreateNode, InsertNode, UpdateNode, DropNode, DeleteNode
+from ssqlite.node import MultiUpdateNode, MultiDeleteNode, OrphanError
+from ssqlite.node import NODE_CLASSES, NODE_TYPE_CODES
+
+
+MAGIC = b"SQGB"
+VERSION = 2
+
+# magic, version, num_names, num_nodes, num_rows,
+# names/tables/nodes/rows/rowsets/strings section offsets
+HEADER = struct.Struct("<4sIQQQQQQQQQ")
+# offset and length of a name in the string section
+NAME = struct.Struct("<QI")
+# query orders of the last CreateNode and DropNode of a table(-1 if none)
+TABLE = struct.Struct("<qq")
+# query_order, node_type, flag, table_id, column_id, primary_key(or rowset offset),
+# parent_order(-1 if none), query offset, query length, number of rowids in rowset,
+# offset of the NAME records of old values in the rowset section(UpdateNodes with flag only)
+NODE = struct.Struct("<qBBIIqqQIIQ")
+# table_id, primary_key, column_id, query_order, node_type
+# sorted, so every (table, rowid, column) is a contiguous range ordered by query_order
+ROW = struct.Struct("<IqIqB")
+
+MULTI_CODES = (NODE_TYPE_CODES[MultiUpdateNode], NODE_TYPE_CODES[MultiDeleteNode])
+INSERT_CODE = NODE_TYPE_CODES[InsertNode]
+DELETE_CODES = (NODE_TYPE_CODES[DeleteNode], NODE_TYPE_CODES[MultiDeleteNode])
+
+
+class InvalidFormat(Exception):
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class MappedIndex(object):
+    """Index which binary searches the memory-mapped node and row tables
+
+    Only the nodes that are asked for are materialized. They carry no parent or
+    children references, so links are resolved through find_parent and friends.
+    """
+
+    # History is never pruned here
+    horizon = 0
+
+    def __init__(self, buf: mmap.mmap):
+        self.buf = buf
+        (
+            magic, version, self.num_names, self.num_nodes, self.num_rows,
+            self.names_offset, self.tables_offset, self.nodes_offset,
+            self.rows_offset, self.rowsets_offset, self.strings_offset
+        ) = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise InvalidFormat("Not a binary SQG file")
+        if version != VERSION:
+            raise InvalidFormat(
+                f"Binary SQG file of version {version} is not supported(version {VERSION}), "
+                "load it with the ssqlite which wrote it and save it again"
+            )
+
+        # Names are few, so they are decoded once
+        self.names = []
+        for i in range(self.num_names):
+            offset, length = NAME.unpack_from(buf, self.names_offset + i * NAME.size)
+            start = self.strings_offset + offset
+            self.names.append(sys.intern(buf[start:start + length].decode()))
+        self.name_ids = {name: name_id for name_id, name in enumerate(self.names)}
+
+    def _read_node(self, idx: int) -> tuple:
+        return NODE.unpack_from(self.buf, self.nodes_offset + idx * NODE.size)
+
+    def _read_row(self, idx: int) -> tuple:
+        return ROW.unpack_from(self.buf, self.rows_offset + idx * ROW.size)
+
+    def _node_idx(self, query_order: int) -> int:
+        """Binary search the node table for given query order"""
+        lo, hi = 0, self.num_nodes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._read_node(mid)[0] < query_order:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_nodes and self._read_node(lo)[0] == query_order:
+            return lo
+        return -1
+
+    def _row_idx(self, key: tuple) -> int:
+        """Binary search the row table for the first entry not less than given key prefix"""
+        lo, hi = 0, self.num_rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._read_row(mid)[:len(key)] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _row_range(self, key: tuple):
+        """Yield every row table entry which starts with given key prefix"""
+        idx = self._row_idx(key)
+        while idx < self.num_rows:
+            entry = self._read_row(idx)
+            if entry[:len(key)] != key:
+                return
+            yield entry
+            idx += 1
+
+    def _materialize(self, record: tuple) -> SSqliteNode:
+        """Build node from a record of the node table"""
+        (
+            query_order, node_type, flag, table_id, column_id, primary_key,
+            _, query_offset, query_length, num_rowids, old_values_offset
+        ) = record
+        start = self.strings_offset + query_offset
+        query_string = self.buf[start:start + query_length].decode()
+        node_class = NODE_CLASSES[node_type]
+
+        if node_type in MULTI_CODES:
+            start = self.rowsets_offset + primary_key
+            primary_keys = array("q")
+            primary_keys.frombytes(self.buf[start:start + num_rowids * primary_keys.itemsize])
+            node = node_class(
+                query_order=query_order, query_string=query_string, primary_keys=primary_keys,
+                target_table=self.names[table_id], target_column=self.names[column_id]
+            )
+            if node_class is MultiUpdateNode and flag:
+                node.old_values = self._read_old_values(old_values_offset, num_rowids)
+        elif node_class is UpdateNode:
+            node = node_class(
+                query_order=query_order, query_string=query_string, primary_key=primary_key,
+                target_table=self.names[table_id], target_column=self.names[column_id],
+                old_value=self._read_old_values(old_values_offset, 1)[0] if flag else None
+            )
+        else:
+            node = node_class(
+                query_order=query_order, query_string=query_string,
+                primary_key=primary_key if node_class in (InsertNode, UpdateNode, DeleteNode) else "",
+                target_table=self.names[table_id], target_column=self.names[column_id]
+            )
+
+        if isinstance(node, CreateNode):
+            node.flag_drop = bool(flag)
+        elif isinstance(node, InsertNode):
+            node.flag_delete = bool(flag)
+        return node
+
+    def _read_old_values(self, offset: int, count: int) -> list[str]:
+        """Decode old values stored as NAME records in the rowset section"""
+        old_values = []
+        for i in range(count):
+            value_offset, length = NAME.unpack_from(self.buf, self.rowsets_offset + offset + i * NAME.size)
+            start = self.strings_offset + value_offset
+            old_values.append(self.buf[start:start + length].decode())
+        return old_values
+
+    def _materialize_order(self, query_order: int) -> SSqliteNode:
+        idx = self._node_idx(query_order)
+        if idx < 0:
+            return None
+        return self._materialize(self._read_node(idx))
+
+    def find(self, _from: str, _key: str | tuple) -> SSqliteNode:
+        """Find specific node from the mapped tables"""
+        _from = _from.lower()
+        node = None
+        if _from in ("create", "drop"):
+            table_id = self.name_ids.get(_key)
+            if table_id is not None:
+                create_order, drop_order = TABLE.unpack_from(self.buf, self.tables_offset + table_id * TABLE.size)
+                query_order = create_order if _from == "create" else drop_order
+                node = None if query_order < 0 else self._materialize_order(query_order)
+        elif _from in ("insert", "delete", "update"):
+            table_name, primary_key, *column_name = _key
+            table_id = self.name_ids.get(table_name)
+            column_id = self.name_ids.get(column_name[0] if column_name else "")
+            if table_id is not None and column_id is not None:
+                entries = list(self._row_range((table_id, primary_key, column_id)))
+                if _from == "update":
+                    if entries:
+                        return [self._materialize_order(entry[3]) for entry in entries]
+                else:
+                    # Entries of a row are ordered by query order, so the last one is the latest
+                    node_types = (INSERT_CODE,) if _from == "insert" else DELETE_CODES
+                    entries = [entry for entry in entries if entry[4] in node_types]
+                    if entries:
+                        node = self._materialize_order(entries[-1][3])
+
+        if node is None:
+            raise NodeNotFound(f"{_from} node with key: [{_key}] doesn't exist")
+        return node
+
+    def find_by_order(self, query_order: int) -> SSqliteNode:
+        """Find specific node based on query order"""
+        node = self._materialize_order(query_order)
+        if node is None:
+            raise NodeNotFound(f"Node with query order [{query_order}] doesn't exist")
+        return node
+
+    def find_last_update(self, table_name: str, primary_key: str, column_name: str) -> UpdateNode:
+        """Find last update node based on given _key"""
+        return self.find_prev_update(table_name, primary_key, column_name, query_order=2 ** 63 - 1)
+
+    def find_prev_update(
+            self, table_name: str, primary_key: str, column_name: str, query_order: int
+        ) -> UpdateNode:
+        """Find the update node that precedes given query order on the same column"""
+        table_id = self.name_ids.get(table_name)
+        column_id = self.name_ids.get(column_name)
+        if table_id is None or not column_id:
+            return None
+        idx = self._row_idx((table_id, primary_key, column_id, query_order))
+        if idx == 0:
+            return None
+        entry = self._read_row(idx - 1)
+        if entry[:3] != (table_id, primary_key, column_id):
+            return None
+        return self._materialize_order(entry[3])
+
+    # Same rule as the pickle index, on top of this index's own find_last_update and find_prev_update
+    find_current_update = Index.find_current_update
+
+    def find_prev_insert(self, table_name: str, primary_key: str, query_order: int) -> InsertNode:
+        """Find the insert node of the row which had given rowid right before given query order"""
+        table_id = self.name_ids.get(table_name)
+        insert_orders = [] if table_id is None else [
+            entry[3] for entry in self._row_range((table_id, primary_key, 0))
+            if entry[4] == INSERT_CODE and entry[3] < query_order
+        ]
+        if not insert_orders:
+            raise NodeNotFound(
+                f"insert node with key: [{(table_name, primary_key)}] before query order [{query_order}] doesn't exist"
+            )
+        return self._materialize_order(insert_orders[-1])
+
+    def _find_next_insert_order(self, table_id: int, insert_node: InsertNode) -> int:
+        """Query order of the insert which took the rowid of given insert node over"""
+        for entry in self._row_range((table_id, insert_node.primary_key, 0)):
+            if entry[4] == INSERT_CODE and entry[3] > insert_node.query_order:
+                return entry[3]
+        return 2 ** 63 - 1
+
+    def find_parent(self, node: SSqliteNode) -> SSqliteNode:
+        """Find parent node of given node"""
+        idx = self._node_idx(node.query_order)
+        parent_order = self._read_node(idx)[6] if idx >= 0 else -1
+        if parent_order < 0:
+            raise OrphanError(node.node_id)
+        return self.find_by_order(parent_order)
+
+    def find_live_inserts(self, create_node: CreateNode) -> list[InsertNode]:
+        """Find insert nodes of the table whose rows were not deleted, in insertion order"""
+        table_id = self.name_ids.get(create_node.target_table)
+        if table_id is None:
+            return []
+        insert_orders = sorted(
+            entry[3] for entry in self._row_range((table_id,))
+            if entry[2] == 0 and entry[4] == INSERT_CODE
+        )
+        insert_nodes = []
+        for query_order in insert_orders:
+            record = self._read_node(self._node_idx(query_order))
+            # Inserts of the same table name may belong to another CREATE
+            if record[6] == create_node.query_order and not record[2]:
+                insert_nodes.append(self._materialize(record))
+        return insert_nodes
+
+    def find_updated_columns(self, insert_node: InsertNode) -> set[str]:
+        """Find all columns updated after given insert node"""
+        table_id = self.name_ids.get(insert_node.target_table)
+        if table_id is None:
+            return set()
+        next_order = self._find_next_insert_order(table_id, insert_node)
+        return {
+            self.names[entry[2]] for entry in self._row_range((table_id, insert_node.primary_key))
+            if entry[2] != 0 and insert_node.query_order < entry[3] < next_order
+        }
+
+    def find_last_updates(self, insert_node: InsertNode) -> dict[str, UpdateNode]:
+        """Find last update node of every column updated after given insert node"""
+        table_id = self.name_ids.get(insert_node.target_table)
+        if table_id is None:
+            return {}
+        # Entries of a column are sorted by query order, so the last one wins
+        next_order = self._find_next_insert_order(table_id, insert_node)
+        last_orders = {
+            self.names[entry[2]]: entry[3] for entry in self._row_range((table_id, insert_node.primary_key))
+            if entry[2] != 0 and insert_node.query_order < entry[3] < next_order
+        }
+        return {column: self._materialize_order(query_order) for column, query_order in last_orders.items()}
+
+
+class MappedQueryGraph(object):
+    """Read-only SQG backed by a memory-mapped binary .sqg file"""
+
+    def __init__(self, sqg_filepath: Path):
+        with open(sqg_filepath, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.index: MappedIndex = MappedIndex(self.buf)
+        except InvalidFormat:
+            self.buf.close()
+            raise
+
+    def close(self) -> None:
+        self.buf.close()
+
+    @property
+    def last_order(self) -> int:
+        """Query order of the most recently added node"""
+        if not self.index.num_nodes:
+            return 0
+        return self.index._read_node(self.index.num_nodes - 1)[0]
+
+    @classmethod
+    def load_from_file(cls, sqg_filename: str="ssqlite.sqg"):
+        """Map binary .sqg file"""
+        return cls(Path(ssqlite.config.BASE_DIR) / sqg_filename)
+
+    @classmethod
+    def save_to_file(cls, graph, sqg_filename: str="ssqlite.sqg") -> None:
+        """Save in-memory SQG object into binary .sqg file"""
+        metrics = ssqlite.metrics.active
+        if metrics is not None:
+            start = time.perf_counter()
+        names, name_ids = [""], {"": 0}
+        def get_name_id(name: str) -> int:
+            if name not in name_ids:
+                name_ids[name] = len(names)
+                names.append(name)
+            return name_ids[name]
+
+        tables = {}
+        node_records, row_entries = [], []
+        rowsets, strings = bytearray(), bytearray()
+        for query_order in sorted(graph.index.order_index):
+            node = graph.index.order_index[query_order]
+            node_type = NODE_TYPE_CODES[type(node)]
+            table_id = get_name_id(node.target_table)
+            column_id = get_name_id(node.target_column)
+
+            if isinstance(node, (MultiUpdateNode, MultiDeleteNode)):
+                primary_key, num_rowids = len(rowsets), len(node.primary_keys)
+                rowsets += node.primary_keys.tobytes()
+                row_entries += [
+                    (table_id, rowid, column_id, query_order, node_type) for rowid in node.primary_keys
+                ]
+            elif isinstance(node, (InsertNode, UpdateNode, DeleteNode)):
+                primary_key, num_rowids = node.primary_key, 0
+                row_entries.append((table_id, primary_key, column_id, query_order, node_type))
+            else:
+                primary_key, num_rowids = 0, 0
+                create_order, drop_order = tables.get(table_id, (-1, -1))
+                if isinstance(node, CreateNode):
+                    tables[table_id] = (query_order, drop_order)
+                else:
+                    tables[table_id] = (create_order, query_order)
+
+            if isinstance(node, MultiUpdateNode):
+                old_values = node.old_values
+            elif isinstance(node, UpdateNode):
+                old_values = None if node.old_value is None else [node.old_value]
+            else:
+                old_values = None
+
+            if isinstance(node, CreateNode):
+                flag = node.flag_drop
+            elif isinstance(node, InsertNode):
+                flag = node.flag_delete
+            else:
+                # UpdateNodes are flagged when their old values are captured
+                flag = old_values is not None
+            parent_order = -1 if node.parent is None else node.parent.query_order
+
+            query_bytes = node.query_string.encode()
+            query_offset = len(strings)
+            strings += query_bytes
+            old_values_offset = len(rowsets)
+            for old_value in old_values or ():
+                value_bytes = old_value.encode()
+                rowsets += NAME.pack(len(strings), len(value_bytes))
+                strings += value_bytes
+            node_records.append(NODE.pack(
+                query_order, node_type, flag, table_id, column_id, primary_key,
+                parent_order, query_offset, len(query_bytes), num_rowids, old_values_offset
+            ))
+        row_entries.sort()
+
+        name_records = []
+        for name in names:
+            name_bytes = name.encode()
+            name_records.append(NAME.pack(len(strings), len(name_bytes)))
+            strings += name_bytes
+
+        names_offset = HEADER.size
+        tables_offset = names_offset + len(names) * NAME.size
+        nodes_offset = tables_offset + len(names) * TABLE.size
+        rows_offset = nodes_offset + len(node_records) * NODE.size
+        rowsets_offset = rows_offset + len(row_entries) * ROW.size
+        strings_offset = rowsets_offset + len(rowsets)
+
+        # Written aside first, so a crash never leaves a partial file in place of the last one
+        sqg_filepath = Path(ssqlite.config.BASE_DIR) / sqg_filename
+        tmp_filepath = Path(ssqlite.config.BASE_DIR) / f"{sqg_filename}-tmp"
+        with open(tmp_filepath, "wb") as f:
+            f.write(HEADER.pack(
+                MAGIC, VERSION, len(names), len(node_records), len(row_entries),
+                names_offset, tables_offset, nodes_offset, rows_offset, rowsets_offset, strings_offset
+            ))
+            f.write(b"".join(name_records))
+            f.write(b"".join(TABLE.pack(*tables.get(table_id, (-1, -1))) for table_id in range(len(names))))
+            f.write(b"".join(node_records))
+            f.write(b"".join(ROW.pack(*entry) for entry in row_entries))
+            f.write(rowsets)
+            f.write(strings)
+        os.replace(tmp_filepath, sqg_filepath)
+        if metrics is not None:
+            metrics.record("save", time.perf_counter() - start)
@@ -0,0 +1,70 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+
+class Metrics(object):
+    """Counters and cumulative timings of the stages of ingestion and recovery"""
+
+    def __init__(self, callbacks: list[Callable[[str, float, int], None]] | None=None):
+        self.counts = defaultdict(int)
+        self.timings = defaultdict(float)
+        self.callbacks = list(callbacks or [])
+
+    def record(self, stage: str, elapsed: float, count: int=1) -> None:
+        """Add elapsed seconds of a stage"""
+        self.counts[stage] += count
+        self.timings[stage] += elapsed
+        for callback in self.callbacks:
+            callback(stage, elapsed, count)
+
+    def count(self, name: str, count: int=1) -> None:
+        """Increase a counter"""
+        self.counts[name] += count
+
+    def reset(self) -> None:
+        """Clear every counter and timing"""
+        self.counts.clear()
+        self.timings.clear()
+
+    def report(self) -> str:
+        """Format counters and timings as a table, one stage per line"""
+        lines = []
+        for stage in sorted(self.counts):
+            if stage in self.timings:
+                total = self.timings[stage]
+                mean = total / self.counts[stage] if self.counts[stage] else 0.0
+                lines.append(
+                    f"{stage:<24} {self.counts[stage]:>10,} {total:>10.3f}s {mean * 10 ** 6:>10.1f}us/each"
+                )
+            else:
+                lines.append(f"{stage:<24} {self.counts[stage]:>10,}")
+        return "\n".join(lines)
+
+
+# Metrics which the pipeline reports to, None while instrumentation is disabled
+active: Metrics | None = None
+
+
+def enable(metrics: Metrics | None=None) -> Metrics:
+    """Start reporting to given metrics, or to new ones"""
+    global active
+    active = metrics if metrics is not None else Metrics()
+    return active
+
+
+def disable() -> None:
+    """Stop reporting"""
+    global active
+    active = None
+
+
+@contextmanager
+def collect(metrics: Metrics | None=None) -> Iterator[Metrics]:
+    """Report to given metrics, or to new ones, within the block"""
+    global active
+    previous = active
+    try:
+        yield enable(metrics)
+    finally:
+        active = previous
@@ -1,10 +1,17 @@
+import sys
+
 from abc import ABCMeta, abstractmethod
+from array import array
+from itertools import count
+from typing import Iterator
+
+from ssqlite.utils import bind_parameters, gc_paused
 
 
 class OrphanError(Exception):
 
     def __init__(self, node_id):
-        self.msg = f"SSqliteNode<{node_id}> has no parent"
+        self.msg = f"SSqliteNode<{node_id:05d}> has no parent"
     
     def __str__(self):
         return self.msg
@@ -39,27 +46,71 @@ class InvalidChild(Exception):
 
 class SSqliteNode(metaclass=ABCMeta):
 
-    node_id: int = 0
+    # Nodes are created by the million, so attributes live in slots rather than a __dict__
+    __slots__ = (
+        "node_id", "query_order", "query_template", "parameters", "parent",
+        "primary_key", "target_table", "target_column"
+    )
+
+    # Counting with a class attribute would invalidate the type cache on every new node
+    node_ids: Iterator[int] = count()
+
+    # Only nodes which can have children own a list of them
+    children: tuple = ()
 
     def __init__(
             self, query_order: int, query_string: str,
-            primary_key: str="", target_table: str="", target_column: str=""
+            primary_key: str="", target_table: str="", target_column: str="",
+            parameters: tuple | dict | None=None
         ):
-        self.node_id = str(SSqliteNode.node_id).rjust(5, "0")
-        SSqliteNode.node_id += 1
+        self.node_id: int = next(SSqliteNode.node_ids)
 
         self.query_order: int = query_order
-        self.query_string: str = query_string
+        # Parameterized statements keep the shared template and their own parameters,
+        # which are only rendered into a query string when it is read
+        self.query_template: str = query_string
+        self.parameters: tuple | dict | None = parameters or None
 
         self.parent: SSqliteNode = None
-        self.children: list[SSqliteNode] = []
 
+        # Table and column names are shared by many nodes, so keep a single copy of each
         self.primary_key: str = primary_key
-        self.target_table: str = target_table
-        self.target_column: str = target_column
+        self.target_table: str = sys.intern(target_table)
+        self.target_column: str = sys.intern(target_column)
     
     def __repr__(self):
-        return f"SSqliteNode(node_id={self.node_id}, query_order={self.query_order})"
+        return f"SSqliteNode(node_id={self.node_id:05d}, query_order={self.query_order})"
+
+    def __setstate__(self, state):
+        # Slots come as (None, slots), while nodes pickled before slots come as their __dict__
+        dict_state, slot_state = state if isinstance(state, tuple) else (state, None)
+        if dict_state:
+            self._set_legacy_state(dict_state)
+        if slot_state:
+            for name, value in slot_state.items():
+                setattr(self, name, value)
+
+    def _set_legacy_state(self, state: dict) -> None:
+        """Fill the slots from the __dict__ of a node pickled before slots"""
+        state = dict(state)
+        state["node_id"] = int(state["node_id"])
+        state["query_template"] = state.pop("query_string")
+        state.setdefault("parameters", None)
+        if isinstance(self, UpdateNode):
+            state["children"] = tuple(state["children"])
+            state.setdefault("old_value", None)
+        elif not isinstance(self, (CreateNode, InsertNode)):
+            # Only nodes which can have children own a list of them
+            del state["children"]
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def query_string(self) -> str:
+        """Query string with bound parameters rendered as literals"""
+        if self.parameters is None:
+            return self.query_template
+        return bind_parameters(self.query_template, self.parameters)
 
     def get_parent(self):
         """Get parent node"""
@@ -86,12 +137,15 @@ class SSqliteNode(metaclass=ABCMeta):
 
 class CreateNode(SSqliteNode):
 
+    __slots__ = ("children", "flag_drop")
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.children: list[SSqliteNode] = []
         self.flag_drop: bool = False
 
     def __repr__(self):
-        return f"CreateNode(node_id={self.node_id}, query_order={self.query_order})"
+        return f"CreateNode(node_id={self.node_id:05d}, query_order={self.query_order})"
 
     def get_child(self):
         """Get specific child"""
@@ -115,12 +169,43 @@ class CreateNode(SSqliteNode):
 
 class InsertNode(SSqliteNode):
 
+    __slots__ = ("children", "flag_delete")
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        # Most rows are never updated, so the list is only allocated with the first child
+        self.children: list[SSqliteNode] = ()
         self.flag_delete: bool = False
 
     def __repr__(self):
-        return f"InsertNode(node_id={self.node_id}, query_order={self.query_order})"
+        return f"InsertNode(node_id={self.node_id:05d}, query_order={self.query_order})"
+
+    @classmethod
+    def from_rowid_range(
+            cls, query_order: int, query_string: str, target_table: str,
+            first_rowid: int, seq_of_parameters: list[tuple | dict]
+        ) -> list["InsertNode"]:
+        """Build nodes of rows inserted with consecutive rowids and query orders, e.g. by executemany"""
+        # Slots are filled directly instead of running __init__, as this is the hot path of bulk loading
+        target_table = sys.intern(target_table)
+        target_column = sys.intern("")
+        node_ids = SSqliteNode.node_ids
+        insert_nodes = []
+        with gc_paused():
+            for idx, parameters in enumerate(seq_of_parameters):
+                node = cls.__new__(cls)
+                node.node_id = next(node_ids)
+                node.query_order = query_order + idx
+                node.query_template = query_string
+                node.parameters = parameters or None
+                node.parent = None
+                node.primary_key = first_rowid + idx
+                node.target_table = target_table
+                node.target_column = target_column
+                node.children = ()
+                node.flag_delete = False
+                insert_nodes.append(node)
+        return insert_nodes
 
     def get_child(self):
         """Get specific child"""
@@ -136,6 +221,8 @@ class InsertNode(SSqliteNode):
     def add_child(self, node: SSqliteNode):
         """Add child node"""
         if isinstance(node, UpdateNode) or isinstance(node, DeleteNode):
+            if not self.children:
+                self.children = []
             self.children.append(node)
         else:
             raise InvalidChild(f"[{type(node)}] cannot be a child of InsertNode")
@@ -157,12 +244,16 @@ class InsertNode(SSqliteNode):
 
 class UpdateNode(SSqliteNode):
 
-    def __init__(self, **kwargs):
+    __slots__ = ("children", "old_value")
+
+    def __init__(self, old_value: str | None=None, **kwargs):
         super().__init__(**kwargs)
-        pass
+        self.children: tuple[SSqliteNode] = ()
+        # SQL literal of the column before the update, e.g. 'Bob' or NULL, if it was captured
+        self.old_value: str | None = old_value
 
     def __repr__(self):
-        return f"UpdateNode(node_id={self.node_id}, query_order={self.query_order})"
+        return f"UpdateNode(node_id={self.node_id:05d}, query_order={self.query_order})"
 
     def get_child(self):
         """Get specific child"""
@@ -180,19 +271,50 @@ class UpdateNode(SSqliteNode):
         if isinstance(node, UpdateNode):
             if self.children:
                 raise InvalidChild("UpdateNode can have only 1 child maximum")
-            self.children.append(node)
+            self.children = (node,)
         else:
             raise InvalidChild(f"[{type(node)}] cannot be a child of UpdateNode")
 
 
+class MultiUpdateNode(UpdateNode):
+
+    __slots__ = ("primary_keys", "old_values")
+
+    def __init__(self, primary_keys: array, old_values: list[str] | None=None, **kwargs):
+        super().__init__(**kwargs)
+        self.primary_keys: array = primary_keys
+        # Old values of the rows, in the same order as primary_keys
+        self.old_values: list[str] | None = old_values
+
+    def __repr__(self):
+        return f"MultiUpdateNode(node_id={self.node_id:05d}, query_order={self.query_order})"
+
+    def set_parent(self, node: SSqliteNode):
+        """Set parent node"""
+        raise InvalidOperation("MultiUpdateNode has a parent per row, which is found from the index")
+
+    def add_child(self, node: SSqliteNode):
+        """Add child node"""
+        if isinstance(node, UpdateNode):
+            # Same child may follow several rows of this node
+            if not self.children:
+                self.children = [node]
+            elif self.children[-1] is not node:
+                self.children.append(node)
+        else:
+            raise InvalidChild(f"[{type(node)}] cannot be a child of MultiUpdateNode")
+
+
 class DropNode(SSqliteNode):
 
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         pass
 
     def __repr__(self):
-        return f"DropNode(node_id={self.node_id}, query_order={self.query_order})"
+        return f"DropNode(node_id={self.node_id:05d}, query_order={self.query_order})"
 
     def get_child(self):
         """Get specific child"""
@@ -212,12 +334,14 @@ class DropNode(SSqliteNode):
 
 class DeleteNode(SSqliteNode):
 
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         pass
 
     def __repr__(self):
-        return f"DeleteNode(node_id={self.node_id}, query_order={self.query_order})"
+        return f"DeleteNode(node_id={self.node_id:05d}, query_order={self.query_order})"
 
     def get_child(self):
         """Get specific child"""
@@ -233,3 +357,74 @@ class DeleteNode(SSqliteNode):
     def add_child(self, node: InsertNode):
         """Add child node"""
         raise InvalidOperation("DeleteNode cannot have a child node")
+
+
+class MultiDeleteNode(DeleteNode):
+
+    __slots__ = ("primary_keys",)
+
+    def __init__(self, primary_keys: array, **kwargs):
+        super().__init__(**kwargs)
+        self.primary_keys: array = primary_keys
+
+    def __repr__(self):
+        return f"MultiDeleteNode(node_id={self.node_id:05d}, query_order={self.query_order})"
+
+    def set_parent(self, node: InsertNode):
+        """Set parent node"""
+        raise InvalidOperation("MultiDeleteNode has a parent per row, which is found from the index")
+
+
+# Fixed type codes used when a node is flattened into a record for persistence
+NODE_CLASSES = (
+    CreateNode, InsertNode, UpdateNode, DropNode, DeleteNode, MultiUpdateNode, MultiDeleteNode
+)
+NODE_TYPE_CODES = {node_class: code for code, node_class in enumerate(NODE_CLASSES)}
+
+
+def node_to_record(node: SSqliteNode) -> tuple:
+    """Flatten node into a tuple which holds no reference to other nodes"""
+    if isinstance(node, (MultiUpdateNode, MultiDeleteNode)):
+        primary_key = node.primary_keys
+    else:
+        primary_key = node.primary_key
+
+    if isinstance(node, MultiUpdateNode):
+        old_value = node.old_values
+    elif isinstance(node, UpdateNode):
+        old_value = node.old_value
+    else:
+        old_value = None
+
+    return (
+        NODE_TYPE_CODES[type(node)], node.query_order, node.query_template,
+        primary_key, node.target_table, node.target_column, node.parameters, old_value
+    )
+
+
+def record_to_node(record: tuple) -> SSqliteNode:
+    """Build an unlinked node back from its record"""
+    code, query_order, query_string, primary_key, target_table, target_column, parameters, old_value = record
+    node_class = NODE_CLASSES[code]
+
+    if node_class is MultiUpdateNode:
+        return node_class(
+            query_order=query_order, query_string=query_string, primary_keys=primary_key,
+            target_table=target_table, target_column=target_column, parameters=parameters,
+            old_values=old_value
+        )
+    if node_class is UpdateNode:
+        return node_class(
+            query_order=query_order, query_string=query_string, primary_key=primary_key,
+            target_table=target_table, target_column=target_column, parameters=parameters,
+            old_value=old_value
+        )
+    if node_class is MultiDeleteNode:
+        return node_class(
+            query_order=query_order, query_string=query_string, primary_keys=primary_key,
+            target_table=target_table, target_column=target_column, parameters=parameters
+        )
+    return node_class(
+        query_order=query_order, query_string=query_string, primary_key=primary_key,
+        target_table=target_table, target_column=target_column, parameters=parameters
+    )
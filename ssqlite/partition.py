@@ -0,0 +1,298 @@
+import os
+import pickle
+import ssqlite.metrics
+import time
+
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from ssqlite.algo import SSqliteQueryGraph, get_sqg_filepath
+from ssqlite.index import NodeNotFound
+from ssqlite.node import SSqliteNode, CreateNode, InsertNode, UpdateNode
+
+
+def get_shard_filename(sqg_filename: str, shard_id: int) -> str:
+    """Helper function for naming the .sqg file of a shard"""
+    return f"{sqg_filename}-shard{shard_id}"
+
+
+def prune_shard(shard_filename: str, horizon: int, collapse_updates: bool=False) -> int:
+    """Prune the history of a shard file up to given horizon, and return the number of dropped nodes"""
+    shard = SSqliteQueryGraph.load_from_file(shard_filename)
+    # keep_last which puts the horizon of the shard at the horizon of the whole graph
+    num_pruned = shard.prune(keep_last=shard.last_order - horizon + 1, collapse_updates=collapse_updates)
+    tmp_filename = f"{shard_filename}-tmp"
+    SSqliteQueryGraph.save_to_file(shard, tmp_filename)
+    os.replace(get_sqg_filepath(tmp_filename), get_sqg_filepath(shard_filename))
+    return num_pruned
+
+
+class PartitionedIndex(object):
+    """Index of PartitionedQueryGraph, which looks nodes up in the shard of their table"""
+
+    def __init__(self, graph: "PartitionedQueryGraph"):
+        self.graph = graph
+
+    @property
+    def horizon(self) -> int:
+        return self.graph.horizon
+
+    def find(self, _from: str, _key: str | tuple) -> SSqliteNode:
+        """Find specific node from index"""
+        table_name = _key if isinstance(_key, str) else _key[0]
+        return self.graph.get_shard(table_name).index.find(_from=_from, _key=_key)
+
+    def find_by_order(self, query_order: int) -> SSqliteNode:
+        """Find specific node based on query order"""
+        table_name = self.graph.find_table_by_order(query_order)
+        if table_name is None or query_order < self.graph.horizon:
+            raise NodeNotFound(f"Node with query order [{query_order}] doesn't exist")
+        return self.graph.get_shard(table_name).index.find_by_order(query_order)
+
+    def find_last_update(self, table_name: str, primary_key: str, column_name: str) -> UpdateNode:
+        """Find last update node based on given _key"""
+        if table_name not in self.graph.shard_ids:
+            return None
+        return self.graph.get_shard(table_name).index.find_last_update(table_name, primary_key, column_name)
+
+    def find_prev_update(
+            self, table_name: str, primary_key: str, column_name: str, query_order: int
+        ) -> UpdateNode:
+        """Find the update node that precedes given query order on the same column"""
+        if table_name not in self.graph.shard_ids:
+            return None
+        return self.graph.get_shard(table_name).index.find_prev_update(
+            table_name, primary_key, column_name, query_order
+        )
+
+    def find_current_update(
+            self, insert_node: InsertNode, column_name: str, query_order: int | None=None
+        ) -> UpdateNode | None:
+        """Find the last update of the column of the row inserted by given insert node, before
+        given query order if there is one, which is None if the row still has its inserted value"""
+        return self.graph.get_shard(insert_node.target_table).index.find_current_update(
+            insert_node, column_name, query_order
+        )
+
+    def find_prev_insert(self, table_name: str, primary_key: str, query_order: int) -> InsertNode:
+        """Find the insert node of the row which had given rowid right before given query order"""
+        return self.graph.get_shard(table_name).index.find_prev_insert(table_name, primary_key, query_order)
+
+    def find_parent(self, node: SSqliteNode) -> SSqliteNode:
+        """Find parent node of given node"""
+        return node.get_parent()
+
+    def find_live_inserts(self, create_node: CreateNode) -> list[InsertNode]:
+        """Find insert nodes of the table whose rows were not deleted, in insertion order"""
+        return self.graph.get_shard(create_node.target_table).index.find_live_inserts(create_node)
+
+    def find_updated_columns(self, insert_node: InsertNode) -> set[str]:
+        """Find all columns updated after given insert node"""
+        return self.graph.get_shard(insert_node.target_table).index.find_updated_columns(insert_node)
+
+    def find_last_updates(self, insert_node: InsertNode) -> dict[str, UpdateNode]:
+        """Find last update node of every column updated after given insert node"""
+        return self.graph.get_shard(insert_node.target_table).index.find_last_updates(insert_node)
+
+
+class PartitionedQueryGraph(object):
+    """SQG partitioned by target table, with the subtree of every table in its own shard
+
+    Shards are loaded on first use and only the ones which were changed are saved again.
+    """
+
+    def __init__(self):
+        self.index: PartitionedIndex = PartitionedIndex(self)
+        # Table name of every shard id and the other way around
+        self.table_names: list[str] = []
+        self.shard_ids: dict[str, int] = {}
+        # Query orders from run_starts[i] on, up to the next run, belong to shard run_shards[i]
+        self.run_starts = array("q")
+        self.run_shards = array("q")
+        self.max_order = 0
+        # Nodes before this query order were pruned from every shard
+        self.horizon = 0
+        self.timeline: list[tuple[float, int]] = []
+        # .sqg file which the shards which aren't loaded yet are read from
+        self.sqg_filename: str | None = None
+        self.shards: dict[str, SSqliteQueryGraph] = {}
+        self.dirty: set[str] = set()
+        self.undo_cache = None
+
+    def __getstate__(self):
+        # Shards are saved to their own files
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        state["dirty"] = set()
+        state["undo_cache"] = None
+        return state
+
+    @property
+    def last_order(self) -> int:
+        """Query order of the most recently added node"""
+        return max(self.max_order, self.horizon - 1)
+
+    stamp = SSqliteQueryGraph.stamp
+    find_order_since = SSqliteQueryGraph.find_order_since
+
+    def get_shard(self, table_name: str) -> SSqliteQueryGraph:
+        """Get the shard of given table, loading it on first use"""
+        shard = self.shards.get(table_name)
+        if shard is not None:
+            return shard
+        shard_id = self.shard_ids.get(table_name)
+        if shard_id is None:
+            raise NodeNotFound(f"create node with key: [{table_name}] doesn't exist")
+        shard = SSqliteQueryGraph.load_from_file(get_shard_filename(self.sqg_filename, shard_id))
+        self.shards[table_name] = shard
+        return shard
+
+    def find_table_by_order(self, query_order: int) -> str | None:
+        """Find the table whose shard holds given query order, if any"""
+        idx = bisect_right(self.run_starts, query_order) - 1
+        if idx < 0 or query_order > self.max_order:
+            return None
+        return self.table_names[self.run_shards[idx]]
+
+    def _add_shard(self, table_name: str) -> SSqliteQueryGraph:
+        shard = SSqliteQueryGraph()
+        shard.index.horizon = self.horizon
+        self.shard_ids[table_name] = len(self.table_names)
+        self.table_names.append(table_name)
+        self.shards[table_name] = shard
+        return shard
+
+    def _map(self, table_name: str, query_order: int) -> None:
+        """Map query order, which comes after every mapped one, to the shard of table"""
+        shard_id = self.shard_ids[table_name]
+        if not self.run_shards or self.run_shards[-1] != shard_id:
+            self.run_starts.append(query_order)
+            self.run_shards.append(shard_id)
+        self.max_order = max(self.max_order, query_order)
+        self.dirty.add(table_name)
+
+    def add_node(self, node: SSqliteNode):
+        if isinstance(node, CreateNode) and node.target_table not in self.shard_ids:
+            self._add_shard(node.target_table)
+        self.get_shard(node.target_table).add_node(node)
+        self._map(node.target_table, node.query_order)
+        self.stamp(node.query_order)
+        if self.undo_cache is not None:
+            self.undo_cache.invalidate(node)
+
+    def add_insert_nodes(self, insert_nodes: list[InsertNode]):
+        """Add InsertNodes of a single table at once, e.g. the rows of an executemany"""
+        if not insert_nodes:
+            return
+        table_name = insert_nodes[0].target_table
+        self.get_shard(table_name).add_insert_nodes(insert_nodes)
+        self._map(table_name, insert_nodes[0].query_order)
+        self.max_order = max(self.max_order, insert_nodes[-1].query_order)
+        self.stamp(insert_nodes[0].query_order)
+        if self.undo_cache is not None:
+            for insert_node in insert_nodes:
+                self.undo_cache.invalidate(insert_node)
+
+    @classmethod
+    def from_graph(cls, graph: SSqliteQueryGraph):
+        """Partition the nodes of SQG, which is left as it is and shares them from now on"""
+        partitioned = cls()
+        partitioned.horizon = graph.index.horizon
+        partitioned.timeline = list(graph.timeline)
+        for query_order in sorted(graph.index.order_index):
+            node = graph.index.order_index[query_order]
+            if node.target_table not in partitioned.shard_ids:
+                shard = partitioned._add_shard(node.target_table)
+                shard.timeline = list(graph.timeline)
+            # Nodes are only ever linked within their table, so the links are kept as they are
+            partitioned.shards[node.target_table].index.add(node)
+            partitioned._map(node.target_table, query_order)
+        return partitioned
+
+    @classmethod
+    def load_from_file(cls, sqg_filename: str="ssqlite.sqg"):
+        """Load the order map of partitioned SQG, leaving its shards until they are used"""
+        metrics = ssqlite.metrics.active
+        if metrics is not None:
+            start = time.perf_counter()
+        with open(get_sqg_filepath(sqg_filename), "rb") as f:
+            graph = pickle.load(f)
+        graph.sqg_filename = sqg_filename
+        if metrics is not None:
+            metrics.record("load", time.perf_counter() - start)
+        return graph
+
+    @classmethod
+    def save_to_file(cls, graph, sqg_filename: str="ssqlite.sqg") -> None:
+        """Save the shards which changed since they were loaded, then the order map"""
+        # Every shard goes to a new file, while the ones which weren't changed are already in their own
+        table_names = graph.dirty if sqg_filename == graph.sqg_filename else graph.table_names
+        for table_name in table_names:
+            # Shard is written aside first as well, so a crash never leaves a partial one
+            shard_filename = get_shard_filename(sqg_filename, graph.shard_ids[table_name])
+            tmp_filename = f"{shard_filename}-tmp"
+            SSqliteQueryGraph.save_to_file(graph=graph.get_shard(table_name), sqg_filename=tmp_filename)
+            os.replace(get_sqg_filepath(tmp_filename), get_sqg_filepath(shard_filename))
+
+        metrics = ssqlite.metrics.active
+        if metrics is not None:
+            start = time.perf_counter()
+        # Order map is written last and aside first, so it never points to a missing shard
+        tmp_filepath = get_sqg_filepath(f"{sqg_filename}-tmp")
+        with open(tmp_filepath, "wb") as f:
+            pickle.dump(graph, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filepath, get_sqg_filepath(sqg_filename))
+        if metrics is not None:
+            metrics.record("save", time.perf_counter() - start)
+        graph.sqg_filename = sqg_filename
+        graph.dirty.clear()
+
+    def _find_horizon(self, keep_last: int | None, keep_since: float | None) -> int:
+        horizon = self.horizon
+        if keep_last is not None:
+            horizon = max(horizon, self.last_order - keep_last + 1)
+        if keep_since is not None:
+            horizon = max(horizon, self.find_order_since(keep_since))
+        return horizon
+
+    def _set_horizon(self, horizon: int) -> None:
+        self.horizon = horizon
+        self.timeline = [entry for entry in self.timeline if entry[1] >= horizon]
+        if self.undo_cache is not None:
+            self.undo_cache.clear()
+
+    def prune(
+            self, keep_last: int | None=None, keep_since: float | None=None, collapse_updates: bool=False
+        ) -> int:
+        """Prune every shard as SSqliteQueryGraph.prune(), at the same horizon, and return the number of dropped nodes"""
+        horizon = self._find_horizon(keep_last, keep_since)
+        num_pruned = 0
+        for table_name in self.table_names:
+            shard = self.get_shard(table_name)
+            num_pruned += shard.prune(keep_last=shard.last_order - horizon + 1, collapse_updates=collapse_updates)
+            self.dirty.add(table_name)
+        self._set_horizon(horizon)
+        return num_pruned
+
+    @classmethod
+    def compact(
+            cls, sqg_filename: str="ssqlite.sqg", keep_last: int | None=None,
+            keep_since: float | None=None, collapse_updates: bool=False, workers: int=0
+        ) -> int:
+        """Prune the shards of partitioned .sqg file, each in a worker process with workers, and
+        return the number of dropped nodes"""
+        graph = cls.load_from_file(sqg_filename)
+        horizon = graph._find_horizon(keep_last, keep_since)
+        shard_filenames = [get_shard_filename(sqg_filename, shard_id) for shard_id in range(len(graph.table_names))]
+        if workers:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                num_pruned = sum(executor.map(
+                    prune_shard, shard_filenames, repeat(horizon), repeat(collapse_updates)
+                ))
+        else:
+            num_pruned = sum(prune_shard(shard_filename, horizon, collapse_updates) for shard_filename in shard_filenames)
+        graph._set_horizon(horizon)
+        cls.save_to_file(graph, sqg_filename)
+        return num_pruned
@@ -1,5 +1,243 @@
+import re
+import sqlite3
+import ssqlite.metrics
+import time
+
+from collections import OrderedDict, defaultdict
+from contextlib import closing
+from functools import lru_cache
+from typing import Iterable, NamedTuple
+
 from ssqlite.algo import SSqliteQueryGraph as SQG
+from ssqlite.algo import add_nodes, execute_many_query, execute_query, get_rowid_alias
+from ssqlite.index import NodeNotFound
 from ssqlite.node import *
+from ssqlite.utils import LITERAL, InvalidInstructionError, find_returning
+from ssqlite.utils import parse_insert_columns, parse_literal, parse_query_string, parse_update_literal
+from ssqlite.utils import quote_identifier
+from ssqlite.utils import split_row_values, split_values, strip_query
+
+
+# Maximum number of rows folded into a single batched undo statement
+UNDO_BATCH_SIZE = 500
+
+INSERT_VALUES_PATTERN = re.compile(
+    r"(?P<head>INSERT\s+INTO\s+.+?\s*VALUES\s*)(?P<values>\(.*\))",
+    flags=re.IGNORECASE | re.DOTALL
+)
+
+LITERAL_PATTERN = re.compile(LITERAL, flags=re.IGNORECASE)
+
+SELECT_TABLE_NAME = "SELECT name FROM sqlite_master WHERE type='table'"
+
+
+class UndoQuery(NamedTuple):
+    """Query of undo query set, as the SQL text shown for it and the statement which runs it,
+    once per row of parameters or as it is if there are none"""
+
+    text: str
+    query: str
+    parameters: list[tuple] = []
+
+
+def as_is(query_string: str) -> UndoQuery:
+    """Undo query which runs its text as it is, e.g. CREATE TABLE"""
+    return UndoQuery(query_string, query_string)
+
+
+def batch_rowid_queries(
+        head: str, primary_keys: list, parameters: tuple=(), text_head: str | None=None
+    ) -> list[UndoQuery]:
+    """Generate queries which run head with given parameters on given rows, shown batched
+    with WHERE rowid IN (...), and as text_head with the parameters written out if given"""
+    text_head = text_head or head
+    query = f"{head} WHERE rowid=?"
+    if len(primary_keys) == 1:
+        return [UndoQuery(f"{text_head} WHERE rowid={primary_keys[0]};", query, [(*parameters, primary_keys[0])])]
+
+    rowid_queries = []
+    for i in range(0, len(primary_keys), UNDO_BATCH_SIZE):
+        batch = primary_keys[i:i + UNDO_BATCH_SIZE]
+        rowids = ", ".join(str(primary_key) for primary_key in batch)
+        rowid_queries.append(UndoQuery(
+            f"{text_head} WHERE rowid IN ({rowids});", query, [(*parameters, primary_key) for primary_key in batch]
+        ))
+    return rowid_queries
+
+
+def batch_delete_queries(table_name: str, primary_keys: list) -> list[UndoQuery]:
+    """Generate DELETE queries for given rows"""
+    return batch_rowid_queries(f"DELETE FROM {table_name}", primary_keys)
+
+
+def batch_restore_queries(table_name: str, column_name: str, old_values: dict[str, list]) -> list[UndoQuery]:
+    """Generate UPDATE queries which set the column of given rows back to their old values"""
+    restore_queries = []
+    for old_value, primary_keys in old_values.items():
+        restore_queries += batch_rowid_queries(
+            f"UPDATE {table_name} SET {column_name}=?", primary_keys,
+            parameters=(parse_literal(old_value),), text_head=f"UPDATE {table_name} SET {column_name}={old_value}"
+        )
+    return restore_queries
+
+
+@lru_cache(maxsize=None)
+def get_table_schema(create_query: str) -> tuple[str | None, tuple[str, ...]] | None:
+    """Find rowid alias and columns of the table created by given query, by creating it in memory,
+    which is None if the query can't be run on its own or the table has no rowid"""
+    with closing(sqlite3.connect(":memory:")) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(create_query)
+            table_name = quote_identifier(cursor.execute(SELECT_TABLE_NAME).fetchone()[0])
+            cursor.execute(f"SELECT rowid FROM {table_name}")
+        except (sqlite3.Error, TypeError):
+            return None
+        columns = tuple(quote_identifier(name) for _, name, *_ in cursor.execute(f"PRAGMA table_info({table_name})"))
+        return get_rowid_alias(cursor, table_name), columns
+
+
+def restore_insert_query(graph: SQG, insert_node: InsertNode, create_node: CreateNode | None=None) -> str:
+    """Generate INSERT query which puts the row of given node back, giving the rowid
+    explicitly if SQLite assigned it, so that the row gets the same rowid again"""
+    query_string = insert_node.query_string
+    columns = parse_insert_columns(query_string)
+    if columns is not None and any(column.lower() in ("rowid", "oid", "_rowid_") for column in columns):
+        return query_string
+
+    match = INSERT_VALUES_PATTERN.fullmatch(strip_query(query_string))
+    if match is None or re.search(r"\bON\s+CONFLICT\b", match.group("values"), re.IGNORECASE):
+        return query_string
+    values = split_row_values(match.group("values"))
+    if values is None:
+        return query_string
+    if create_node is None:
+        create_node = graph.index.find_parent(insert_node)
+    schema = get_table_schema(create_node.query_string)
+    if schema is None:
+        return query_string
+    rowid_alias, table_columns = schema
+    if columns is None:
+        if rowid_alias is not None:
+            return query_string
+        columns = list(table_columns)
+    elif rowid_alias in (column.lower() for column in columns):
+        return query_string
+    else:
+        columns = [quote_identifier(column) for column in columns]
+    if len(values) != len(columns):
+        return query_string
+    return (
+        f"INSERT INTO {insert_node.target_table}(rowid, {', '.join(columns)}) "
+        f"VALUES({insert_node.primary_key}, {', '.join(values)});"
+    )
+
+
+def batch_insert_queries(graph: SQG, insert_nodes: list[InsertNode]) -> list[UndoQuery]:
+    """Generate INSERT queries for given nodes, merging consecutive single-row
+    inserts that share the same column list into multi-row INSERT statements"""
+    return batch_insert_statements([restore_insert_query(graph, insert_node) for insert_node in insert_nodes])
+
+
+def insert_undo_query(text: str, head: str, batch_values: list[str]) -> UndoQuery:
+    """Undo query of INSERT of given VALUES, which is run as a parameterized statement
+    once per row if the column list is given and every value is a literal"""
+    rows = []
+    for values in batch_values:
+        rows += split_values(values) or [None]
+    if (
+        parse_insert_columns(head) is None or None in rows or len({len(row) for row in rows}) != 1
+        or not all(LITERAL_PATTERN.fullmatch(value) for row in rows for value in row)
+    ):
+        return as_is(text)
+    placeholders = ", ".join("?" * len(rows[0]))
+    return UndoQuery(
+        text, f"{head.rstrip()}({placeholders})", [tuple(parse_literal(value) for value in row) for row in rows]
+    )
+
+
+def batch_insert_statements(query_strings: list[str]) -> list[UndoQuery]:
+    """Merge consecutive single-row INSERT statements that share the same column list
+    into multi-row INSERT statements"""
+    if len(query_strings) == 1:
+        match = INSERT_VALUES_PATTERN.fullmatch(strip_query(query_strings[0]))
+        if match is None:
+            return [as_is(query_strings[0])]
+        return [insert_undo_query(query_strings[0], match.group("head"), [match.group("values")])]
+
+    insert_queries = []
+    batch_head, batch_values = None, []
+    for query_string in query_strings:
+        match = INSERT_VALUES_PATTERN.fullmatch(strip_query(query_string))
+        if match is None or re.search(r"\bON\s+CONFLICT\b", match.group("values"), re.IGNORECASE):
+            head, values = None, query_string
+        else:
+            head, values = match.group("head"), match.group("values")
+        # Flush the current batch when the column list changes or the batch is full
+        if batch_values and (head is None or head != batch_head or len(batch_values) >= UNDO_BATCH_SIZE):
+            insert_queries.append(insert_undo_query(f"{batch_head}{', '.join(batch_values)};", batch_head, batch_values))
+            batch_head, batch_values = None, []
+        if head is None:
+            insert_queries.append(as_is(values))
+        else:
+            batch_head = head
+            batch_values.append(values)
+    if batch_values:
+        insert_queries.append(insert_undo_query(f"{batch_head}{', '.join(batch_values)};", batch_head, batch_values))
+
+    return insert_queries
+
+
+def coalesce_insert_query(insert_query: str, insert_node: InsertNode, update_nodes: list[UpdateNode]) -> str | None:
+    """Fold the last updates of a row into the INSERT query restoring it, so that a single statement
+    restores the final values of the row, or None if the INSERT or any update can't be folded"""
+    query_string = strip_query(insert_query)
+    match = INSERT_VALUES_PATTERN.fullmatch(query_string)
+    columns = parse_insert_columns(query_string)
+    if match is None or columns is None:
+        return None
+    values = split_row_values(match.group("values"))
+    if values is None or len(values) != len(columns):
+        return None
+
+    positions = {column.lower(): idx for idx, column in enumerate(columns)}
+    for update_node in update_nodes:
+        assignment = parse_update_literal(update_node.query_string)
+        if assignment is None:
+            return None
+        column, value = assignment
+        idx = positions.get(column.lower())
+        # Column left to its default by the INSERT
+        if idx is None:
+            positions[column.lower()] = len(columns)
+            columns.append(column)
+            values.append(value)
+        else:
+            values[idx] = value
+    return f"INSERT INTO {insert_node.target_table}({', '.join(columns)}) VALUES({', '.join(values)});"
+
+
+def coalesce_insert_queries(
+        graph: SQG, insert_nodes: list[InsertNode], create_node: CreateNode | None=None
+    ) -> list[UndoQuery]:
+    """Generate queries which restore given rows with their final values, as multi-row INSERTs
+    of the folded rows followed by the updates of the rows which couldn't be folded"""
+    insert_queries = []
+    replayed_updates = {}
+    for insert_node in insert_nodes:
+        update_nodes = list(graph.index.find_last_updates(insert_node).values())
+        insert_query = restore_insert_query(graph, insert_node, create_node)
+        coalesced_query = coalesce_insert_query(insert_query, insert_node, update_nodes)
+        if coalesced_query is not None:
+            insert_queries.append(coalesced_query)
+            continue
+        insert_queries.append(insert_query)
+        for update_node in update_nodes:
+            replayed_updates.setdefault(update_node.query_order, (update_node, []))[1].append(insert_node.primary_key)
+
+    undo_query_set  = batch_insert_statements(insert_queries)
+    undo_query_set += replay_update_queries(replayed_updates)
+    return undo_query_set
 
 
 def generate_undo_query_create(node: CreateNode):
@@ -7,7 +245,7 @@ def generate_undo_query_create(node: CreateNode):
     if node.flag_drop:
         return []
     # 2. Otherwise, generate corresponding DROP query
-    drop_query = f"DROP TABLE {node.target_table};"
+    drop_query = as_is(f"DROP TABLE {node.target_table};")
     undo_query_set = [drop_query]
 
     return undo_query_set
@@ -18,94 +256,530 @@ def generate_undo_query_insert(node: InsertNode):
     if node.flag_delete:
         return []
     # 2. Otherwise, generate corresponding DELETE query
-    delete_query = f"DELETE FROM {node.target_table} WHERE rowid={node.primary_key};"
-    undo_query_set = [delete_query]
+    undo_query_set = batch_delete_queries(table_name=node.target_table, primary_keys=[node.primary_key])
     return undo_query_set
 
 
 def generate_undo_query_update(graph: SQG, node: UpdateNode):
     # 1. Check whether corresponding row is deleted or not
-    corr_insert_node = graph.index.find(
-        _from="insert",
-        _key=f"{node.target_table}-{node.primary_key}"
+    corr_insert_node = graph.index.find_prev_insert(
+        table_name=node.target_table,
+        primary_key=node.primary_key,
+        query_order=node.query_order
     )
     if corr_insert_node.flag_delete:
         return []
-    
-    parent_node = node.get_parent()
-    # 2. Otherwise, if it's parent is an UpdateNode, just execute its query
+    # 2. If the old value was captured, just set it back
+    if node.old_value is not None:
+        return batch_restore_queries(
+            table_name=node.target_table,
+            column_name=node.target_column,
+            old_values={node.old_value: [node.primary_key]}
+        )
+
+    parent_node = graph.index.find_parent(node)
+    # 3. Otherwise, if it's parent is an UpdateNode, just execute its query on the row
     if isinstance(parent_node, UpdateNode):
-        undo_query_set = [parent_node.query_string]
-    # 3. If it's parent is an InsertNode, delete the row and execute the insert statement again
+        undo_query_set = replay_update_queries({parent_node.query_order: (parent_node, [node.primary_key])})
+    # 4. If it's parent is an InsertNode, delete the row and execute the insert statement again
     elif isinstance(parent_node, InsertNode):
-        delete_query = f"DELETE FROM {node.target_table} WHERE rowid={node.primary_key};"
-        insert_query = corr_insert_node.query_string
-        undo_query_set = [delete_query, insert_query]
-    # 4. Exception Handler
+        undo_query_set  = batch_delete_queries(table_name=node.target_table, primary_keys=[node.primary_key])
+        undo_query_set += batch_insert_statements([restore_insert_query(graph, corr_insert_node)])
+    # 5. Exception Handler
     else:
         raise InvalidParent(f"UpdateNode cannot have {type(parent_node)} as its parent")
 
     return undo_query_set
 
 
-def generate_undo_query_drop(graph: SQG, node: DropNode):
+def generate_undo_query_multi_update(graph: SQG, node: MultiUpdateNode):
+    reinsert_nodes = []
+    prev_update_nodes = {}
+    old_values = {}
+    for idx, primary_key in enumerate(node.primary_keys):
+        # 1. Skip rows which are deleted
+        corr_insert_node = graph.index.find_prev_insert(
+            table_name=node.target_table,
+            primary_key=primary_key,
+            query_order=node.query_order
+        )
+        if corr_insert_node.flag_delete:
+            continue
+        # 2. Rows whose old value was captured are set back to it
+        if node.old_values is not None:
+            old_values.setdefault(node.old_values[idx], []).append(primary_key)
+            continue
+        # 3. Rows whose parent is an UpdateNode only need that query executed again
+        prev_update_node = graph.index.find_current_update(
+            corr_insert_node, node.target_column, query_order=node.query_order
+        )
+        if prev_update_node is not None:
+            prev_update_nodes.setdefault(prev_update_node.query_order, (prev_update_node, []))[1].append(primary_key)
+        # 4. Rows whose parent is an InsertNode are deleted and inserted again
+        else:
+            reinsert_nodes.append(corr_insert_node)
+
+    undo_query_set = batch_restore_queries(
+        table_name=node.target_table,
+        column_name=node.target_column,
+        old_values=old_values
+    )
+    if reinsert_nodes:
+        undo_query_set += batch_delete_queries(
+            table_name=node.target_table,
+            primary_keys=[insert_node.primary_key for insert_node in reinsert_nodes]
+        )
+        undo_query_set += batch_insert_queries(graph, reinsert_nodes)
+    undo_query_set += replay_update_queries(prev_update_nodes)
+    return undo_query_set
+
+
+def generate_undo_query_drop(graph: SQG, node: DropNode, coalesce: bool=False):
     # 1. Find corresponding CreateNode(=parent)
-    create_node = node.get_parent()
+    create_node = graph.index.find_parent(node)
     # 2. Find all following inserts which were not deleted(flag_delete=False)
-    insert_nodes = []
-    for child in create_node.children:
-        if isinstance(child, InsertNode) and not child.flag_delete:
-            insert_nodes.append(child)
+    insert_nodes = graph.index.find_live_inserts(create_node)
+    if coalesce:
+        return [as_is(create_node.query_string)] + coalesce_insert_queries(graph, insert_nodes, create_node)
     # 3. Find all following updates(only the last ones)
-    last_update_nodes = []
+    last_update_nodes = {}
     for insert_node in insert_nodes:
-        updated_columns = insert_node.get_all_updated_columns()
-        for column in updated_columns:
-            last_update = graph.index.find_last_update(
-                table_name=insert_node.target_table,
-                primary_key=insert_node.primary_key,
-                column_name=column
-            )
-            if last_update is not None:
-                last_update_nodes.append(last_update)
+        for last_update in graph.index.find_last_updates(insert_node).values():
+            # MultiUpdateNode may be the last update of several rows
+            last_update_nodes.setdefault(last_update.query_order, (last_update, []))[1].append(insert_node.primary_key)
     # 4. Run'em all
-    undo_query_set  = [create_node.query_string]
-    undo_query_set += [insert_node.query_string for insert_node in insert_nodes]
-    undo_query_set += [update_node.query_string for update_node in last_update_nodes]
+    undo_query_set = [as_is(create_node.query_string)]
+    for insert_node in insert_nodes:
+        undo_query_set += batch_insert_statements([restore_insert_query(graph, insert_node, create_node)])
+    undo_query_set += replay_update_queries(last_update_nodes)
     return undo_query_set
 
-def generate_undo_query_delete(graph: SQG, node: DeleteNode):
+def generate_undo_query_delete(graph: SQG, node: DeleteNode, coalesce: bool=False):
     # 1. Find corresponding InsertNode(=parent)
-    insert_node = node.get_parent()
+    insert_node = graph.index.find_parent(node)
+    if coalesce:
+        return coalesce_insert_queries(graph, [insert_node])
     # 2. Find all following updates
-    update_nodes = []
-    updated_columns = insert_node.get_all_updated_columns()
-    for column in updated_columns:
-        last_update = graph.index.find_last_update(
-            table_name=node.target_table,
-            primary_key=node.primary_key,
-            column_name=column
+    update_nodes = {
+        update_node.query_order: (update_node, [insert_node.primary_key])
+        for update_node in graph.index.find_last_updates(insert_node).values()
+    }
+
+    undo_query_set  = batch_insert_statements([restore_insert_query(graph, insert_node)])
+    undo_query_set += replay_update_queries(update_nodes)
+    return undo_query_set
+
+
+def generate_undo_query_multi_delete(graph: SQG, node: MultiDeleteNode, coalesce: bool=False):
+    # 1. Find the InsertNode of every deleted row, rather than of a row which took its rowid over since
+    insert_nodes = [
+        graph.index.find_prev_insert(
+            table_name=node.target_table, primary_key=primary_key, query_order=node.query_order
         )
-        update_nodes.append(last_update)
-    
-    undo_query_set = [insert_node.query_string] + [update_node.query_string for update_node in update_nodes]
+        for primary_key in node.primary_keys
+    ]
+    if coalesce:
+        return coalesce_insert_queries(graph, insert_nodes)
+    # 2. Find all following updates of every row
+    update_nodes = {}
+    for insert_node in insert_nodes:
+        for last_update in graph.index.find_last_updates(insert_node).values():
+            update_nodes.setdefault(last_update.query_order, (last_update, []))[1].append(insert_node.primary_key)
+
+    undo_query_set  = batch_insert_queries(graph, insert_nodes)
+    undo_query_set += replay_update_queries(update_nodes)
     return undo_query_set
 
 
-def generate_undo_query(graph: SQG, query_order: int) -> list[str]:
-    """Generate undo query set"""
+def plan_undo_query(graph: SQG, query_order: int, coalesce: bool=False) -> list[UndoQuery]:
+    """Generate undo query set, as the statements which run it
+
+    With coalesce=True, rows restored by undoing DROP/DELETE are inserted along with
+    the last updates of their columns, as multi-row INSERTs of their final values.
+    """
     undo_query_set = []
     target_node = graph.index.find_by_order(query_order=query_order)
-    
+    metrics = ssqlite.metrics.active
+    if metrics is not None:
+        start = time.perf_counter()
+
     if isinstance(target_node, CreateNode):
         undo_query_set = generate_undo_query_create(target_node)
     elif isinstance(target_node, InsertNode):
         undo_query_set = generate_undo_query_insert(target_node)
+    elif isinstance(target_node, MultiUpdateNode):
+        undo_query_set = generate_undo_query_multi_update(graph, target_node)
     elif isinstance(target_node, UpdateNode):
         undo_query_set = generate_undo_query_update(graph, target_node)
     elif isinstance(target_node, DropNode):
-        undo_query_set = generate_undo_query_drop(graph, target_node)
+        undo_query_set = generate_undo_query_drop(graph, target_node, coalesce)
+    elif isinstance(target_node, MultiDeleteNode):
+        undo_query_set = generate_undo_query_multi_delete(graph, target_node, coalesce)
     elif isinstance(target_node, DeleteNode):
-        undo_query_set = generate_undo_query_delete(graph, target_node)
+        undo_query_set = generate_undo_query_delete(graph, target_node, coalesce)
+
+    if metrics is not None:
+        metrics.record(f"undo.{type(target_node).__name__}", time.perf_counter() - start)
+    return undo_query_set
+
+
+def generate_undo_query(graph: SQG, query_order: int, coalesce: bool=False) -> list[str]:
+    """Generate undo query set, as SQL text"""
+    return [undo_query.text for undo_query in plan_undo_query(graph, query_order=query_order, coalesce=coalesce)]
+
+
+class UndoCache(object):
+    """LRU cache of undo query sets keyed by query order
+
+    An added node evicts the undo query sets of the nodes which touch the same rows or table.
+    """
+
+    def __init__(self, graph: SQG, maxsize: int=128):
+        self.graph = graph
+        self.maxsize = maxsize
+        # (query_order, coalesce) to (undo query set, keys it depends on), least recently used first
+        self.undo_query_sets = OrderedDict()
+        # (table,) for anything in the table, (table, None) for CREATE/DROP and (table, rowid) for rows
+        self.dependents = defaultdict(set)
+        self.hits, self.misses = 0, 0
+        graph.undo_cache = self
+
+    def get(self, query_order: int, coalesce: bool=False) -> list[str]:
+        """Get undo query set of given query order, generating it on a miss"""
+        key = (query_order, coalesce)
+        entry = self.undo_query_sets.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.undo_query_sets.move_to_end(key)
+            return list(entry[0])
+
+        self.misses += 1
+        undo_query_set = generate_undo_query(self.graph, query_order=query_order, coalesce=coalesce)
+        node = self.graph.index.find_by_order(query_order=query_order)
+        if isinstance(node, CreateNode):
+            dependencies = [(node.target_table, None)]
+        elif isinstance(node, DropNode):
+            dependencies = [(node.target_table,)]
+        elif isinstance(node, (MultiUpdateNode, MultiDeleteNode)):
+            dependencies = [(node.target_table, None)]
+            dependencies += [(node.target_table, primary_key) for primary_key in node.primary_keys]
+        else:
+            dependencies = [(node.target_table, None), (node.target_table, node.primary_key)]
+
+        self.undo_query_sets[key] = (undo_query_set, dependencies)
+        for dependency in dependencies:
+            self.dependents[dependency].add(key)
+        if len(self.undo_query_sets) > self.maxsize:
+            self.evict(next(iter(self.undo_query_sets)))
+        return list(undo_query_set)
+
+    def evict(self, key: tuple) -> None:
+        """Drop a cached undo query set"""
+        _, dependencies = self.undo_query_sets.pop(key)
+        for dependency in dependencies:
+            keys = self.dependents[dependency]
+            keys.discard(key)
+            if not keys:
+                del self.dependents[dependency]
+
+    def invalidate(self, node: SSqliteNode) -> None:
+        """Drop the cached undo query sets which depend on what node touches"""
+        dependencies = [(node.target_table,)]
+        if isinstance(node, (CreateNode, DropNode)):
+            dependencies.append((node.target_table, None))
+        elif isinstance(node, (MultiUpdateNode, MultiDeleteNode)):
+            dependencies += [(node.target_table, primary_key) for primary_key in node.primary_keys]
+        else:
+            dependencies.append((node.target_table, node.primary_key))
+
+        for dependency in dependencies:
+            for key in list(self.dependents.get(dependency, ())):
+                self.evict(key)
+
+    def clear(self) -> None:
+        """Drop every cached undo query set"""
+        self.undo_query_sets.clear()
+        self.dependents.clear()
+
+
+def find_insert_before(graph: SQG, table_name: str, primary_key: int, from_order: int) -> InsertNode:
+    """Find the InsertNode of the row which had given rowid right before from_order"""
+    # Row may have been deleted and inserted again with the same rowid since
+    return graph.index.find_prev_insert(table_name=table_name, primary_key=primary_key, query_order=from_order)
+
+
+def replayed_query_string(update_node: UpdateNode) -> str:
+    """Query string of UPDATE to replay, without RETURNING clause whose rows nobody reads"""
+    query_string = update_node.query_string
+    returning = find_returning(query_string)
+    if returning < 0:
+        return query_string
+    return f"{query_string[:returning].rstrip()};"
+
+
+def restrict_update_queries(update_node: UpdateNode, primary_keys: list) -> list[UndoQuery]:
+    """Rewrite the WHERE clause of UPDATE query, so that it only touches given rows"""
+    query_string = strip_query(replayed_query_string(update_node))
+    condition = parse_query_string(query_string).condition
+    if not query_string.endswith(condition):
+        return [as_is(replayed_query_string(update_node))]
+    head = query_string[:len(query_string) - len(condition)].rstrip()
+    # Literal which is the only assignment is a parameter, so rows of every value share the statement
+    assignment = parse_update_literal(query_string)
+    if assignment is None or head.split(None, 2)[1].upper() == "OR":
+        return batch_rowid_queries(head, primary_keys)
+    column, value = assignment
+    return batch_rowid_queries(
+        f"UPDATE {update_node.target_table} SET {column}=?", primary_keys,
+        parameters=(parse_literal(value),), text_head=head
+    )
+
+
+def replay_update_queries(update_rows: dict[int, tuple[UpdateNode, list]]) -> list[UndoQuery]:
+    """Generate the queries of updates to replay, keyed by query order along with the rows to
+    replay them on, so that a MultiUpdateNode doesn't touch any other row matching its WHERE"""
+    update_queries = []
+    for order in sorted(update_rows):
+        update_node, primary_keys = update_rows[order]
+        if isinstance(update_node, MultiUpdateNode):
+            update_queries += restrict_update_queries(update_node, sorted(primary_keys))
+        else:
+            update_queries.append(as_is(replayed_query_string(update_node)))
+    return update_queries
 
+
+def restore_row_queries(graph: SQG, insert_node: InsertNode, from_order: int) -> tuple[str, list[UpdateNode]]:
+    """Generate INSERT query of the row as it was before from_order, along with the
+    updates to replay after it if they can't be folded into the INSERT"""
+    update_nodes = []
+    for column in graph.index.find_updated_columns(insert_node):
+        update_node = graph.index.find_current_update(insert_node, column, query_order=from_order)
+        if update_node is not None:
+            update_nodes.append(update_node)
+
+    insert_query = restore_insert_query(graph, insert_node)
+    coalesced_query = coalesce_insert_query(insert_query, insert_node, update_nodes)
+    if coalesced_query is not None:
+        return coalesced_query, []
+    return insert_query, update_nodes
+
+
+def find_value_before(graph: SQG, node: UpdateNode, idx: int, insert_node: InsertNode) -> str | None:
+    """Find the value the column had before node updated the idx-th row of it, as an SQL literal"""
+    if isinstance(node, MultiUpdateNode):
+        primary_key = node.primary_keys[idx]
+        old_value = None if node.old_values is None else node.old_values[idx]
+    else:
+        primary_key, old_value = node.primary_key, node.old_value
+    if old_value is not None:
+        return old_value
+
+    update_node = graph.index.find_current_update(insert_node, node.target_column, query_order=node.query_order)
+    if update_node is not None:
+        assignment = parse_update_literal(update_node.query_string)
+        return None if assignment is None else assignment[1]
+
+    # Column still holds the value it was inserted with
+    query_string = strip_query(insert_node.query_string)
+    match = INSERT_VALUES_PATTERN.fullmatch(query_string)
+    columns = parse_insert_columns(query_string)
+    if match is None or columns is None:
+        return None
+    values = split_row_values(match.group("values"))
+    if values is None or len(values) != len(columns):
+        return None
+    positions = {column.lower(): idx for idx, column in enumerate(columns)}
+    idx = positions.get(node.target_column.lower())
+    if idx is None or LITERAL_PATTERN.fullmatch(values[idx]) is None:
+        return None
+    return values[idx]
+
+
+def plan_undo_range(graph: SQG, from_order: int, to_order: int | None=None) -> list[UndoQuery]:
+    """Generate a single undo query set which reverts every node from from_order to to_order,
+    as the statements which run it"""
+    if to_order is None:
+        to_order = graph.last_order
+    if from_order < graph.index.horizon:
+        raise NodeNotFound(f"Nodes before query order [{graph.index.horizon}] were pruned")
+    metrics = ssqlite.metrics.active
+    if metrics is not None:
+        start = time.perf_counter()
+
+    # 1. Walk the range backwards, so the first change seen is the last one made
+    first_table_nodes, last_table_nodes = {}, {}
+    first_row_nodes, last_row_nodes = {}, {}
+    first_column_updates, first_delete_nodes = {}, {}
+    table_rows = {}
+    for query_order in range(to_order, from_order - 1, -1):
+        try:
+            node = graph.index.find_by_order(query_order=query_order)
+        except NodeNotFound:
+            continue
+        if isinstance(node, (CreateNode, DropNode)):
+            last_table_nodes.setdefault(node.target_table, node)
+            first_table_nodes[node.target_table] = node
+            # Rows changed since belong to a table which is dropped by the undo anyway
+            for row in table_rows.pop(node.target_table, ()):
+                del first_row_nodes[row], last_row_nodes[row]
+                first_column_updates.pop(row, None)
+                first_delete_nodes.pop(row, None)
+            continue
+
+        if isinstance(node, (MultiUpdateNode, MultiDeleteNode)):
+            primary_keys = node.primary_keys
+        else:
+            primary_keys = [node.primary_key]
+        for idx, primary_key in enumerate(primary_keys):
+            row = (node.target_table, primary_key)
+            table_rows.setdefault(node.target_table, set()).add(row)
+            last_row_nodes.setdefault(row, node)
+            first_row_nodes[row] = node
+            if isinstance(node, UpdateNode):
+                first_column_updates.setdefault(row, {})[node.target_column] = (node, idx)
+            elif isinstance(node, DeleteNode):
+                first_delete_nodes[row] = node
+
+    # 2. Tables created since are dropped, and tables dropped since are created again with their rows
+    drop_queries, table_queries = [], []
+    insert_nodes = []
+    for table_name, first_node in first_table_nodes.items():
+        if isinstance(last_table_nodes[table_name], CreateNode):
+            drop_queries.append(as_is(f"DROP TABLE {table_name};"))
+        if isinstance(first_node, CreateNode):
+            continue
+        create_node = graph.index.find_parent(first_node)
+        table_queries.append(as_is(create_node.query_string))
+        # Rows which weren't changed since, and the ones which were but existed before
+        rows = {
+            insert_node.primary_key: insert_node for insert_node in graph.index.find_live_inserts(create_node)
+            if insert_node.query_order < from_order
+        }
+        for row in table_rows.get(table_name, ()):
+            node = first_row_nodes[row]
+            if not isinstance(node, InsertNode) and row[1] not in rows:
+                rows[row[1]] = find_insert_before(graph, table_name, row[1], from_order)
+        insert_nodes += [rows[primary_key] for primary_key in sorted(rows)]
+
+    # 3. Rows of the other tables are deleted, inserted again or have their columns set back
+    delete_rows, old_values = {}, {}
+    for row, first_node in first_row_nodes.items():
+        table_name, primary_key = row
+        if table_name in first_table_nodes:
+            continue
+        existed_before = not isinstance(first_node, InsertNode)
+        exists_after = not isinstance(last_row_nodes[row], DeleteNode)
+        if not existed_before:
+            if exists_after:
+                delete_rows.setdefault(table_name, []).append(primary_key)
+            continue
+
+        insert_node = find_insert_before(graph, table_name, primary_key, from_order)
+        if exists_after and row not in first_delete_nodes:
+            # Columns are set back one by one if all of their old values are known
+            values = {
+                column: find_value_before(graph, node, idx, insert_node)
+                for column, (node, idx) in first_column_updates[row].items()
+            }
+            if None not in values.values():
+                for column, value in values.items():
+                    old_values.setdefault((table_name, column), {}).setdefault(value, []).append(primary_key)
+                continue
+        if exists_after:
+            delete_rows.setdefault(table_name, []).append(primary_key)
+        insert_nodes.append(insert_node)
+
+    # 4. Put the plan together, so every row is deleted before it is inserted again
+    undo_query_set = drop_queries
+    for table_name, primary_keys in delete_rows.items():
+        undo_query_set += batch_delete_queries(table_name=table_name, primary_keys=sorted(primary_keys))
+    undo_query_set += table_queries
+
+    insert_queries, replayed_updates = [], {}
+    for insert_node in insert_nodes:
+        insert_query, update_nodes = restore_row_queries(graph, insert_node, from_order)
+        insert_queries.append(insert_query)
+        for update_node in update_nodes:
+            replayed_updates.setdefault(update_node.query_order, (update_node, []))[1].append(insert_node.primary_key)
+    undo_query_set += batch_insert_statements(insert_queries)
+    # Updates which couldn't be folded only touch the restored rows
+    for order in sorted(replayed_updates):
+        update_node, primary_keys = replayed_updates[order]
+        undo_query_set += restrict_update_queries(update_node, sorted(primary_keys))
+
+    for (table_name, column_name), values in old_values.items():
+        undo_query_set += batch_restore_queries(table_name=table_name, column_name=column_name, old_values=values)
+    if metrics is not None:
+        metrics.record("undo.range", time.perf_counter() - start)
     return undo_query_set
+
+
+def generate_undo_range(graph: SQG, from_order: int, to_order: int | None=None) -> list[str]:
+    """Generate a single undo query set which reverts every node from from_order to to_order, as SQL text"""
+    return [undo_query.text for undo_query in plan_undo_range(graph, from_order=from_order, to_order=to_order)]
+
+
+def rollback_to(graph: SQG, query_order: int) -> list[str]:
+    """Generate a single undo query set which reverts every node after query_order"""
+    return generate_undo_range(graph, from_order=query_order + 1)
+
+
+def apply_undo(
+        conn: sqlite3.Connection, graph: SQG, query_orders: int | Iterable[int], record: bool=True,
+        capture_old_values: bool=False
+    ) -> list[SSqliteNode]:
+    """Undo given query order, or a contiguous range of them, in a single transaction
+
+    With record=False, the undo is not recorded, so the graph no longer matches the database.
+    """
+    # 1. Plan the undo
+    if isinstance(query_orders, int):
+        undo_query_set = plan_undo_query(graph, query_order=query_orders)
+    else:
+        query_orders = sorted(set(query_orders))
+        if not query_orders:
+            return []
+        if query_orders[-1] - query_orders[0] + 1 != len(query_orders):
+            raise ValueError("Query orders to undo must be contiguous")
+        undo_query_set = plan_undo_range(graph, from_order=query_orders[0], to_order=query_orders[-1])
+
+    # 2. Run it in a single transaction, recording a node for every executed row
+    cursor = conn.cursor()
+    nodes = []
+    owns_transaction = not conn.in_transaction
+    cursor.execute("BEGIN" if owns_transaction else "SAVEPOINT ssqlite_undo")
+    try:
+        first_order = graph.last_order + 1
+        for _, query, seq_of_parameters in undo_query_set:
+            if not record:
+                if seq_of_parameters:
+                    cursor.executemany(query, seq_of_parameters)
+                else:
+                    cursor.execute(query)
+                continue
+            try:
+                if seq_of_parameters:
+                    nodes.extend(execute_many_query(
+                        cursor, query, first_order + len(nodes), seq_of_parameters, capture_old_values
+                    ))
+                else:
+                    node = execute_query(cursor, query, first_order + len(nodes), capture_old_values=capture_old_values)
+                    if node is not None:
+                        nodes.append(node)
+            except InvalidInstructionError:
+                cursor.execute(query)
+
+        # 3. Nodes go first, so the in-database graph is written in the same transaction
+        add_nodes(graph, nodes)
+    except Exception:
+        if owns_transaction:
+            conn.rollback()
+        else:
+            cursor.execute("ROLLBACK TO ssqlite_undo")
+            cursor.execute("RELEASE ssqlite_undo")
+        raise
+    if owns_transaction:
+        conn.commit()
+    else:
+        cursor.execute("RELEASE ssqlite_undo")
+    return nodes
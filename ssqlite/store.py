@@ -0,0 +1,376 @@
+import sqlite3
+
+from array import array
+
+from ssqlite.index import Index, NodeNotFound
+from ssqlite.node import SSqliteNode, CreateNode, InsertNode, UpdateNode, DropNode, DeleteNode
+from ssqlite.node import MultiUpdateNode, MultiDeleteNode, OrphanError
+from ssqlite.node import NODE_CLASSES, NODE_TYPE_CODES
+
+
+CREATE_CODE = NODE_TYPE_CODES[CreateNode]
+INSERT_CODE = NODE_TYPE_CODES[InsertNode]
+
+# Node types stored for each kind of lookup of Index.find
+FIND_CODES = {
+    "create": (CREATE_CODE, CREATE_CODE),
+    "insert": (INSERT_CODE, INSERT_CODE),
+    "drop": (NODE_TYPE_CODES[DropNode], NODE_TYPE_CODES[DropNode]),
+    "delete": (NODE_TYPE_CODES[DeleteNode], NODE_TYPE_CODES[MultiDeleteNode]),
+}
+
+MAX_ORDER = 2 ** 63 - 1
+
+# Maximum number of rowids bound to a single IN (...) lookup
+ROWID_CHUNK_SIZE = 500
+
+# Nodes themselves, and an "edge" from every node to each (table, rowid, column) it touches.
+# Inserts and deletes touch the empty column of a row.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS _ssqlite_nodes (
+    query_order INTEGER PRIMARY KEY,
+    node_type INTEGER NOT NULL,
+    query_string TEXT NOT NULL,
+    target_table TEXT NOT NULL,
+    target_column TEXT NOT NULL,
+    primary_key INTEGER,
+    parent_order INTEGER,
+    flag INTEGER NOT NULL DEFAULT 0,
+    old_value TEXT
+);
+CREATE INDEX IF NOT EXISTS _ssqlite_nodes_table ON _ssqlite_nodes(target_table, node_type);
+CREATE INDEX IF NOT EXISTS _ssqlite_nodes_parent ON _ssqlite_nodes(parent_order);
+CREATE TABLE IF NOT EXISTS _ssqlite_rows (
+    target_table TEXT NOT NULL,
+    primary_key INTEGER NOT NULL,
+    target_column TEXT NOT NULL,
+    query_order INTEGER NOT NULL,
+    node_type INTEGER NOT NULL,
+    old_value TEXT,
+    PRIMARY KEY (target_table, primary_key, target_column, query_order)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS _ssqlite_rows_order ON _ssqlite_rows(query_order);
+"""
+
+# Columns added to the shadow tables after they were first released
+NODE_COLUMNS = "query_order, node_type, query_string, target_table, target_column, primary_key, flag, old_value"
+
+INSERT_NODE = """
+INSERT INTO _ssqlite_nodes(
+    query_order, node_type, query_string, target_table, target_column, primary_key, parent_order, old_value
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+INSERT_ROW = """
+INSERT INTO _ssqlite_rows(target_table, primary_key, target_column, query_order, node_type, old_value)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+SET_FLAG = "UPDATE _ssqlite_nodes SET flag=1 WHERE query_order=?"
+
+SELECT_BY_ORDER = f"SELECT {NODE_COLUMNS} FROM _ssqlite_nodes WHERE query_order=?"
+SELECT_PARENT_ORDER = "SELECT parent_order FROM _ssqlite_nodes WHERE query_order=?"
+SELECT_BY_TABLE = f"""
+SELECT {NODE_COLUMNS} FROM _ssqlite_nodes
+WHERE target_table=? AND node_type IN (?, ?) ORDER BY query_order DESC LIMIT 1
+"""
+SELECT_BY_ROW = f"""
+SELECT {NODE_COLUMNS} FROM _ssqlite_nodes WHERE query_order=(
+    SELECT query_order FROM _ssqlite_rows
+    WHERE target_table=? AND primary_key=? AND target_column='' AND node_type IN (?, ?)
+    ORDER BY query_order DESC LIMIT 1
+)
+"""
+SELECT_PREV_INSERT = f"""
+SELECT {NODE_COLUMNS} FROM _ssqlite_nodes WHERE query_order=(
+    SELECT query_order FROM _ssqlite_rows
+    WHERE target_table=? AND primary_key=? AND target_column='' AND node_type=? AND query_order<?
+    ORDER BY query_order DESC LIMIT 1
+)
+"""
+# Updates of a row are the ones before the next row which took its rowid over
+NEXT_INSERT_ORDER = f"""
+    COALESCE((
+        SELECT MIN(query_order) FROM _ssqlite_rows
+        WHERE target_table=:table AND primary_key=:rowid AND target_column='' AND node_type={INSERT_CODE}
+        AND query_order>:order
+    ), {MAX_ORDER})
+"""
+SELECT_UPDATES = f"""
+SELECT {NODE_COLUMNS} FROM _ssqlite_nodes WHERE query_order IN (
+    SELECT query_order FROM _ssqlite_rows
+    WHERE target_table=? AND primary_key=? AND target_column=?
+) ORDER BY query_order
+"""
+SELECT_LAST_UPDATE = f"""
+SELECT {NODE_COLUMNS} FROM _ssqlite_nodes WHERE query_order=(
+    SELECT query_order FROM _ssqlite_rows
+    WHERE target_table=? AND primary_key=? AND target_column=? AND query_order<?
+    ORDER BY query_order DESC LIMIT 1
+)
+"""
+SELECT_LIVE_INSERTS = f"""
+SELECT {NODE_COLUMNS} FROM _ssqlite_nodes
+WHERE parent_order=? AND node_type=? AND flag=0 ORDER BY query_order
+"""
+SELECT_UPDATED_COLUMNS = f"""
+SELECT DISTINCT target_column FROM _ssqlite_rows
+WHERE target_table=:table AND primary_key=:rowid AND target_column!='' AND query_order>:order
+AND query_order<{NEXT_INSERT_ORDER}
+"""
+SELECT_LAST_UPDATES = f"""
+SELECT {NODE_COLUMNS} FROM _ssqlite_nodes WHERE query_order IN (
+    SELECT MAX(query_order) FROM _ssqlite_rows
+    WHERE target_table=:table AND primary_key=:rowid AND target_column!='' AND query_order>:order
+    AND query_order<{NEXT_INSERT_ORDER}
+    GROUP BY target_column
+)
+"""
+SELECT_ROWIDS = "SELECT primary_key, old_value FROM _ssqlite_rows WHERE query_order=? ORDER BY primary_key"
+SELECT_LAST_ORDER = "SELECT MAX(query_order) FROM _ssqlite_nodes"
+
+
+class SQLiteIndex(object):
+    """Index which finds nodes with point lookups on the shadow tables
+
+    Only the nodes that are asked for are materialized. They carry no parent or
+    children references, so links are resolved through find_parent and friends.
+    """
+
+    # History is never pruned here
+    horizon = 0
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def _materialize(self, row: tuple) -> SSqliteNode:
+        """Build node from a row of _ssqlite_nodes"""
+        if row is None:
+            return None
+        query_order, node_type, query_string, target_table, target_column, primary_key, flag, old_value = row
+        node_class = NODE_CLASSES[node_type]
+
+        if node_class in (MultiUpdateNode, MultiDeleteNode):
+            rowids = self.conn.execute(SELECT_ROWIDS, (query_order,)).fetchall()
+            node = node_class(
+                query_order=query_order, query_string=query_string,
+                primary_keys=array("q", (rowid for rowid, _ in rowids)),
+                target_table=target_table, target_column=target_column
+            )
+            # Old values are captured for all rows of an update, or for none of them
+            if node_class is MultiUpdateNode and rowids and rowids[0][1] is not None:
+                node.old_values = [old_value for _, old_value in rowids]
+        elif node_class is UpdateNode:
+            node = node_class(
+                query_order=query_order, query_string=query_string, primary_key=primary_key,
+                target_table=target_table, target_column=target_column, old_value=old_value
+            )
+        else:
+            node = node_class(
+                query_order=query_order, query_string=query_string,
+                primary_key="" if primary_key is None else primary_key,
+                target_table=target_table, target_column=target_column
+            )
+
+        if isinstance(node, CreateNode):
+            node.flag_drop = bool(flag)
+        elif isinstance(node, InsertNode):
+            node.flag_delete = bool(flag)
+        return node
+
+    def find(self, _from: str, _key: str | tuple) -> SSqliteNode:
+        """Find specific node from the shadow tables"""
+        _from = _from.lower()
+        if _from in ("create", "drop"):
+            row = self.conn.execute(SELECT_BY_TABLE, (_key, *FIND_CODES[_from])).fetchone()
+        elif _from in ("insert", "delete"):
+            row = self.conn.execute(SELECT_BY_ROW, (*_key, *FIND_CODES[_from])).fetchone()
+        else:
+            rows = self.conn.execute(SELECT_UPDATES, _key).fetchall()
+            if rows:
+                return [self._materialize(row) for row in rows]
+            row = None
+
+        if row is None:
+            raise NodeNotFound(f"{_from} node with key: [{_key}] doesn't exist")
+        return self._materialize(row)
+
+    def find_by_order(self, query_order: int) -> SSqliteNode:
+        """Find specific node based on query order"""
+        row = self.conn.execute(SELECT_BY_ORDER, (query_order,)).fetchone()
+        if row is None:
+            raise NodeNotFound(f"Node with query order [{query_order}] doesn't exist")
+        return self._materialize(row)
+
+    def find_last_update(self, table_name: str, primary_key: str, column_name: str) -> UpdateNode:
+        """Find last update node based on given _key"""
+        return self.find_prev_update(table_name, primary_key, column_name, query_order=MAX_ORDER)
+
+    def find_prev_update(
+            self, table_name: str, primary_key: str, column_name: str, query_order: int
+        ) -> UpdateNode:
+        """Find the update node that precedes given query order on the same column"""
+        row = self.conn.execute(
+            SELECT_LAST_UPDATE, (table_name, primary_key, column_name, query_order)
+        ).fetchone()
+        return self._materialize(row)
+
+    # Same rule as the pickle index, on top of this index's own find_last_update and find_prev_update
+    find_current_update = Index.find_current_update
+
+    def find_prev_insert(self, table_name: str, primary_key: str, query_order: int) -> InsertNode:
+        """Find the insert node of the row which had given rowid right before given query order"""
+        row = self.conn.execute(
+            SELECT_PREV_INSERT, (table_name, primary_key, INSERT_CODE, query_order)
+        ).fetchone()
+        if row is None:
+            raise NodeNotFound(
+                f"insert node with key: [{(table_name, primary_key)}] before query order [{query_order}] doesn't exist"
+            )
+        return self._materialize(row)
+
+    def find_parent(self, node: SSqliteNode) -> SSqliteNode:
+        """Find parent node of given node"""
+        row = self.conn.execute(SELECT_PARENT_ORDER, (node.query_order,)).fetchone()
+        if row is None or row[0] is None:
+            raise OrphanError(node.node_id)
+        return self.find_by_order(row[0])
+
+    def find_live_inserts(self, create_node: CreateNode) -> list[InsertNode]:
+        """Find insert nodes of the table whose rows were not deleted, in insertion order"""
+        rows = self.conn.execute(SELECT_LIVE_INSERTS, (create_node.query_order, INSERT_CODE))
+        return [self._materialize(row) for row in rows.fetchall()]
+
+    def find_updated_columns(self, insert_node: InsertNode) -> set[str]:
+        """Find all columns updated after given insert node"""
+        rows = self.conn.execute(SELECT_UPDATED_COLUMNS, {
+            "table": insert_node.target_table, "rowid": insert_node.primary_key, "order": insert_node.query_order
+        })
+        return {column for column, in rows.fetchall()}
+
+    def find_last_updates(self, insert_node: InsertNode) -> dict[str, UpdateNode]:
+        """Find last update node of every column updated after given insert node"""
+        rows = self.conn.execute(SELECT_LAST_UPDATES, {
+            "table": insert_node.target_table, "rowid": insert_node.primary_key, "order": insert_node.query_order
+        })
+        update_nodes = [self._materialize(row) for row in rows.fetchall()]
+        return {update_node.target_column: update_node for update_node in update_nodes}
+
+
+class SQLiteQueryGraph(object):
+    """SQG stored in shadow tables of the database it records
+
+    Nodes are committed or rolled back together with the recorded statements.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        # Statements are run one by one, as executescript would commit the pending transaction
+        for statement in SCHEMA.split(";"):
+            if statement.strip():
+                self.conn.execute(statement)
+        self.index: SQLiteIndex = SQLiteIndex(conn)
+        # UndoCache attached to the graph, which is told about every node added through it
+        self.undo_cache = None
+
+    @property
+    def last_order(self) -> int:
+        """Query order of the most recently added node"""
+        return self.conn.execute(SELECT_LAST_ORDER).fetchone()[0] or 0
+
+    def _insert_node(self, node: SSqliteNode, parent_order: int=None) -> None:
+        """Write node and the rows it touches to the shadow tables"""
+        is_multi = isinstance(node, (MultiUpdateNode, MultiDeleteNode))
+        self.conn.execute(INSERT_NODE, (
+            node.query_order, NODE_TYPE_CODES[type(node)], node.query_string,
+            node.target_table, node.target_column,
+            None if is_multi or node.primary_key == "" else node.primary_key,
+            parent_order,
+            node.old_value if type(node) is UpdateNode else None
+        ))
+        if is_multi:
+            primary_keys = node.primary_keys
+        elif isinstance(node, (InsertNode, UpdateNode, DeleteNode)):
+            primary_keys = [node.primary_key]
+        else:
+            return
+        if isinstance(node, MultiUpdateNode) and node.old_values is not None:
+            old_values = node.old_values
+        else:
+            old_values = [None] * len(primary_keys)
+        self.conn.executemany(INSERT_ROW, (
+            (
+                node.target_table, primary_key, node.target_column, node.query_order,
+                NODE_TYPE_CODES[type(node)], old_value
+            )
+            for primary_key, old_value in zip(primary_keys, old_values)
+        ))
+
+    def _find_insert_orders(self, table_name: str, primary_keys: array) -> list[int]:
+        """Find query orders of the InsertNodes of given rows, raising NodeNotFound for any missing row"""
+        insert_orders = []
+        for i in range(0, len(primary_keys), ROWID_CHUNK_SIZE):
+            chunk = primary_keys[i:i + ROWID_CHUNK_SIZE]
+            rows = self.conn.execute(f"""
+                SELECT primary_key, MAX(query_order) FROM _ssqlite_rows
+                WHERE target_table=? AND target_column='' AND node_type=?
+                AND primary_key IN ({', '.join('?' * len(chunk))})
+                GROUP BY primary_key
+            """, (table_name, INSERT_CODE, *chunk)).fetchall()
+            if len(rows) != len(chunk):
+                raise NodeNotFound(f"insert node of some rows in [{table_name}] doesn't exist")
+            insert_orders += [query_order for _, query_order in rows]
+        return insert_orders
+
+    def add_insert_nodes(self, insert_nodes: list[InsertNode]):
+        """Add InsertNodes of a single table at once, e.g. the rows of an executemany"""
+        if not insert_nodes:
+            return
+        if self.undo_cache is not None:
+            for insert_node in insert_nodes:
+                self.undo_cache.invalidate(insert_node)
+        parent_create_node = self.index.find(_from="create", _key=insert_nodes[0].target_table)
+        self.conn.executemany(INSERT_NODE, (
+            (
+                insert_node.query_order, INSERT_CODE, insert_node.query_string,
+                insert_node.target_table, "", insert_node.primary_key, parent_create_node.query_order, None
+            )
+            for insert_node in insert_nodes
+        ))
+        self.conn.executemany(INSERT_ROW, (
+            (insert_node.target_table, insert_node.primary_key, "", insert_node.query_order, INSERT_CODE, None)
+            for insert_node in insert_nodes
+        ))
+
+    def add_node(self, node: SSqliteNode):
+        if self.undo_cache is not None:
+            self.undo_cache.invalidate(node)
+        if isinstance(node, CreateNode):
+            self._insert_node(node)
+        elif isinstance(node, InsertNode):
+            # Parent is the CreateNode of the table
+            parent_create_node = self.index.find(_from="create", _key=node.target_table)
+            self._insert_node(node, parent_order=parent_create_node.query_order)
+        elif isinstance(node, MultiUpdateNode):
+            # Parents are found per row from _ssqlite_rows, so only check that every row exists
+            self._find_insert_orders(node.target_table, node.primary_keys)
+            self._insert_node(node)
+        elif isinstance(node, UpdateNode):
+            # Parent is the last UpdateNode of the column, or the InsertNode of the row
+            corr_insert_node = self.index.find(_from="insert", _key=(node.target_table, node.primary_key))
+            parent_node = self.index.find_current_update(corr_insert_node, node.target_column) or corr_insert_node
+            self._insert_node(node, parent_order=parent_node.query_order)
+        elif isinstance(node, DropNode):
+            # Parent is the CreateNode of the table, which gets flag_drop=True
+            parent_create_node = self.index.find(_from="create", _key=node.target_table)
+            self.conn.execute(SET_FLAG, (parent_create_node.query_order,))
+            self._insert_node(node, parent_order=parent_create_node.query_order)
+        elif isinstance(node, MultiDeleteNode):
+            # Every deleted row's InsertNode gets flag_delete=True
+            insert_orders = self._find_insert_orders(node.target_table, node.primary_keys)
+            self.conn.executemany(SET_FLAG, ((query_order,) for query_order in insert_orders))
+            self._insert_node(node)
+        elif isinstance(node, DeleteNode):
+            # Parent is the InsertNode of the row, which gets flag_delete=True
+            parent_insert_node = self.index.find(_from="insert", _key=(node.target_table, node.primary_key))
+            self.conn.execute(SET_FLAG, (parent_insert_node.query_order,))
+            self._insert_node(node, parent_order=parent_insert_node.query_order)
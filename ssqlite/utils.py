@@ -1,6 +1,12 @@
+import gc
+import math
 import re
+import sqlite3
 
+from contextlib import closing, contextmanager
+from functools import lru_cache
 from enum import Enum
+from typing import Iterable, Iterator, Mapping, NamedTuple, Sequence
 
 
 class NodeType(Enum):
@@ -21,92 +27,361 @@ class InvalidInstructionError(Exception):
         return self.msg
 
 
-def parse_table_name(pattern: str, query_string: str) -> str:
-    """Helper function for parsing table name from query string"""
-    table_name_match = re.search(pattern=pattern, string=query_string, flags=re.IGNORECASE)
+# Everything before the first ';' or '--' that is not inside a quoted literal
+STATEMENT_BODY_PATTERN = re.compile(r"""(?:[^'"`;-]|'[^']*'|"[^"]*"|`[^`]*`|-(?!-))*""")
+
+
+@contextmanager
+def gc_paused() -> Iterator[None]:
+    """Pause the cyclic garbage collector while a large number of objects is built"""
+    gc_enabled = gc.isenabled()
+    gc.disable()
     try:
-        table_name = table_name_match.group("table_name")
-    except AttributeError:
-        raise
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
 
-    return table_name
 
+def strip_query(query_string: str) -> str:
+    """Strip trailing semicolon and comments from query string"""
+    query_string = query_string.strip()
+    # Fast path for a plain statement whose only ';' is the terminator
+    if "--" not in query_string and query_string.find(";") in (-1, len(query_string) - 1):
+        return query_string.rstrip(";").rstrip()
+    return STATEMENT_BODY_PATTERN.match(query_string).group().strip()
 
-def parse_column_name(pattern: str, query_string: str) -> str:
-    """Helper function for parsing column name from query string"""
-    column_name_match = re.search(pattern=pattern, string=query_string, flags=re.IGNORECASE)
-    try:
-        column_name = column_name_match.group("column_name")
-    except AttributeError:
-        raise
 
-    return column_name
+def strip_leading_comments(statement: str) -> str:
+    """Strip whitespace and comments in front of statement"""
+    statement = statement.lstrip()
+    while statement.startswith(("--", "/*")):
+        if statement.startswith("--"):
+            end = statement.find("\n")
+            statement = "" if end < 0 else statement[end + 1:].lstrip()
+        else:
+            end = statement.find("*/")
+            statement = "" if end < 0 else statement[end + 2:].lstrip()
+    return statement
+
+
+def split_statements(lines: Iterable[str]) -> Iterator[str]:
+    """Incrementally split lines of SQL text into complete statements
+
+    Every ';' is a candidate boundary, which sqlite3.complete_statement confirms.
+    """
+    buffer = ""
+    for line in lines:
+        start = 0
+        end = line.find(";")
+        while end >= 0:
+            statement = buffer + line[start:end + 1]
+            if sqlite3.complete_statement(statement):
+                statement = strip_leading_comments(statement)
+                # Skip empty statements such as a stray ';'
+                if statement != ";":
+                    yield statement
+                buffer, start = "", end + 1
+            end = line.find(";", end + 1)
+        buffer += line[start:]
+
+    # Last statement may not be terminated by ';'
+    statement = strip_leading_comments(buffer).rstrip()
+    if statement:
+        yield statement
+
+
+def read_queries(sql_filepath: str) -> Iterator[str]:
+    """Lazily yield statements from .sql file"""
+    with open(sql_filepath, "r") as f:
+        yield from split_statements(f)
+
+
+# Literals and comments are matched first, so that placeholders inside them are kept
+PARAMETER_PATTERN = re.compile(
+    r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|--[^\n]*|/\*.*?\*/"""
+    r"|\?(?P<number>\d*)|[:@$](?P<name>\w+)",
+    flags=re.DOTALL
+)
+
+
+def render_literal(value) -> str:
+    """Render Python value as SQL literal"""
+    if value is None:
+        return "NULL"
+    if isinstance(value, float):
+        # SQLite stores NaN as NULL and reads an overflowing literal as infinity
+        if math.isnan(value):
+            return "NULL"
+        if math.isinf(value):
+            return "9e999" if value > 0 else "-9e999"
+        return repr(value)
+    if isinstance(value, int):
+        return str(int(value))
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"X'{bytes(value).hex()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def bind_parameters(query_string: str, parameters: Sequence | Mapping) -> str:
+    """Render bound parameters into query string as literals"""
+    next_index = 0
+
+    def render(match: re.Match) -> str:
+        nonlocal next_index
+        number, name = match.group("number"), match.group("name")
+        if name is not None:
+            return render_literal(parameters[name])
+        if number is None:
+            return match.group()
+        # Plain '?' takes the parameter after the largest one used so far
+        index = int(number) - 1 if number else next_index
+        next_index = max(next_index, index + 1)
+        return render_literal(parameters[index])
+
+    return PARAMETER_PATTERN.sub(render, query_string)
+
+
+# Everything from WHERE up to the end of the statement body, without the trailing ';' or comment
+WHERE_CLAUSE = r"""\s+(?P<condition>WHERE\b(?:[^'"`;-]|'[^']*'|"[^"]*"|`[^`]*`|-(?!-))*)"""
+
+# Table or column name, either bare or quoted as in the output of .dump, e.g. "X", `X` or [X]
+IDENTIFIER = r"""(?:\w+|"(?:[^"]|"")+"|`[^`]+`|\[[^\]]+\])"""
+
+# One precompiled pattern per instruction, which extracts every field in a single match
+QUERY_PATTERNS = {
+    NodeType.CREATE.name: re.compile(
+        r"\s*CREATE\s+(?:TEMP(?:ORARY)?\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(?P<table_name>" + IDENTIFIER + ")",
+        flags=re.IGNORECASE
+    ),
+    NodeType.INSERT.name: re.compile(
+        r"\s*INSERT\s+(?:OR\s+\w+\s+)?INTO\s+(?P<table_name>" + IDENTIFIER + ")",
+        flags=re.IGNORECASE
+    ),
+    NodeType.UPDATE.name: re.compile(
+        r"\s*UPDATE\s+(?:OR\s+\w+\s+)?(?P<table_name>" + IDENTIFIER + r")\s+SET\s+(?P<column_name>" + IDENTIFIER + r")\s*="
+        r"""(?:[^'"`;-]|'[^']*'|"[^"]*"|`[^`]*`|-(?!-))*?(?:""" + WHERE_CLAUSE + r"|\s*(?=;|--|$))",
+        flags=re.IGNORECASE
+    ),
+    NodeType.DROP.name: re.compile(
+        r"\s*DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?(?P<table_name>" + IDENTIFIER + ")",
+        flags=re.IGNORECASE
+    ),
+    NodeType.DELETE.name: re.compile(
+        r"\s*DELETE\s+FROM\s+(?P<table_name>" + IDENTIFIER + ")(?:" + WHERE_CLAUSE + ")?",
+        flags=re.IGNORECASE
+    ),
+}
+
+
+INSERT_COLUMNS_PATTERN = re.compile(
+    r"""\s*INSERT\s+(?:OR\s+\w+\s+)?INTO\s+""" + IDENTIFIER + r"""\s*\((?P<columns>[^)]*)\)""",
+    flags=re.IGNORECASE
+)
+
+
+def parse_insert_columns(query_string: str) -> list[str] | None:
+    """Parse column list of INSERT query, which is None if it isn't given"""
+    columns_match = INSERT_COLUMNS_PATTERN.match(query_string)
+    if columns_match is None:
+        return None
+    return [column.strip().strip("\"`[]") for column in columns_match.group("columns").split(",")]
+
+
+# A single SQL literal, e.g. 'Bob', -1.5, X'00ff' or NULL
+LITERAL = r"""'(?:[^']|'')*'|X'[0-9A-F]*'|[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:E[-+]?\d+)?|NULL\b"""
+
+UPDATE_LITERAL_PATTERN = re.compile(
+    r"\s*UPDATE\s+(?:OR\s+\w+\s+)?" + IDENTIFIER + r"\s+SET\s+(?P<column_name>" + IDENTIFIER + r")\s*=\s*(?P<value>" + LITERAL + r")"
+    r"\s*(?:WHERE\b|;|--|$)",
+    flags=re.IGNORECASE
+)
 
+VALUES_TOKEN_PATTERN = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|[(),]|[^'"(),]+""")
 
-def parse_condition(pattern: str, query_string: str) -> str:
-    """Helper function for parsing condition caluse in query string"""
-    where_clause_match = re.search(pattern=pattern, string=query_string, flags=re.IGNORECASE)
+
+def parse_update_literal(query_string: str) -> tuple[str, str] | None:
+    """Parse column name and value of UPDATE query, which is None unless the value is a literal"""
+    match = UPDATE_LITERAL_PATTERN.match(query_string)
+    if match is None:
+        return None
+    return unquote_identifier(match.group("column_name")), match.group("value")
+
+
+def split_values(values: str) -> list[list[str]] | None:
+    """Split the parenthesized rows of VALUES into their expressions, which is None for anything else"""
+    rows, row, current = [], [], []
+    depth, expects_row = 0, True
+    for token in VALUES_TOKEN_PATTERN.findall(values):
+        if depth == 0:
+            # Rows are separated by commas, and surrounded by whitespace only
+            if token == "(" and expects_row:
+                depth, expects_row = 1, False
+            elif token == "," and not expects_row:
+                expects_row = True
+            elif token.strip():
+                return None
+            continue
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+            if depth == 0:
+                rows.append(row + ["".join(current).strip()])
+                row, current = [], []
+                continue
+        elif token == "," and depth == 1:
+            row.append("".join(current).strip())
+            current = []
+            continue
+        current.append(token)
+    if depth or expects_row:
+        return None
+    return rows
+
+
+def split_row_values(values: str) -> list[str] | None:
+    """Split a single parenthesized row of VALUES into its expressions, which is None for anything else"""
+    rows = split_values(values)
+    if rows is None or len(rows) != 1:
+        return None
+    return rows[0]
+
+
+def parse_literal(literal: str):
+    """Parse SQL literal into Python value, the inverse of render_literal"""
+    if literal.upper() == "NULL":
+        return None
+    if literal.startswith("'"):
+        return literal[1:-1].replace("''", "'")
+    if literal[:2].upper() == "X'":
+        return bytes.fromhex(literal[2:-1])
     try:
-        condition = where_clause_match.group("condition")
-    except AttributeError:
-        raise
+        return int(literal)
+    except ValueError:
+        return float(literal)
+
+
+class ParsedQuery(NamedTuple):
+
+    inst: str
+    table_name: str
+    column_name: str | None = None
+    condition: str = ""
+
+
+@lru_cache(maxsize=None)
+def quote_identifier(name: str) -> str:
+    """Render a plain name, e.g. of sqlite_master, as an identifier which is quoted only if it needs to be"""
+    if re.fullmatch(r"[A-Za-z_]\w*", name):
+        # Keywords are told apart by SQLite itself, which has the only complete list of them
+        with closing(sqlite3.connect(":memory:")) as conn:
+            try:
+                conn.execute(f"SELECT 0 AS {name}")
+                return name
+            except sqlite3.Error:
+                pass
+    return '"' + name.replace('"', '""') + '"'
+
+
+def identifier_name(identifier: str) -> str:
+    """Plain name of an identifier, quoted or not"""
+    if identifier[0] == '"':
+        return identifier[1:-1].replace('""', '"')
+    if identifier[0] == "`":
+        return identifier[1:-1].replace("``", "`")
+    if identifier[0] == "[":
+        return identifier[1:-1]
+    return identifier
 
-    return condition
 
+def unquote_identifier(identifier: str) -> str:
+    """Strip the quotes of a name which doesn't need them, so that "X" and X are the same table"""
+    return quote_identifier(identifier_name(identifier))
 
-def parse_query_string(query_string: str) -> dict:
+
+TRANSACTION_PATTERN = re.compile(
+    rf"""\s*(?P<inst>BEGIN|COMMIT|END|ROLLBACK|SAVEPOINT|RELEASE)\b"""
+    rf"""(?:\s+TRANSACTION\b)?(?P<to>\s+TO\b)?(?:\s+SAVEPOINT\b)?(?:\s+(?P<name>{IDENTIFIER}))?""",
+    flags=re.IGNORECASE
+)
+
+
+def parse_transaction_control(query_string: str) -> tuple[str, str | None] | None:
+    """Classify BEGIN/COMMIT/ROLLBACK/ROLLBACK TO/SAVEPOINT/RELEASE, along with its savepoint name"""
+    match = TRANSACTION_PATTERN.match(query_string)
+    if match is None:
+        return None
+    inst = match.group("inst").upper()
+    if inst in ("BEGIN", "COMMIT", "END"):
+        return "COMMIT" if inst == "END" else inst, None
+    if inst == "ROLLBACK" and match.group("to") is None:
+        return inst, None
+    # Savepoint names are case-insensitive
+    name = match.group("name")
+    return "ROLLBACK TO" if inst == "ROLLBACK" else inst, name and unquote_identifier(name).lower()
+
+
+RETURNING_PATTERN = re.compile(r"\bRETURNING\b", flags=re.IGNORECASE)
+
+CLAUSE_TOKEN_PATTERN = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\]|[()]|[^'"`\[()]+""")
+
+
+def find_returning(query_string: str) -> int:
+    """Find where RETURNING clause of query starts, which is -1 if there is none"""
+    if RETURNING_PATTERN.search(query_string) is None:
+        return -1
+    # Only the keyword outside of literals, quoted names and subqueries counts
+    depth = 0
+    for token in CLAUSE_TOKEN_PATTERN.finditer(query_string):
+        text = token.group()
+        if text == "(":
+            depth += 1
+        elif text == ")":
+            depth -= 1
+        elif depth == 0 and text[0] not in "'\"`[":
+            match = RETURNING_PATTERN.search(text)
+            if match is not None:
+                return token.start() + match.start()
+    return -1
+
+
+def parse_query_string(query_string: str) -> ParsedQuery:
     """Parse query string"""
-    inst = query_string.split()[0]
-    if inst not in [nt.name for nt in NodeType]:
+    # 1. Classify by the first keyword, in any case
+    tokens = query_string.split(None, 1)
+    inst = tokens[0].upper() if tokens else ""
+    pattern = QUERY_PATTERNS.get(inst)
+    if pattern is None:
         raise InvalidInstructionError(inst)
 
-    table_name = None
-    column_name = None
-    condition = None
-
-    if inst == NodeType.CREATE.name:
-        table_name = parse_table_name(
-            pattern=r"TABLE(\s+)(?P<table_name>[a-zA-Z0-9_]+)(\s+)",
-            query_string=query_string
-        )
-    elif inst == NodeType.INSERT.name:
-        table_name = parse_table_name(
-            pattern=r"INSERT(\s+)INTO(\s+)(?P<table_name>[a-zA-Z0-9_]+)",
-            query_string=query_string
-        )
-    elif inst == NodeType.UPDATE.name:
-        table_name = parse_table_name(
-            pattern=r"UPDATE(\s+)(?P<table_name>[a-zA-Z0-9_]+)(\s+)SET",
-            query_string=query_string
-        )
-        column_name = parse_column_name(
-            pattern=r"SET(\s+)(?P<column_name>[a-zA-Z0-9_]+)(\s*)=",
-            query_string=query_string
-        )
-        condition = parse_condition(
-            pattern=r"(?P<condition>WHERE(\s+)([a-zA-Z0-9_]*)(\s*)=(\s*)(\'?)(\"?)([a-zA-Z0-9_]+)(\'?)(\"?))",
-            query_string=query_string
-        )
-    elif inst == NodeType.DROP.name:
-        table_name = parse_table_name(
-            pattern=r"DROP(\s+)TABLE(\s+)(?P<table_name>[a-zA-Z0-9_]+)",
-            query_string=query_string
-        )
-    elif inst == NodeType.DELETE.name:
-        table_name = parse_table_name(
-            pattern=r"DELETE(\s+)FROM(\s+)(?P<table_name>[a-zA-Z0-9_]+)(\s+)",
-            query_string=query_string
-        )
-        condition = parse_condition(
-            pattern=r"(?P<condition>WHERE(\s+)([a-zA-Z0-9_]*)(\s*)=(\s*)(\'?)(\"?)([a-zA-Z0-9_]+)(\'?)(\"?))",
-            query_string=query_string
-        )
-
-    result = {
-        "inst": inst,
-        "table_name": table_name,
-        "column_name": column_name,
-        "condition": condition
-    }
-
-    return result
+    # 2. Extract table name, column name and WHERE clause at once
+    match = pattern.match(query_string)
+    if match is None:
+        raise InvalidInstructionError(query_string.strip())
+    fields = match.groupdict()
+
+    column_name = fields.get("column_name")
+    condition = fields.get("condition") or ""
+    # RETURNING clause isn't a part of WHERE clause
+    returning = find_returning(condition)
+    if returning >= 0:
+        condition = condition[:returning]
+    return ParsedQuery(
+        inst=inst,
+        table_name=unquote_identifier(fields["table_name"]),
+        column_name=column_name and unquote_identifier(column_name),
+        condition=condition.rstrip()
+    )
+
+
+def parse_queries(query_strings: list[str]) -> list[tuple | None]:
+    """Parse a chunk of query strings into plain tuples of ParsedQuery fields, which are
+    cheap to send between processes, with None for the ones which SQG doesn't record"""
+    parse_records = []
+    for query_string in query_strings:
+        try:
+            parse_records.append(tuple(parse_query_string(query_string)))
+        except InvalidInstructionError:
+            parse_records.append(None)
+    return parse_records
@@ -1,31 +1,53 @@
+import asyncio
+import glob
 import os
+import random
+import sqlite3
 import ssqlite
+import ssqlite.aio
+import ssqlite.metrics
 import unittest
 
-from ssqlite.algo import SSqliteQueryGraph as SQG
-from ssqlite.recovery import generate_undo_query
+from ssqlite.algo import SSqliteQueryGraph as SQG, get_journal_filepath
+from ssqlite.mapped import MappedQueryGraph
+from ssqlite.partition import PartitionedQueryGraph
+from ssqlite.store import SQLiteQueryGraph
+from ssqlite.index import NodeNotFound
+from ssqlite.journal import SQGJournal
+from ssqlite.node import InsertNode, InvalidOperation
+from ssqlite.recovery import UndoCache, apply_undo, generate_undo_query, generate_undo_range, plan_undo_query, rollback_to
+
+
+# Prefixes of the files written by the tests
+QUERY_TYPES = [
+    "create", "insert", "update", "drop", "delete", "batch", "multiupdate", "multidelete",
+    "journal", "indb", "mapped", "lowercase", "dump", "connection", "executemany",
+    "triggers", "oldvalues", "coalesce", "rollback", "apply", "cache", "live", "prune", "metrics",
+    "parallel", "async", "partition", "reuse", "indbreuse", "picklereuse", "replay",
+    "differential", "iterdump", "baseline", "savepoint", "triggersnames", "returning"
+]
+
+
+def remove_test_files() -> None:
+    """Helper function for removing the files written by the tests, shards and temporary files included"""
+    for query_type in QUERY_TYPES:
+        filenames = [f"{query_type}.db", f"{query_type}.sqg", f"{query_type}.sqg-journal", f"{query_type}.sqg-tmp"]
+        filenames += glob.glob(f"{query_type}.sqg-shard*")
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
 
 
 class RecoveryTests(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls) -> None:
-        query_types = ["create", "insert", "update", "drop", "delete"]
-        for query_type in query_types:
-            if os.path.exists(f"{query_type}.db"):
-                os.remove(f"{query_type}.db")
-            if os.path.exists(f"{query_type}.sqg"):
-                os.remove(f"{query_type}.sqg")
-    
+        remove_test_files()
+
     @classmethod
     def tearDownClass(cls) -> None:
-        query_types = ["create", "insert", "update", "drop", "delete"]
-        for query_type in query_types:
-            if os.path.exists(f"{query_type}.db"):
-                os.remove(f"{query_type}.db")
-            if os.path.exists(f"{query_type}.sqg"):
-                os.remove(f"{query_type}.sqg")
-    
+        remove_test_files()
+
     def get_undo_query(
             self, db_name: str, sql_filename: str,
             sqg_filename: str, query_order: int
@@ -40,6 +62,55 @@ class RecoveryTests(unittest.TestCase):
         undo_query_set = generate_undo_query(graph, query_order=query_order)
         return undo_query_set
 
+    def get_snapshot(self, db: sqlite3.Connection) -> dict[str, list[tuple]]:
+        """Helper function for reading every user table, along with the rowids of its rows"""
+        table_names = [
+            table_name for table_name, in db.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE '_ssqlite%' ORDER BY name"
+            )
+        ]
+        return {
+            table_name: db.execute(f"SELECT rowid, * FROM {table_name} ORDER BY rowid").fetchall()
+            for table_name in table_names
+        }
+
+    def generate_statements(self, rng: random.Random, num_statements: int) -> list[str]:
+        """Helper function for generating statements whose updates set literals, and which give
+        rowids of deleted rows and dropped tables out again"""
+        statements = []
+        live_ids = {}
+        for _ in range(num_statements):
+            table_name = rng.choice(["X", "Y"])
+            kind = rng.random()
+            if table_name not in live_ids:
+                live_ids[table_name] = set()
+                statements.append(f"CREATE TABLE {table_name} (id INTEGER PRIMARY KEY, name VARCHAR(255), team VARCHAR(255))")
+                continue
+            rowids = live_ids[table_name]
+            free_ids = [rowid for rowid in range(1, 9) if rowid not in rowids]
+            rowid = rng.randrange(1, 9)
+            if kind < 0.35 and free_ids:
+                rowids.add(free_ids[0])
+                statements.append(
+                    f"INSERT INTO {table_name}(id, name, team) VALUES({free_ids[0]}, 'name{rng.randrange(100)}', 'team{rng.randrange(3)}')"
+                )
+            elif kind < 0.55:
+                statements.append(f"UPDATE {table_name} SET name='name{rng.randrange(100)}' WHERE id={rowid}")
+            elif kind < 0.7:
+                statements.append(f"UPDATE {table_name} SET name='multi{rng.randrange(100)}' WHERE team='team{rng.randrange(3)}'")
+            elif kind < 0.8:
+                rowids.discard(rowid)
+                statements.append(f"DELETE FROM {table_name} WHERE id={rowid}")
+            elif kind < 0.9:
+                rowids.difference_update(range(rowid, 9))
+                statements.append(f"DELETE FROM {table_name} WHERE id>={rowid}")
+            elif kind < 0.95:
+                del live_ids[table_name]
+                statements.append(f"DROP TABLE {table_name}")
+            else:
+                statements.append(f"UPDATE {table_name} SET team='team{rng.randrange(3)}' WHERE id={rowid}")
+        return statements
+
     def test_recovery_create(self):
         undo_query_set = self.get_undo_query(
             db_name="create.db",
@@ -123,6 +194,977 @@ class RecoveryTests(unittest.TestCase):
             [query.lower() for query in expected_query_set]
         )
 
+    def test_build_batched(self):
+        ssqlite.executescript(
+            db_name="batch.db",
+            sql_filename="test_delete.sql",
+            sqg_filename="batch.sqg",
+            batch_size=4
+        )
+        # Every batch has been committed, so a fresh connection sees all rows
+        conn = sqlite3.connect("batch.db")
+        num_rows = conn.execute("SELECT COUNT(*) FROM X").fetchone()[0]
+        conn.close()
+        self.assertEqual(num_rows, 5)
+
+        graph = SQG.load_from_file("batch.sqg")
+        undo_query_set = generate_undo_query(graph, query_order=6)
+        expected_query_set = [
+            "INSERT INTO X(id, name) VALUES(1, 'Alice');",
+            "UPDATE X SET name='Aaron' WHERE id=1;"
+        ]
+        self.assertEqual(
+            [query.lower() for query in undo_query_set],
+            [query.lower() for query in expected_query_set]
+        )
+
+    def test_recovery_multi_update(self):
+        undo_query_set = self.get_undo_query(
+            db_name="multiupdate.db",
+            sql_filename="test_multirow.sql",
+            sqg_filename="multiupdate.sqg",
+            query_order=8 # UPDATE X SET name='Someone' WHERE team='red';
+        )
+        expected_query_set = [
+            "DELETE FROM X WHERE rowid IN (2, 5);",
+            "INSERT INTO X(id, name, team) VALUES(2, 'Bob', 'red'), (5, 'Eve', 'red');",
+            "UPDATE X SET name='Aaron' WHERE id=1;"
+        ]
+        self.assertEqual(
+            [query.lower() for query in undo_query_set],
+            [query.lower() for query in expected_query_set]
+        )
+
+    def test_recovery_multi_delete(self):
+        undo_query_set = self.get_undo_query(
+            db_name="multidelete.db",
+            sql_filename="test_multirow.sql",
+            sqg_filename="multidelete.sqg",
+            query_order=10 # DELETE FROM X WHERE team='blue';
+        )
+        expected_query_set = [
+            "INSERT INTO X(id, name, team) VALUES(3, 'Charles', 'blue'), (4, 'David', 'blue');",
+            "UPDATE X SET name='Carl' WHERE id=3;"
+        ]
+        self.assertEqual(
+            [query.lower() for query in undo_query_set],
+            [query.lower() for query in expected_query_set]
+        )
+
+    def test_build_journal(self):
+        ssqlite.executescript(
+            db_name="journal.db",
+            sql_filename="test_delete.sql",
+            sqg_filename="journal.sqg",
+            journal=True
+        )
+        # Nodes are only in the journal until it is compacted
+        self.assertFalse(os.path.exists("journal.sqg"))
+        # Node whose transaction never committed, e.g. of a crash before the database commit, isn't replayed
+        graph = SQG.load_from_file("journal.sqg")
+        journal = SQGJournal(get_journal_filepath("journal.sqg"))
+        journal.append(InsertNode(
+            query_order=graph.last_order + 1, query_string="INSERT INTO X(id, name) VALUES(9, 'Ghost')",
+            primary_key=9, target_table="X"
+        ))
+        journal.sync()
+        self.assertEqual(SQG.load_from_file("journal.sqg").last_order, graph.last_order)
+        journal.close()
+        expected_query_set = [
+            "INSERT INTO X(id, name) VALUES(1, 'Alice');",
+            "UPDATE X SET name='Aaron' WHERE id=1;"
+        ]
+        for _ in range(2):
+            graph = SQG.load_from_file("journal.sqg")
+            undo_query_set = generate_undo_query(graph, query_order=6)
+            self.assertEqual(
+                [query.lower() for query in undo_query_set],
+                [query.lower() for query in expected_query_set]
+            )
+            SQG.compact("journal.sqg")
+            self.assertFalse(os.path.exists("journal.sqg-journal"))
+
+    def test_recovery_in_database(self):
+        sql_filenames = [
+            "test_create.sql", "test_insert.sql", "test_update.sql",
+            "test_drop.sql", "test_delete.sql", "test_multirow.sql"
+        ]
+        for sql_filename in sql_filenames:
+            for filename in ["indb.db", "indb.sqg"]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            ssqlite.executescript(
+                db_name=":memory:",
+                sql_filename=sql_filename,
+                sqg_filename="indb.sqg"
+            )
+            graph = SQG.load_from_file("indb.sqg")
+            ssqlite.executescript(
+                db_name="indb.db",
+                sql_filename=sql_filename,
+                sqg_filename=None
+            )
+            # Undo query sets from the shadow tables match the ones from the pickled graph
+            conn = sqlite3.connect("indb.db")
+            db_graph = SQLiteQueryGraph(conn)
+            for query_order in graph.index.order_index:
+                self.assertEqual(
+                    generate_undo_query(db_graph, query_order=query_order),
+                    generate_undo_query(graph, query_order=query_order),
+                    msg=f"{sql_filename}: {query_order}"
+                )
+            conn.close()
+
+    def test_recovery_mapped(self):
+        sql_filenames = [
+            "test_create.sql", "test_insert.sql", "test_update.sql",
+            "test_drop.sql", "test_delete.sql", "test_multirow.sql"
+        ]
+        for sql_filename in sql_filenames:
+            ssqlite.executescript(
+                db_name=":memory:",
+                sql_filename=sql_filename,
+                sqg_filename="mapped.sqg"
+            )
+            graph = SQG.load_from_file("mapped.sqg")
+            ssqlite.executescript(
+                db_name=":memory:",
+                sql_filename=sql_filename,
+                sqg_filename="mapped.sqg",
+                binary=True
+            )
+            # Undo query sets from the mapped file match the ones from the pickled graph
+            mapped_graph = MappedQueryGraph.load_from_file("mapped.sqg")
+            for query_order in graph.index.order_index:
+                self.assertEqual(
+                    generate_undo_query(mapped_graph, query_order=query_order),
+                    generate_undo_query(graph, query_order=query_order),
+                    msg=f"{sql_filename}: {query_order}"
+                )
+            mapped_graph.close()
+
+    def test_recovery_baseline_pickle(self):
+        # Graph of test_update.sql pickled by the baseline release, before nodes had slots
+        graph = SQG.load_from_file(os.path.join("data", "baseline_update.sqg"))
+        ssqlite.executescript(db_name=":memory:", sql_filename="test_update.sql", sqg_filename="baseline.sqg")
+        expected_graph = SQG.load_from_file("baseline.sqg")
+        self.assertEqual(graph.last_order, expected_graph.last_order)
+        for query_order in expected_graph.index.order_index:
+            self.assertEqual(
+                generate_undo_query(graph, query_order=query_order),
+                generate_undo_query(expected_graph, query_order=query_order),
+                msg=f"{query_order}"
+            )
+
+        # Rows are keyed by tuples again, like in graphs saved since
+        self.assertEqual(graph.index.find(_from="insert", _key=("X", 2)).query_order, 3)
+        self.assertEqual(graph.index.find_last_update("X", 2, "name").query_order, 9)
+
+    def test_recovery_lowercase(self):
+        undo_query_set = self.get_undo_query(
+            db_name="lowercase.db",
+            sql_filename="test_lowercase.sql",
+            sqg_filename="lowercase.sqg",
+            query_order=4 # update x set name='Zed';
+        )
+        expected_query_set = [
+            "DELETE FROM x WHERE rowid=1;",
+            "insert into x(id, name) values(1, 'Alice');"
+        ]
+        self.assertEqual(
+            [query.lower() for query in undo_query_set],
+            [query.lower() for query in expected_query_set]
+        )
+
+    def test_recovery_dump(self):
+        undo_query_set = self.get_undo_query(
+            db_name="dump.db",
+            sql_filename="test_dump.sql",
+            sqg_filename="dump.sqg",
+            query_order=7 # UPDATE X SET name='Carl' WHERE id=3;
+        )
+        expected_query_set = [
+            "DELETE FROM X WHERE rowid=3;",
+            "INSERT INTO X VALUES(3,'Charles;\nChaplin');"
+        ]
+        self.assertEqual(
+            [query.lower() for query in undo_query_set],
+            [query.lower() for query in expected_query_set]
+        )
+
+    def test_recovery_connection(self):
+        conn = ssqlite.connect("connection.db", sqg_filename="connection.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+        conn.executemany(
+            "INSERT INTO X(id, name) VALUES(?, ?)",
+            [(1, "Alice"), (2, "Bob"), (3, "Charles")]
+        )
+        conn.commit()
+        # Rolled back statement is not recorded
+        conn.execute("DELETE FROM X WHERE id > ?", (1,))
+        conn.rollback()
+        with conn:
+            conn.execute("UPDATE X SET name=:name WHERE id=:id", {"name": "Brendan", "id": 2})
+        conn.close()
+
+        graph = SQG.load_from_file("connection.sqg")
+        undo_query_set = generate_undo_query(graph, query_order=5) # UPDATE X SET name='Brendan' WHERE id=2
+        expected_query_set = [
+            "DELETE FROM X WHERE rowid=2;",
+            "INSERT INTO X(id, name) VALUES(2, 'Bob')"
+        ]
+        self.assertEqual(
+            [query.lower() for query in undo_query_set],
+            [query.lower() for query in expected_query_set]
+        )
+
+    def test_recovery_returning(self):
+        conn = ssqlite.connect("returning.db", sqg_filename="returning.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+        conn.executemany("INSERT INTO X(id, name) VALUES(?, ?)", [(1, "Alice"), (2, "Bob"), (3, "Charles")])
+        # Rows of the statement's own RETURNING are left to the caller
+        rows = conn.execute("UPDATE X SET name='Bobby' WHERE id=2 RETURNING id").fetchall()
+        self.assertEqual(rows, [(2,)])
+        rows = conn.execute("DELETE FROM X WHERE id>=2 RETURNING *").fetchall()
+        self.assertEqual(sorted(rows), [(2, "Bobby"), (3, "Charles")])
+        conn.commit()
+
+        # Update is replayed without its RETURNING, whose rows would keep the undo from committing
+        self.assertEqual(generate_undo_query(conn.graph, query_order=6)[1], "UPDATE X SET name='Bobby' WHERE id=2;")
+        conn.undo(range(5, 7))
+        self.assertEqual(conn.execute("SELECT * FROM X").fetchall(), [(1, "Alice"), (2, "Bob"), (3, "Charles")])
+        conn.close()
+
+    def test_recovery_transaction_control(self):
+        conn = ssqlite.connect("savepoint.db", sqg_filename="savepoint.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+        # Statements rolled back by ROLLBACK are not recorded
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO X(id, name) VALUES(1, 'Alice')")
+        conn.execute("ROLLBACK")
+        self.assertEqual(conn.graph.last_order, 1)
+
+        # Nor are the ones rolled back to a savepoint, while the ones before it are
+        conn.execute("SAVEPOINT a")
+        conn.execute("INSERT INTO X(id, name) VALUES(1, 'Alice')")
+        conn.execute("SAVEPOINT b")
+        conn.execute("INSERT INTO X(id, name) VALUES(2, 'Bob')")
+        conn.execute("ROLLBACK TO a")
+        conn.execute("INSERT INTO X(id, name) VALUES(3, 'Charles')")
+        conn.execute("RELEASE a")
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(conn.execute("SELECT * FROM X").fetchall(), [(3, "Charles")])
+        self.assertEqual(conn.graph.last_order, 2)
+        self.assertEqual(conn.graph.index.find_by_order(2).primary_key, 3)
+
+        conn.execute("BEGIN")
+        conn.execute("SAVEPOINT a")
+        conn.execute("UPDATE X SET name='Carl' WHERE id=3")
+        conn.execute("RELEASE a")
+        conn.execute("COMMIT")
+        self.assertEqual(generate_undo_query(conn.graph, query_order=3), [
+            "DELETE FROM X WHERE rowid=3;", "INSERT INTO X(id, name) VALUES(3, 'Charles')"
+        ])
+        conn.close()
+
+    def test_recovery_executemany(self):
+        conn = ssqlite.connect("executemany.db", sqg_filename="executemany.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+        # Rowids are assigned by SQLite, so the rows are inserted in bulk
+        conn.executemany("INSERT INTO X(name) VALUES(?)", [("Alice",), ("Bob",), ("O'Neil",)])
+        # Rowids are given, so the rows are inserted one by one
+        conn.executemany("INSERT INTO X(id, name) VALUES(?, ?)", [(10, "David"), (7, "Eve")])
+        conn.executemany("DELETE FROM X WHERE id=?", [(2,), (10,)])
+        conn.commit()
+        conn.close()
+
+        graph = SQG.load_from_file("executemany.sqg")
+        insert_nodes = [graph.index.find_by_order(query_order) for query_order in (2, 3, 4)]
+        self.assertEqual([node.primary_key for node in insert_nodes], [1, 2, 3])
+        # Nodes share the template and keep their own parameters
+        self.assertTrue(insert_nodes[0].query_template is insert_nodes[2].query_template)
+        self.assertEqual(insert_nodes[2].parameters, ("O'Neil",))
+
+        expected_query_sets = {
+            4: ["DELETE FROM X WHERE rowid=3;"],
+            6: ["DELETE FROM X WHERE rowid=7;"],
+            # Row is restored at the rowid SQLite assigned it
+            7: ["INSERT INTO X(rowid, name) VALUES(2, 'Bob');"],
+            8: ["INSERT INTO X(id, name) VALUES(10, 'David')"],
+        }
+        for query_order, expected_query_set in expected_query_sets.items():
+            undo_query_set = generate_undo_query(graph, query_order=query_order)
+            self.assertEqual(
+                [query.lower() for query in undo_query_set],
+                [query.lower() for query in expected_query_set]
+            )
+
+        conn = ssqlite.connect("executemany.db", sqg_filename="executemany.sqg")
+        conn.execute("CREATE TABLE Y (name VARCHAR(255))")
+        conn.executemany("INSERT INTO Y VALUES(?)", [("a",), ("b",), ("c",)])
+        conn.execute("DELETE FROM Y WHERE name='b'")
+        conn.commit()
+        conn.undo(conn.graph.last_order)
+        self.assertEqual(conn.execute("SELECT rowid, name FROM Y").fetchall(), [(1, "a"), (2, "b"), (3, "c")])
+        conn.close()
+
+    def test_recovery_triggers(self):
+        conn = ssqlite.connect("triggers.db", sqg_filename="triggers.sqg", capture="triggers")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255), team VARCHAR(255))")
+        conn.executemany(
+            "INSERT INTO X(name, team) VALUES(?, ?)",
+            [("Alice", "red"), ("Bob", "blue"), ("Charles", "red")]
+        )
+        # Statements which are not parsed are still recorded row by row
+        conn.execute("UPDATE X SET team='green' WHERE id IN (SELECT id FROM X WHERE team='red')")
+        conn.execute(
+            "INSERT INTO X(id, name, team) VALUES(2, 'Brendan', 'blue') "
+            "ON CONFLICT(id) DO UPDATE SET name=excluded.name"
+        )
+        conn.execute("DELETE FROM X WHERE team='blue'")
+        conn.commit()
+        conn.close()
+
+        graph = SQG.load_from_file("triggers.sqg")
+        expected_query_sets = {
+            5: [ # UPDATE X SET team='green' WHERE rowid=1;
+                "UPDATE X SET team='red' WHERE rowid=1;"
+            ],
+            8: [ # DELETE FROM X WHERE rowid=2;
+                "INSERT INTO X(id, name, team) VALUES(2, 'Bob', 'blue');",
+                "UPDATE X SET name='Brendan' WHERE rowid=2;"
+            ],
+        }
+        for query_order, expected_query_set in expected_query_sets.items():
+            undo_query_set = generate_undo_query(graph, query_order=query_order)
+            self.assertEqual(
+                [query.lower() for query in undo_query_set],
+                [query.lower() for query in expected_query_set]
+            )
+
+    def test_recovery_triggers_names(self):
+        conn = ssqlite.connect("triggersnames.db", sqg_filename="triggersnames.sqg", capture="triggers")
+        # Names which need quotes, including keywords, are quoted in the triggers and the logged statements
+        conn.execute("CREATE TABLE \"my table\" (id INTEGER PRIMARY KEY, \"it's\" VARCHAR(255))")
+        conn.execute("CREATE TABLE \"order\" (id, \"group\")")
+        conn.execute("INSERT INTO \"my table\" VALUES(1, 'Alice')")
+        conn.execute("UPDATE \"my table\" SET \"it's\"='Bob'")
+        conn.execute("INSERT INTO \"order\" VALUES(1, 'red')")
+        # Temp tables are left out
+        conn.execute("CREATE TEMP TABLE T (id INTEGER PRIMARY KEY)")
+        conn.execute("INSERT INTO T VALUES(1)")
+        conn.execute("DROP TABLE T")
+        # Row whose rowid changed is recorded as deleted and inserted again
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+        conn.execute("INSERT INTO X(id, name) VALUES(1, 'Alice')")
+        conn.execute("UPDATE X SET id=5 WHERE id=1")
+        conn.commit()
+
+        expected_query_sets = {
+            4: ["UPDATE \"my table\" SET \"it's\"='Alice' WHERE rowid=1;"],
+            5: ["DELETE FROM \"order\" WHERE rowid=1;"],
+            8: ["INSERT INTO X(id, name) VALUES(1, 'Alice');"],
+            9: ["DELETE FROM X WHERE rowid=5;"],
+        }
+        self.assertEqual(conn.graph.last_order, 9)
+        for query_order, expected_query_set in expected_query_sets.items():
+            self.assertEqual(generate_undo_query(conn.graph, query_order=query_order), expected_query_set)
+        # Undo of quoted tables runs as parameterized statements all the same
+        self.assertEqual(plan_undo_query(conn.graph, query_order=5)[0][1:], ("DELETE FROM \"order\" WHERE rowid=?", [(1,)]))
+        conn.undo(range(8, 10))
+        self.assertEqual(conn.execute("SELECT * FROM X").fetchall(), [(1, "Alice")])
+        conn.undo(4)
+        self.assertEqual(conn.execute("SELECT * FROM \"my table\"").fetchall(), [(1, "Alice")])
+        conn.close()
+
+    def test_recovery_old_values(self):
+        graph_by_backend = {}
+        for binary in [False, True]:
+            ssqlite.executescript(
+                db_name=":memory:",
+                sql_filename="test_multirow.sql",
+                sqg_filename="oldvalues.sqg",
+                binary=binary,
+                capture_old_values=True
+            )
+            if binary:
+                graph_by_backend["mapped"] = MappedQueryGraph.load_from_file("oldvalues.sqg")
+            else:
+                graph_by_backend["pickle"] = SQG.load_from_file("oldvalues.sqg")
+        ssqlite.executescript(
+            db_name="oldvalues.db",
+            sql_filename="test_multirow.sql",
+            sqg_filename=None,
+            capture_old_values=True
+        )
+        conn = sqlite3.connect("oldvalues.db")
+        graph_by_backend["indb"] = SQLiteQueryGraph(conn)
+
+        expected_query_sets = {
+            7: [ # UPDATE X SET name='Aaron' WHERE id=1;
+                "UPDATE X SET name='Alice' WHERE rowid=1;"
+            ],
+            8: [ # UPDATE X SET name='Someone' WHERE team='red';
+                "UPDATE X SET name='Aaron' WHERE rowid=1;",
+                "UPDATE X SET name='Bob' WHERE rowid=2;",
+                "UPDATE X SET name='Eve' WHERE rowid=5;"
+            ],
+            9: [], # UPDATE X SET name='Carl' WHERE id=3; of a deleted row
+        }
+        for backend, graph in graph_by_backend.items():
+            for query_order, expected_query_set in expected_query_sets.items():
+                self.assertEqual(
+                    generate_undo_query(graph, query_order=query_order),
+                    expected_query_set,
+                    msg=f"{backend}: {query_order}"
+                )
+        graph_by_backend["mapped"].close()
+        conn.close()
+
+        # Connections capture old values of their own, leaving the others as they are
+        db = ssqlite.connect(":memory:", sqg_filename=None, capture_old_values=True)
+        other = ssqlite.connect(":memory:", sqg_filename=None)
+        for conn in [db, other]:
+            conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+            conn.execute("INSERT INTO X(id, name) VALUES(1, 'Alice')")
+            conn.execute("UPDATE X SET name='Aaron' WHERE id=1")
+            conn.commit()
+        self.assertEqual(db.graph.index.find_by_order(3).old_value, "'Alice'")
+        self.assertIsNone(other.graph.index.find_by_order(3).old_value)
+        db.close()
+        other.close()
+
+    def test_recovery_coalesce(self):
+        expected_query_sets = {
+            ("test_drop.sql", 15): [ # DROP TABLE X;
+                "CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255));",
+                "INSERT INTO X(id, name) VALUES(2, 'Brendan'), (3, 'Charles'), (5, 'Eve'), (6, 'Francis'), (7, 'Gerrard');"
+            ],
+            ("test_delete.sql", 6): [ # DELETE FROM X WHERE name='Aaron';
+                "INSERT INTO X(id, name) VALUES(1, 'Aaron');"
+            ],
+            ("test_multirow.sql", 10): [ # DELETE FROM X WHERE team='blue';
+                "INSERT INTO X(id, name, team) VALUES(3, 'Carl', 'blue'), (4, 'David', 'blue');"
+            ],
+        }
+        for (sql_filename, query_order), expected_query_set in expected_query_sets.items():
+            ssqlite.executescript(
+                db_name=":memory:",
+                sql_filename=sql_filename,
+                sqg_filename="coalesce.sqg"
+            )
+            graph = SQG.load_from_file("coalesce.sqg")
+            self.assertEqual(
+                generate_undo_query(graph, query_order=query_order, coalesce=True),
+                expected_query_set
+            )
+
+        # Updates which can't be folded are replayed, followed by the later updates they would undo
+        os.remove("coalesce.sqg")
+        conn = ssqlite.connect("coalesce.db", sqg_filename="coalesce.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255), score INTEGER)")
+        conn.executemany(
+            "INSERT INTO X(id, name, score) VALUES(?, ?, ?)",
+            [(1, "Alice", 10), (2, "Bob", 20), (3, "Charles", 30)]
+        )
+        conn.execute("UPDATE X SET score=score+1 WHERE id<3")
+        conn.execute("UPDATE X SET score=0 WHERE id=1")
+        conn.commit()
+        rows = conn.execute("SELECT * FROM X ORDER BY id").fetchall()
+        conn.execute("DROP TABLE X")
+        conn.close()
+
+        graph = SQG.load_from_file("coalesce.sqg")
+        conn = sqlite3.connect(":memory:")
+        for query in generate_undo_query(graph, query_order=graph.last_order, coalesce=True):
+            conn.execute(query)
+        self.assertEqual(conn.execute("SELECT * FROM X ORDER BY id").fetchall(), rows)
+        conn.close()
+
+    def test_recovery_rollback_to(self):
+        def dump_tables(conn):
+            return {
+                table_name: conn.execute(f"SELECT rowid, * FROM {table_name} ORDER BY rowid").fetchall()
+                for table_name, in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE '_ssqlite_%' ORDER BY name"
+                )
+            }
+
+        conn = ssqlite.connect("rollback.db", sqg_filename="rollback.sqg")
+        snapshots = {0: dump_tables(conn.conn)}
+        for query in [
+            "CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255), score INTEGER)",
+            "INSERT INTO X(id, name, score) VALUES(1, 'Alice', 10)",
+            "INSERT INTO X(id, name, score) VALUES(2, 'Bob', 20)",
+            "UPDATE X SET score=score+5 WHERE id<3",
+            "UPDATE X SET name='Aaron' WHERE id=1",
+            "DELETE FROM X WHERE id=2",
+            "INSERT INTO X(id, name, score) VALUES(2, 'Brendan', 0)",
+            "UPDATE X SET score=7 WHERE id=2",
+            "CREATE TABLE Y (id INTEGER PRIMARY KEY, x_id INTEGER)",
+            "INSERT INTO Y(id, x_id) VALUES(1, 2)",
+            "DROP TABLE X",
+            "CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255), score INTEGER)",
+            "INSERT INTO X(id, name, score) VALUES(1, 'Charles', 30)",
+        ]:
+            conn.execute(query)
+            conn.commit()
+            snapshots[conn.last_order] = dump_tables(conn.conn)
+        conn.close()
+
+        # Undoing everything after any query order brings back the tables as they were then
+        graph = SQG.load_from_file("rollback.sqg")
+        for query_order, snapshot in snapshots.items():
+            conn = sqlite3.connect(":memory:")
+            with sqlite3.connect("rollback.db") as source:
+                source.backup(conn)
+            for query in rollback_to(graph, query_order):
+                conn.execute(query)
+            self.assertEqual(dump_tables(conn), snapshot, msg=f"rollback_to: {query_order}")
+            conn.close()
+
+        # Rows are touched once, whatever happened to them within the range
+        self.assertEqual(
+            generate_undo_range(graph, from_order=5, to_order=8),
+            [
+                "DELETE FROM X WHERE rowid=2;",
+                "INSERT INTO X(id, name, score) VALUES(2, 'Bob', 20)",
+                "UPDATE X SET score=score+5 WHERE rowid=2;",
+                "UPDATE X SET name='Alice' WHERE rowid=1;"
+            ]
+        )
+
+    def test_recovery_apply_undo(self):
+        conn = ssqlite.connect("apply.db", sqg_filename="apply.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255), score INTEGER)")
+        conn.executemany(
+            "INSERT INTO X(id, name, score) VALUES(?, ?, ?)",
+            [(1, "Alice", 10), (2, "Bob", 20), (3, "Charles", 30)]
+        )
+        conn.execute("UPDATE X SET score=score+1 WHERE id<3")
+        conn.commit()
+        rows = conn.execute("SELECT * FROM X ORDER BY id").fetchall()
+
+        # Both statements are undone at once, and the undo is recorded as well
+        conn.execute("DELETE FROM X WHERE id=2")
+        conn.execute("UPDATE X SET name='Aaron' WHERE id=1")
+        conn.commit()
+        conn.undo(range(6, 8))
+        self.assertEqual(conn.execute("SELECT * FROM X ORDER BY id").fetchall(), rows)
+
+        # Restored row is deleted and restored again from the recorded undo
+        conn.execute("DELETE FROM X WHERE id=2")
+        conn.commit()
+        conn.undo(conn.last_order)
+        self.assertEqual(conn.execute("SELECT * FROM X ORDER BY id").fetchall(), rows)
+        conn.close()
+
+        # Rows are restored with parameterized statements
+        graph = SQG.load_from_file("apply.sqg")
+        insert_node = graph.index.find(_from="insert", _key=("X", 2))
+        self.assertEqual(insert_node.query_template, "INSERT INTO X(id, name, score) VALUES(?, ?, ?)")
+        self.assertEqual(insert_node.parameters, (2, "Bob", 20))
+
+        # Within a transaction of the caller, the undo is left for the caller to commit
+        db = sqlite3.connect("apply.db")
+        db.execute("INSERT INTO X(id, name, score) VALUES(4, 'David', 40)")
+        apply_undo(db, graph, graph.last_order)
+        self.assertTrue(db.in_transaction)
+        db.rollback()
+        self.assertEqual(db.execute("SELECT * FROM X ORDER BY id").fetchall(), rows)
+        db.close()
+
+    def test_recovery_cache(self):
+        conn = ssqlite.connect("cache.db", sqg_filename="cache.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+        conn.execute("INSERT INTO X(id, name) VALUES(1, 'Alice')")
+        conn.execute("INSERT INTO X(id, name) VALUES(2, 'Bob')")
+        conn.execute("UPDATE X SET name='Bobby' WHERE id=2")
+        conn.commit()
+        cache = UndoCache(conn.graph, maxsize=2)
+
+        expected_query_set = generate_undo_query(conn.graph, query_order=4)
+        self.assertEqual(cache.get(4), expected_query_set)
+        self.assertEqual(cache.get(4), expected_query_set)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Changes to other rows keep the undo query set, changes to the same row drop it
+        conn.execute("UPDATE X SET name='Aaron' WHERE id=1")
+        conn.commit()
+        cache.get(4)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        conn.execute("DELETE FROM X WHERE id=2")
+        conn.commit()
+        cache.get(4)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # Least recently used undo query set is evicted first
+        cache.get(2)
+        cache.get(4)
+        cache.get(3)
+        self.assertEqual(set(cache.undo_query_sets), {(4, False), (3, False)})
+
+        # CREATE depends on the whole table, and the graph is saved without the cache
+        cache.get(1)
+        conn.execute("DROP TABLE X")
+        conn.close()
+        self.assertEqual(cache.undo_query_sets, {})
+        self.assertIsNone(SQG.load_from_file("cache.sqg").undo_cache)
+
+    def test_recovery_live_rows(self):
+        conn = ssqlite.connect("live.db", sqg_filename="live.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+        conn.execute("INSERT INTO X(id, name) VALUES(1, 'Alice')")
+        conn.execute("INSERT INTO X(id, name) VALUES(2, 'Bob')")
+        conn.execute("UPDATE X SET name='Bobby' WHERE id=2")
+        conn.execute("DELETE FROM X WHERE id=2")
+        conn.execute("INSERT INTO X(id, name) VALUES(2, 'Carl')")
+        conn.execute("UPDATE X SET name='Aaron' WHERE id=1")
+        conn.execute("UPDATE X SET name='Al' WHERE id=1")
+        conn.execute("DROP TABLE X")
+        conn.commit()
+        conn.close()
+
+        # Deleted row is left out, the row inserted again with its rowid is restored last
+        expected_query_set = [
+            "CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))",
+            "INSERT INTO X(id, name) VALUES(1, 'Alice')",
+            "INSERT INTO X(id, name) VALUES(2, 'Carl')",
+            "UPDATE X SET name='Al' WHERE id=1"
+        ]
+        graph = SQG.load_from_file("live.sqg")
+        self.assertEqual(generate_undo_query(graph, query_order=9), expected_query_set)
+        self.assertEqual(
+            generate_undo_query(graph, query_order=5),
+            ["INSERT INTO X(id, name) VALUES(2, 'Bob')", "UPDATE X SET name='Bobby' WHERE id=2"]
+        )
+
+    def test_recovery_prune(self):
+        conn = ssqlite.connect("prune.db", sqg_filename="prune.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+        conn.execute("INSERT INTO X(id, name) VALUES(1, 'Alice')")
+        conn.execute("INSERT INTO X(id, name) VALUES(2, 'Bob')")
+        conn.execute("UPDATE X SET name='Aaron' WHERE id=1")
+        conn.execute("UPDATE X SET name='Al' WHERE id=1")
+        conn.execute("DELETE FROM X WHERE id=2")
+        conn.execute("CREATE TABLE Y (id INTEGER PRIMARY KEY, team VARCHAR(255))")
+        conn.execute("DROP TABLE Y")
+        conn.execute("UPDATE X SET name='Alex' WHERE id=1")
+        conn.commit()
+        conn.close()
+        graph = SQG.load_from_file("prune.sqg")
+        expected_query_sets = {
+            query_order: generate_undo_query(graph, query_order=query_order) for query_order in range(1, 10)
+        }
+
+        # Deleted row, dropped table and the first update of the live row are gone
+        self.assertEqual(graph.prune(keep_last=1), 5)
+        self.assertEqual(graph.last_order, 9)
+        self.assertEqual(generate_undo_query(graph, query_order=9), expected_query_sets[9])
+        self.assertEqual(expected_query_sets[9], ["UPDATE X SET name='Al' WHERE id=1"])
+        with self.assertRaises(NodeNotFound):
+            generate_undo_query(graph, query_order=5)
+        self.assertEqual(generate_undo_range(graph, from_order=9), ["UPDATE X SET name='Al' WHERE rowid=1;"])
+        with self.assertRaises(NodeNotFound):
+            rollback_to(graph, query_order=7)
+
+        # Older updates overwritten from the horizon on are collapsed into the old value of the last one
+        graph = SQG.load_from_file("prune.sqg")
+        self.assertEqual(graph.prune(keep_last=1, collapse_updates=True), 6)
+        self.assertEqual(generate_undo_query(graph, query_order=9), ["UPDATE X SET name='Al' WHERE rowid=1;"])
+
+        # Updates from the horizon on are never collapsed
+        graph = SQG.load_from_file("prune.sqg")
+        self.assertEqual(graph.prune(keep_last=6, collapse_updates=True), 0)
+        for query_order in range(4, 10):
+            self.assertEqual(generate_undo_query(graph, query_order=query_order), expected_query_sets[query_order])
+
+        # Nodes are kept from the first second which may be at or after the given time
+        graph = SQG.load_from_file("prune.sqg")
+        graph.timeline = [(100.0, 1), (200.0, 6)]
+        self.assertEqual(graph.find_order_since(150.0), 1)
+        self.assertEqual(graph.find_order_since(200.0), 6)
+        graph.prune(keep_since=250.0)
+        self.assertEqual(generate_undo_query(graph, query_order=6), expected_query_sets[6])
+
+        # Pruned file keeps its query orders for the next connection
+        SQG.compact("prune.sqg", keep_last=2)
+        conn = ssqlite.connect("prune.db", sqg_filename="prune.sqg")
+        self.assertEqual(conn.last_order, 9)
+        conn.execute("DELETE FROM X WHERE id=1")
+        conn.commit()
+        conn.undo(conn.last_order)
+        self.assertEqual(conn.execute("SELECT * FROM X").fetchall(), [(1, "Alex")])
+        conn.close()
+
+    def test_metrics(self):
+        stages = []
+        with ssqlite.metrics.collect(ssqlite.metrics.Metrics(callbacks=[
+                lambda stage, elapsed, count: stages.append(stage)
+            ])) as metrics:
+            undo_query_set = self.get_undo_query(
+                db_name="metrics.db", sql_filename="test_update.sql",
+                sqg_filename="metrics.sqg", query_order=9
+            )
+
+            # Table created without recording has no node for its rows to link to
+            conn = ssqlite.connect(":memory:", sqg_filename="metrics.sqg")
+            conn.conn.execute("CREATE TABLE Y (id INTEGER PRIMARY KEY)")
+            conn.execute("INSERT INTO Y(id) VALUES(1)")
+            conn.commit()
+            conn.close()
+        self.assertIsNone(ssqlite.metrics.active)
+        self.assertEqual(undo_query_set, ["DELETE FROM X WHERE rowid=2;", "INSERT INTO X(id, name) VALUES(2, 'Bob');"])
+
+        self.assertEqual(metrics.counts["parse"], metrics.counts["execute"])
+        self.assertEqual(metrics.counts["undo.UpdateNode"], 1)
+        self.assertEqual(metrics.counts["skipped"], 1)
+        self.assertEqual(metrics.counts["load"], 2)
+        self.assertEqual(metrics.counts["save"], 2)
+        self.assertEqual(len(stages), sum(metrics.counts.values()) - metrics.counts["skipped"])
+        self.assertIn("undo.UpdateNode", metrics.report())
+
+    def test_build_parallel(self):
+        for sql_filename in ["test_update.sql", "test_drop.sql", "test_multirow.sql", "test_dump.sql"]:
+            graphs = []
+            for workers in [0, 2]:
+                ssqlite.executescript(
+                    db_name=":memory:",
+                    sql_filename=sql_filename,
+                    sqg_filename="parallel.sqg",
+                    workers=workers
+                )
+                graphs.append(SQG.load_from_file("parallel.sqg"))
+
+            # Same nodes with the same query orders, whichever process parsed them
+            serial, parallel = graphs
+            self.assertEqual(sorted(serial.index.order_index), sorted(parallel.index.order_index))
+            for query_order, node in serial.index.order_index.items():
+                self.assertEqual(type(node), type(parallel.index.order_index[query_order]))
+                self.assertEqual(
+                    generate_undo_query(serial, query_order=query_order),
+                    generate_undo_query(parallel, query_order=query_order)
+                )
+
+    def test_recovery_async(self):
+        async def run() -> list[str]:
+            async with await ssqlite.aio.connect("async.db", sqg_filename="async.sqg") as db:
+                await db.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+                # Concurrent statements share transactions, but keep the order they were made in
+                await asyncio.gather(*[
+                    db.execute("INSERT INTO X(id, name) VALUES(?, ?)", (i, f"name{i}")) for i in range(1, 51)
+                ])
+                # Failing statement doesn't take the rest of its batch down with it
+                results = await asyncio.gather(
+                    db.execute("INSERT INTO X(id, name) VALUES(1, 'duplicate')"),
+                    db.execute("UPDATE X SET name='Bob' WHERE id=2"),
+                    return_exceptions=True
+                )
+                self.assertIsInstance(results[0], sqlite3.IntegrityError)
+                self.assertEqual(await db.execute("SELECT name FROM X WHERE id=2"), [("Bob",)])
+
+                undo_query_set = await db.generate_undo_query(52) # UPDATE X SET name='Bob' WHERE id=2
+                await db.undo(52)
+                await db.save()
+                self.assertEqual(await db.execute("SELECT COUNT(*) FROM X"), [(50,)])
+                self.assertEqual(await db.execute("SELECT name FROM X WHERE id=2"), [("name2",)])
+            with self.assertRaises(sqlite3.ProgrammingError):
+                await db.execute("SELECT 1")
+            return undo_query_set
+
+        undo_query_set = asyncio.run(run())
+        expected_query_set = [
+            "DELETE FROM X WHERE rowid=2;",
+            "INSERT INTO X(id, name) VALUES(2, 'name2')"
+        ]
+        self.assertEqual(
+            [query.lower() for query in undo_query_set],
+            [query.lower() for query in expected_query_set]
+        )
+        graph = SQG.load_from_file("async.sqg")
+        # Undo is recorded as its DELETE and INSERT
+        self.assertEqual(graph.last_order, 54)
+
+    def test_recovery_partitioned(self):
+        conn = ssqlite.connect("partition.db", sqg_filename="partition.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+        conn.execute("CREATE TABLE Y (id INTEGER PRIMARY KEY, name VARCHAR(255))")
+        conn.executemany("INSERT INTO X(id, name) VALUES(?, ?)", [(1, "Alice"), (2, "Bob")])
+        conn.executemany("INSERT INTO Y(id, name) VALUES(?, ?)", [(1, "Charles"), (2, "David")])
+        conn.execute("UPDATE X SET name='Aaron' WHERE id=1")
+        conn.execute("UPDATE Y SET name='Brendan' WHERE id=2")
+        conn.commit()
+        conn.close()
+        graph = SQG.load_from_file("partition.sqg")
+        PartitionedQueryGraph.save_to_file(PartitionedQueryGraph.from_graph(graph), "partition.sqg")
+
+        # Undo only loads the shard of its table
+        partitioned = PartitionedQueryGraph.load_from_file("partition.sqg")
+        self.assertEqual(
+            generate_undo_query(partitioned, query_order=8), # UPDATE Y SET name='Brendan' WHERE id=2
+            generate_undo_query(graph, query_order=8)
+        )
+        self.assertEqual(list(partitioned.shards), ["Y"])
+        self.assertEqual(generate_undo_range(partitioned, 3), generate_undo_range(graph, 3))
+
+        # Recorded undo goes to the shard of its table
+        db = sqlite3.connect("partition.db")
+        apply_undo(db, partitioned, 7)
+        PartitionedQueryGraph.save_to_file(partitioned, "partition.sqg")
+        self.assertEqual(db.execute("SELECT name FROM X WHERE id=1").fetchall(), [("Alice",)])
+        db.close()
+
+        # Shards are pruned independently, at the same horizon
+        PartitionedQueryGraph.compact("partition.sqg", keep_last=4, workers=2)
+        partitioned = PartitionedQueryGraph.load_from_file("partition.sqg")
+        self.assertEqual(partitioned.last_order, 10)
+        with self.assertRaises(NodeNotFound):
+            generate_undo_query(partitioned, query_order=6)
+        undo_query_set = generate_undo_query(partitioned, query_order=8)
+        expected_query_set = [
+            "DELETE FROM Y WHERE rowid=2;",
+            "INSERT INTO Y(id, name) VALUES(2, 'David')"
+        ]
+        self.assertEqual(
+            [query.lower() for query in undo_query_set],
+            [query.lower() for query in expected_query_set]
+        )
+
+    def test_recovery_rowid_reuse(self):
+        conn = ssqlite.connect("reuse.db", sqg_filename="reuse.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255), team VARCHAR(255))")
+        for name in ["a", "b", "c"]:
+            conn.execute(f"INSERT INTO X(name, team) VALUES('{name}', 'red')")
+        conn.execute("DELETE FROM X WHERE id>=2")
+        # New row takes rowid 2 over, and is updated on its own
+        conn.execute("INSERT INTO X(name, team) VALUES('new', 'blue')")
+        conn.execute("UPDATE X SET name='newer' WHERE id=2")
+        conn.commit()
+        conn.close()
+
+        graph = SQG.load_from_file("reuse.sqg")
+        undo_query_set = generate_undo_query(graph, query_order=5) # DELETE FROM X WHERE id>=2
+        expected_query_set = ["INSERT INTO X(rowid, name, team) VALUES(2, 'b', 'red'), (3, 'c', 'red');"]
+        self.assertEqual(undo_query_set, expected_query_set)
+        self.assertEqual(generate_undo_query(graph, query_order=5, coalesce=True), expected_query_set)
+
+    def test_recovery_indb_rowid_reuse(self):
+        statements = [
+            "CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255))",
+            "INSERT INTO X(name) VALUES('a')",
+            "INSERT INTO X(name) VALUES('b')",
+            "UPDATE X SET name='bb' WHERE id=2",
+            "DELETE FROM X WHERE id=2",
+            # New row takes rowid 2 over, so its update doesn't follow the one of the deleted row
+            "INSERT INTO X(name) VALUES('new')",
+            "UPDATE X SET name='newer' WHERE id=2",
+            "UPDATE X SET name='newest' WHERE id=2"
+        ]
+        graph_by_backend, conns = {}, []
+        for backend, sqg_filename in [("pickle", "picklereuse.sqg"), ("indb", None)]:
+            conn = ssqlite.connect(f"{backend}reuse.db", sqg_filename=sqg_filename)
+            for statement in statements:
+                conn.execute(statement)
+            conn.commit()
+            graph_by_backend[backend] = conn.graph
+            conns.append(conn)
+
+        for query_order in range(2, len(statements) + 1):
+            self.assertEqual(
+                generate_undo_query(graph_by_backend["indb"], query_order=query_order),
+                generate_undo_query(graph_by_backend["pickle"], query_order=query_order),
+                msg=f"{query_order}"
+            )
+        self.assertEqual(
+            generate_undo_query(graph_by_backend["indb"], query_order=7),
+            ["DELETE FROM X WHERE rowid=2;", "INSERT INTO X(rowid, name) VALUES(2, 'new');"]
+        )
+        for conn in conns:
+            conn.close()
+
+    def test_recovery_multi_update_replay(self):
+        conn = ssqlite.connect("replay.db", sqg_filename="replay.sqg")
+        conn.execute("CREATE TABLE X (id INTEGER PRIMARY KEY, name VARCHAR(255), team VARCHAR(255))")
+        conn.executemany(
+            "INSERT INTO X(id, name, team) VALUES(?, ?, ?)",
+            [(1, "a", "red"), (2, "b", "red"), (3, "c", "red")]
+        )
+        conn.execute("UPDATE X SET name='multi' WHERE team='red'")
+        conn.execute("UPDATE X SET name='one' WHERE id=1")
+        conn.execute("UPDATE X SET name='z' WHERE id=2")
+        conn.execute("DELETE FROM X WHERE id=3")
+        conn.commit()
+        conn.close()
+
+        # UPDATE ... WHERE team='red' is only replayed on the undone row, leaving row 2 as it is
+        graph = SQG.load_from_file("replay.sqg")
+        undo_query_set = generate_undo_query(graph, query_order=6) # UPDATE X SET name='one' WHERE id=1
+        self.assertEqual(undo_query_set, ["UPDATE X SET name='multi' WHERE rowid=1;"])
+        undo_query_set = generate_undo_query(graph, query_order=8) # DELETE FROM X WHERE id=3
+        expected_query_set = [
+            "INSERT INTO X(id, name, team) VALUES(3, 'c', 'red')",
+            "UPDATE X SET name='multi' WHERE rowid=3;"
+        ]
+        self.assertEqual(undo_query_set, expected_query_set)
+
+    def test_recovery_rollback_differential(self):
+        for seed in range(3):
+            rng = random.Random(seed)
+            for filename in ["differential.db", "differential.sqg"]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            conn = ssqlite.connect("differential.db", sqg_filename="differential.sqg")
+            snapshots = {0: self.get_snapshot(conn.conn)}
+            for statement in self.generate_statements(rng, num_statements=150):
+                conn.execute(statement)
+                conn.commit()
+                snapshots[conn.last_order] = self.get_snapshot(conn.conn)
+
+            # Rolling back to any query order gives the database back as it was then
+            query_orders = sorted(snapshots)[:-1]
+            for query_order in rng.sample(query_orders, 20):
+                db = sqlite3.connect(":memory:")
+                conn.conn.backup(db)
+                for query in rollback_to(conn.graph, query_order):
+                    db.execute(query)
+                self.assertEqual(self.get_snapshot(db), snapshots[query_order], f"seed {seed}, query order {query_order}")
+                db.close()
+            conn.close()
+
+    def test_build_iterdump(self):
+        source = sqlite3.connect(":memory:")
+        source.execute('CREATE TABLE "X" (id INTEGER PRIMARY KEY, name VARCHAR(255))')
+        source.execute("CREATE INDEX ix ON X(name)")
+        source.executemany("INSERT INTO X(id, name) VALUES(?, ?)", [(1, "Alice"), (2, "O'Brien")])
+        source.commit()
+        sql_filepath = os.path.join(ssqlite.config.BASE_DIR, "data", "iterdump.sql")
+        with open(sql_filepath, "w") as f:
+            f.write("\n".join(source.iterdump()))
+
+        # Quoted tables are recorded, and statements which aren't recorded are executed anyway
+        ssqlite.executescript(
+            db_name="iterdump.db", sql_filename="iterdump.sql", sqg_filename="iterdump.sqg"
+        )
+        os.remove(sql_filepath)
+        db = sqlite3.connect("iterdump.db")
+        self.assertEqual(list(db.iterdump()), list(source.iterdump()))
+        db.close()
+        graph = SQG.load_from_file("iterdump.sqg")
+        undo_query_set = generate_undo_query(graph, query_order=4) # INSERT INTO "X" VALUES(2,'O''Brien')
+        self.assertEqual(undo_query_set, ["DELETE FROM X WHERE rowid=2;"])
+
+        # Rolling back to a savepoint would leave nodes of rows which aren't there, so it's refused
+        with open(sql_filepath, "w") as f:
+            f.write("\n".join([
+                "CREATE TABLE Y (id INTEGER PRIMARY KEY, name VARCHAR(255));",
+                "SAVEPOINT s;",
+                "INSERT INTO Y(id, name) VALUES(1, 'Alice');",
+                "ROLLBACK TO s;"
+            ]))
+        with self.assertRaisesRegex(InvalidOperation, "SAVEPOINT"):
+            ssqlite.executescript(db_name=":memory:", sql_filename="iterdump.sql", sqg_filename="iterdump.sqg")
+        os.remove(sql_filepath)
+
 
 if __name__ == "__main__":
 